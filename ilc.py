@@ -1,6 +1,10 @@
 from __future__ import print_function
 
 import argparse
+import copy
+import json
+import multiprocessing
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -9,14 +13,75 @@ from scipy.interpolate import interp1d
 from scipy.signal import savgol_filter
 
 from ilc_models import base, trivial, one, quadlin, quadlinpos, nl1d, quad2dlin, quad2d, quad2ddedi, quad2ddedis, quad3d, quad3dtv, quad3dfl, quad3dflv, quad3dfltd, quad3dfls
+from ilc_models.divergence import DivergenceMonitor
+from ilc_models.fb_check import analytic_responses, feedback_jacobians, mismatch_report
+from ilc_models.rollout_cache import RolloutCache, content_key
+from ilc_models.integrators import integrators
+from ilc_models.stream import BinaryAppender, ColumnRecorder, Decimator, Resampler, RunningErrorStats, run_stream, stream_chunks
 from python_utils.polyu import deriv_fitting_matrix
+from solvers import anytime_lsqr, dual_lstsq, lifted_operator, operator_norm
 
 
+# Options that do not change the simulation of a trial with given ILC controls,
+# left out of the rollout cache keys (the ILC grid is part of the key).
+rollout_independent_args = (
+  'ilc_dt', 'ilc_dt_start', 'ilc_grid', 'ilc_grid_floor', 'refine_every', 'trials', 'alpha', 'w',
+  'relin_time', 'relin_iter', 'filter', 'p2p_times', 'update_law', 'solver', 'solve_deadline',
+  'check_fb_resp', 'fb_resp_method', 'fb_resp_eps', 'noise', 'noise_stddev', 'poke',
+  'stream', 'stream_chunk', 'stream_file', 'stream_decimate', 'rollouts', 'rollout_dist_spread',
+  'cache_dir', 'cache_size', 'cache_linearization', 'event_log_interval', 'no_stdout', 'print_params',
+  'plot', 'plot_fb_resp', 'plot_controls', 'plot_control_corrections', 'plot_updates', 'plot_all',
+  'save', 'save_dir_prefix', 'save_symlink',
+)
+
+# Options that, with the ILC grid and the constrained outputs, determine the
+# learning operators of the constant_ilc_mats models (see shared_operators).
+constant_operator_args = ('system', 'feedback', 'discretization', 'w', 'solver', 'update_law')
+
+# Rollout of a candidate step size (see --alpha-candidates), set before
+# forking the workers that run it, which inherit it.
+speculative_rollout = None
+
+def run_speculative_rollout(k):
+  return speculative_rollout(k)
+
 def get_poly(x, v=0, a=0, j=0, end_pos=1.0, duration=1.0):
   poly_fit_mat = np.linalg.inv(deriv_fitting_matrix(8, t_end=duration))
   poly = poly_fit_mat.dot(np.array((x, v, a, j, end_pos, 0, 0, 0)))
   return poly[::-1]
 
+def get_graded_grid(ts, density, n_steps):
+  """ Returns n_steps + 1 times spanning ts, spaced so that every step
+      covers an equal integral of density (density must be positive). """
+  cum_density = np.hstack((0, np.cumsum(0.5 * (density[1:] + density[:-1]) * np.diff(ts))))
+  return np.interp(np.linspace(0, cum_density[-1], n_steps + 1), cum_density, ts)
+
+def get_ilc_dts(ts_ilc, uniform):
+  """ Returns the durations of the ILC steps, one for all steps of a
+      uniform grid (which need not be the nominal ILC dt when that does
+      not divide the grid's duration) and one per step otherwise. """
+  if uniform:
+    return (ts_ilc[-1] - ts_ilc[0]) / (len(ts_ilc) - 1)
+
+  return np.diff(ts_ilc)
+
+def get_output_inds(ts_ilc, p2p_times):
+  """ Returns the ILC steps whose outputs are constrained for point-to-point ILC.
+      The output of step i is at time ts_ilc[i + 1].
+      p2p_times are time instants ("0.5") or windows ("0.5:0.7"). """
+  out_ts = ts_ilc[1:]
+  inds = set()
+  for spec in p2p_times:
+    if ':' in spec:
+      start, end = (float(t) for t in spec.split(':'))
+      window = np.flatnonzero((out_ts >= start - 1e-9) & (out_ts <= end + 1e-9))
+      assert len(window), "P2P window %s contains no ILC steps" % spec
+      inds.update(window)
+    else:
+      inds.add(np.argmin(np.abs(out_ts - float(spec))))
+
+  return np.array(sorted(inds), dtype=int)
+
 system_map = {
                # ilc, DIMS
   'trivial':   (trivial.Trivial, 1),
@@ -42,6 +107,11 @@ def get_parser():
   # General
   parser.add_argument("--system", type=str, default="simple", choices=system_map.keys(), help="Type of system to simulate.")
   parser.add_argument("--sim-dt", type=float, default=0.02, help="Time between simulation steps.")
+  parser.add_argument("--sim-substeps", default=1, type=int, help="No. of physics steps per controller call. The controller runs every --sim-dt and its output is held over the substeps.")
+  parser.add_argument("--fast-sim", default=False, action='store_true', help="Use the quaternion based preallocated rigid body integrator in 3D Quads.")
+  parser.add_argument("--integrator", default="euler", choices=integrators.keys(), help="Integrator for the vehicle dynamics between control ticks (the control is held constant over each sim step).")
+  parser.add_argument("--fl-integrator", default="explicit", choices=["explicit", "implicit", "exponential"], help="For the feedback linearized systems (2ddedi, 3ddedi...), redo each sim step in flat coordinates with the stiff linear feedback treated linearly implicitly or exponentially. Stays stable at larger --sim-dt.")
+  parser.add_argument("--integrator-tol", default=1e-6, type=float, help="Relative and absolute local error tolerance of adaptive integrators (rk45).")
 
   # Trajectory
   parser.add_argument("--dist", default=1.5, type=float, help="Distance to travel.")
@@ -57,16 +127,29 @@ def get_parser():
 
   # ILC
   parser.add_argument("--ilc-dt", type=float, default=0.02, help="Time between ILC corrections.")
+  parser.add_argument("--ilc-dt-start", type=float, default=0.0, help="Coarse-to-fine schedule: time between ILC corrections for the first updates, halved every --refine-every trials down to --ilc-dt. 0 disables the schedule.")
+  parser.add_argument("--ilc-grid", default="uniform", choices=["uniform", "reference", "error"], type=str, help="Spacing of the ILC time grid. reference concentrates ILC steps where the desired jerk and snap are large, error where the previous trial's position error curvature is large.")
+  parser.add_argument("--ilc-grid-floor", default=0.2, type=float, help="Relative ILC step density kept everywhere on a nonuniform ILC grid.")
+  parser.add_argument("--refine-every", type=int, default=1, help="No. of trials between ILC grid refinements when using --ilc-dt-start.")
   parser.add_argument("--trials", type=int, default=4, help="Number of ILC trials to run.")
   parser.add_argument("--alpha", type=float, default=1.0, help="Percentage of update (0 - 1) to use at each iteration. Lower values increase stability.")
+  parser.add_argument("--alpha-candidates", default=None, nargs='+', type=float, help="Instead of --alpha, roll out the update scaled by each of these in parallel and keep the one with the lowest avg. pos error. Its rollout is the next trial, so the no. of trials stays the same.")
+  parser.add_argument("--speculative-workers", default=0, type=int, help="No. of processes rolling out the --alpha-candidates (forked, 0 for one per candidate). Without fork (or inside a daemonic sweep worker) they run one after another.")
   parser.add_argument("--relin-time", default=True, action='store_true', help="Use a different linearization point at each time step along the trajectory.")
   parser.add_argument("--relin-iter", default=True, action='store_true', help="Use different linearization points for each iteration.")
   parser.add_argument("--no-relin-time", default=False, dest='relin_time', action='store_false')
   parser.add_argument("--no-relin-iter", default=False, dest='relin_iter', action='store_false')
   parser.add_argument("--w", default=1e-1, type=float, help="Weight of control update norm minimization.")
   parser.add_argument("--filter", default=False, action='store_true', help="Filter the position errors fed into ILC.")
+  parser.add_argument("--p2p-times", default=None, nargs='+', type=str, help="Point-to-point ILC: only penalize the position error at these times (s) or time windows (start:end).")
+  parser.add_argument("--discretization", default="euler", choices=["euler", "zoh"], type=str, help="Discretization of the linearized models over each ILC step. zoh uses the exact zero-order hold discretization (matrix exponential) of the continuous Jacobians behind the explicit Euler ones, which stays accurate on coarse ILC grids.")
+  parser.add_argument("--update-law", default="norm-optimal", choices=["norm-optimal", "gradient"], type=str, help="ILC learning law. gradient uses u += gamma * P^T e, computed in O(N) by a backward recursion, with gamma = 1 / ||P||^2 estimated by power iteration (--w is not used).")
+  parser.add_argument("--solver", default="lstsq", choices=["lstsq", "lsqr"], type=str, help="Method used to solve for the ILC update. lsqr is iterative and can be stopped early by --solve-deadline.")
+  parser.add_argument("--solve-deadline", default=0.0, type=float, help="Wall-clock budget (s) for computing each ILC update with the lsqr solver, including linearization. The best update found so far is used when it runs out. 0 means no deadline.")
 
   parser.add_argument("--check-fb-resp", default=False, action='store_true', help="Check the feedback response along the final trajectory against numerical differentiation.")
+  parser.add_argument("--fb-resp-method", default="central", choices=["forward", "central", "complex"], type=str, help="Numerical differentiation used for the feedback response. complex (complex step) needs a model whose feedback_batch is analytic and falls back to central otherwise.")
+  parser.add_argument("--fb-resp-eps", default=1e-6, type=float, help="Step of the numerical differentiation of the feedback response.")
 
   # Disturbances
   parser.add_argument("--thrust-dist", default=1.0, type=float, help="Disturbance used to scale the commanded thrust u.")
@@ -87,6 +170,9 @@ def get_parser():
   parser.add_argument("--angaccel-limit", default=3000, type=float, help="Maximum magnitude of the angular acceleration control input for 3D Quads.")
   parser.add_argument("--accel-limit", default=50, type=float, help="Maximum magnitude of the linear acceleration control input for 3D Quads.")
 
+  parser.add_argument("--init-pos-offset", default=None, nargs='+', type=float, help="Offset (m) of the initial position from the start of the reference, per axis or one value for all axes.")
+  parser.add_argument("--init-vel-offset", default=None, nargs='+', type=float, help="Initial velocity (m/s), per axis or one value for all axes.")
+
   parser.add_argument("--noise", default=False, action='store_true', help="Add noise to the position errors fed into ILC.")
   parser.add_argument("--noise-stddev", default=1e-3, type=float, help="Stddev of noise added to the position errors")
 
@@ -95,7 +181,25 @@ def get_parser():
   parser.add_argument("--poke-time", default=0.5, type=float, help="Time of poke.")
   parser.add_argument("--poke-duration", default=0.03, type=float, help="Duration of poke.")
 
+  parser.add_argument("--stream", default=False, action='store_true', help="Compute the trial metrics from simulate_stream, only keeping the states the ILC update needs.")
+  parser.add_argument("--stream-chunk", default=256, type=int, help="No. of simulation steps per chunk passed to the stream sinks.")
+  parser.add_argument("--stream-file", default=None, type=str, help="With --stream, append the (t, x, u) records of trial i to STREAM_FILE-i.bin (layout in the .json sidecar).")
+  parser.add_argument("--stream-decimate", default=1, type=int, help="Only write every n-th record to --stream-file.")
+
+  parser.add_argument("--abort-pos-error", default=None, type=float, help="Stop a trial early (diverged) once the position error norm exceeds this (m).")
+  parser.add_argument("--abort-saturation-steps", default=None, type=int, help="Stop a trial early (diverged) after this many steps in a row with saturation or clipping events.")
+  parser.add_argument("--abort-nan", default=False, action='store_true', help="Stop a trial early (diverged) once the state is not finite.")
+
+  parser.add_argument("--rollouts", default=0, type=int, help="No. of vehicles to simulate together (simulate_batch) with the final controls, each with randomly scaled disturbances.")
+  parser.add_argument("--rollout-dist-spread", default=0.1, type=float, help="Each rollout scales the disturbance parameters by a uniform random factor in [1 - spread, 1 + spread].")
+
+  # Cache Options
+  parser.add_argument("--cache-dir", default=None, type=str, help="Directory of a cache of simulated trials, keyed by a hash of the options, reference and ILC controls. Trials found there are loaded instead of simulated, e.g. the first trial of every run in a sweep over --alpha or --w.")
+  parser.add_argument("--cache-size", default=1024, type=float, help="Size limit (MB) of the cache directory. The least recently used entries are removed beyond it.")
+  parser.add_argument("--cache-linearization", default=False, action='store_true', help="Also cache the ILC learning operators (lstsq / lsqr updates).")
+
   # Output Options
+  parser.add_argument("--event-log-interval", default=None, type=float, help="Print simulation events (e.g. saturation) as they happen, at most once per this many simulated seconds per event type. By default they are only counted and summarized per trial.")
   parser.add_argument("--no-stdout", default=False, action='store_true', help="Print stats to stdout.")
   parser.add_argument("--print-params", default=False, action='store_true', help="Print tabulated params at start.")
   parser.add_argument("--plot", default=False, action='store_true', help="Plot the states for each trial.")
@@ -113,7 +217,9 @@ def get_parser():
   return parser
 
 class ILCExperiment(object):
-  def __init__(self, args):
+  def __init__(self, args, shared_operators=None):
+    """ shared_operators (see SharedOperators) supplies and receives the
+        learning operators of constant_ilc_mats models across runs. """
     assert args.relin_time or not args.relin_iter
     assert not (args.relin_time and (not args.relin_iter) and (not args.feedforward))
 
@@ -125,7 +231,13 @@ class ILCExperiment(object):
     ilc = ilc_c(**vars(args))
     AXIS = 1 if DIMS == 3 else 0
 
-    ilc_dt = args.ilc_dt
+    def ilc_dt_schedule(iter_no):
+      if args.ilc_dt_start <= 0:
+        return args.ilc_dt
+
+      return max(args.ilc_dt, args.ilc_dt_start / 2 ** (iter_no // args.refine_every))
+
+    ilc_dt = ilc_dt_schedule(0)
     sim_dt = args.sim_dt
     poly_tend = args.traj_duration
     t_end = poly_tend + args.rest_time
@@ -137,7 +249,6 @@ class ILCExperiment(object):
     ts = np.linspace(0, t_end, N + 1)
 
     N_ilc = int(round(t_end / ilc_dt))
-    ts_ilc = np.linspace(0, t_end, N_ilc + 1)
 
     poke_center = args.poke_time / sim_dt
     poke_steps = args.poke_duration / sim_dt
@@ -174,6 +285,22 @@ class ILCExperiment(object):
       jerks_des = pad_des(np.zeros(len(poly_ts)))
       snaps_des = pad_des(np.zeros(len(poly_ts)))
 
+    def make_ts_ilc(N_ilc, pos_errors=None):
+      """ Returns the ILC grid, graded according to --ilc-grid """
+      if args.ilc_grid == 'reference':
+        activity = [np.abs(jerks_des), np.abs(snaps_des)]
+      elif args.ilc_grid == 'error' and pos_errors is not None:
+        err_accels = np.gradient(np.gradient(pos_errors, ts, axis=0), ts, axis=0)
+        activity = [np.linalg.norm(err_accels, axis=1)]
+      else:
+        return np.linspace(0, t_end, N_ilc + 1)
+
+      density = args.ilc_grid_floor + sum(a / max(np.max(a), 1e-12) for a in activity)
+      return get_graded_grid(ts, density, N_ilc)
+
+    ts_ilc = make_ts_ilc(N_ilc)
+    ilc_dts = get_ilc_dts(ts_ilc, args.ilc_grid == 'uniform')
+
     lifted_control = np.zeros(N_ilc * ilc.n_control)
     if (DIMS == 2 or DIMS == 3) and not args.feedback:
       lifted_control[::ilc.n_control] = base.g
@@ -183,23 +310,34 @@ class ILCExperiment(object):
     if args.feedforward:
       assert hasattr(ilc, 'feedforward')
 
-      ff_states = []
-      ff_controls = []
+      if getattr(ilc, 'feedforward_batch', None) is not None:
+        hod_arrs = []
+        for hod in [poss_des, vels_des, accels_des, jerks_des, snaps_des]:
+          arr = np.zeros((N, DIMS))
+          arr[:, AXIS] = hod[:N]
+          hod_arrs.append(arr)
+
+        ff_states, ff_controls = ilc.feedforward_batch(*hod_arrs, ts=ts[:N])
+
+      else:
+        ff_states = []
+        ff_controls = []
 
-      for i in range(N):
-        hods = [poss_des[i], vels_des[i], accels_des[i], jerks_des[i], snaps_des[i]]
-        hod_vecs = []
-        for hod in hods:
-          vec = np.zeros(DIMS)
-          vec[AXIS] = hod
-          hod_vecs.append(vec)
+        for i in range(N):
+          hods = [poss_des[i], vels_des[i], accels_des[i], jerks_des[i], snaps_des[i]]
+          hod_vecs = []
+          for hod in hods:
+            vec = np.zeros(DIMS)
+            vec[AXIS] = hod
+            hod_vecs.append(vec)
 
-        state, control = ilc.feedforward(*hod_vecs)
-        ff_states.append(state)
-        ff_controls.append(control)
+          ilc.events.clock = ts[i]
+          state, control = ilc.feedforward(*hod_vecs)
+          ff_states.append(state)
+          ff_controls.append(control)
 
-      ff_states = np.array(ff_states)
-      ff_controls = np.array(ff_controls)
+        ff_states = np.array(ff_states)
+        ff_controls = np.array(ff_controls)
 
       if not args.feedback:
         ff_controls_interp = interp1d(ts[:-1], ff_controls, axis=0)(ts_ilc[:-1])
@@ -236,223 +374,178 @@ class ILCExperiment(object):
     snaps_des_vec = np.zeros((N + 1, DIMS))
     snaps_des_vec[:, AXIS] = snaps_des
 
-    poss_des_interp = interp1d(ts, poss_des_vec, axis=0)(ts_ilc)
-    vels_des_interp = interp1d(ts, vels_des_vec, axis=0)(ts_ilc)
-    accels_des_interp = interp1d(ts, accels_des_vec, axis=0)(ts_ilc)
-    jerks_des_interp = interp1d(ts, jerks_des_vec, axis=0)(ts_ilc)
-    snaps_des_interp = interp1d(ts, snaps_des_vec, axis=0)(ts_ilc)
+    def desired_on_grid(ts_ilc):
+      return [interp1d(ts, des, axis=0)(ts_ilc) for des in (poss_des_vec, vels_des_vec, accels_des_vec, jerks_des_vec, snaps_des_vec)]
 
-    class Controller:
-      def __init__(self, lifted_control, poss_des, vels_des, accels_des, jerks_des, snaps_des):
-        self.poss_des = poss_des
-        self.vels_des = vels_des
+    def prolong_controls(lifted, old_ts_ilc, new_ts_ilc):
+      """ Moves a lifted control vector to a new ILC grid using the same
+          interpolation the controller applies to it. """
+      controls_ilc = lifted.reshape((len(old_ts_ilc) - 1, ilc.n_control))
+      return interp1d(old_ts_ilc[:-1], controls_ilc, axis=0, fill_value="extrapolate")(new_ts_ilc[:-1]).ravel()
 
-        self.accs_des = []
-        self.jerks_des = []
-        self.snaps_des = []
-        self.angvels_des = []
-        self.angaccels_des = []
+    poss_des_interp, vels_des_interp, accels_des_interp, jerks_des_interp, snaps_des_interp = desired_on_grid(ts_ilc)
 
-        controls_ilc = np.zeros((N_ilc, ilc.n_control))
-        for i in range(controls_ilc.shape[0]):
-          controls_ilc[i, :] = lifted_control[ilc.n_control * i : ilc.n_control * (i + 1)]
+    def get_angular_des():
+      """ Returns the desired angular velocities and accelerations
+          of every sim step for the desired thrust direction """
+      if args.model_drag:
+        drag_dist_control = args.drag_dist
+      else:
+        drag_dist_control = 0
 
-        self.controls = interp1d(ts_ilc[:-1], controls_ilc, axis=0, fill_value="extrapolate")(ts[:-1])
+      accel = accels_des_vec[:N]
+      jerk = jerks_des_vec[:N]
+      snap = snaps_des_vec[:N]
 
-        for i in range(N):
-          accel = accels_des[i, :]
-          jerk = jerks_des[i, :]
-          snap = snaps_des[i, :]
-
-          self.accs_des.append(accel)
-          if args.feedforward:
-            self.jerks_des.append(jerk)
-            self.snaps_des.append(snaps_des[i, :])
-          else:
-            self.jerks_des.append(jerk * 0)
-            self.snaps_des.append(snaps_des[i, :] * 0)
+      acc_vec = accel + ilc.g_vec + drag_dist_control * vels_des_vec[:N]
+      u = np.linalg.norm(acc_vec, axis=1)
 
-          if args.system in ['linear', 'linearpos']:
-            self.angvels_des.append(self.jerks_des[-1])
-            self.angaccels_des.append(self.snaps_des[-1])
+      for i in np.flatnonzero(u < 1e-3):
+        ilc.events.record('low_acc_norm', ts[i])
 
-          elif '2d' in args.system or '3d' in args.system:
-            if args.model_drag:
-              drag_dist_control = args.drag_dist
-            else:
-              drag_dist_control = 0
+      z_b      = acc_vec / u[:, np.newaxis]
 
-            acc_vec = accel + ilc.g_vec + drag_dist_control * vels_des[i]
-            u = np.linalg.norm(acc_vec)
+      u_dot = np.sum(z_b * (jerk + drag_dist_control * accel), axis=1)
+      z_b_dot  = (jerk - u_dot[:, np.newaxis] * z_b + drag_dist_control * accel) / u[:, np.newaxis]
 
-            if u < 1e-3:
-              print("WARNING: acc norm too low!")
+      u_ddot = np.sum(snap * z_b, axis=1) + u * np.sum(z_b_dot * z_b_dot, axis=1) + drag_dist_control * np.sum(jerk * z_b, axis=1)
+      z_b_ddot = (snap - u_ddot[:, np.newaxis] * z_b - 2 * u_dot[:, np.newaxis] * z_b_dot + drag_dist_control * jerk) / u[:, np.newaxis]
 
-            z_b      = (1.0 / u) * acc_vec
+      if DIMS == 2:
+        return (z_b[:, 0] * z_b_dot[:, 1] - z_b[:, 1] * z_b_dot[:, 0],
+                z_b[:, 0] * z_b_ddot[:, 1] - z_b[:, 1] * z_b_ddot[:, 0])
 
-            u_dot = z_b.dot(jerk + drag_dist_control * accel)
-            z_b_dot  = (1.0 / u) * (jerk - u_dot * z_b + drag_dist_control * accel)
+      return np.cross(z_b, z_b_dot), np.cross(z_b, z_b_ddot)
 
-            u_ddot = snap.dot(z_b) + u * z_b_dot.dot(z_b_dot) + drag_dist_control * jerk.dot(z_b)
-            z_b_ddot = (1.0 / u) * (snap - u_ddot * z_b - 2 * u_dot * z_b_dot + drag_dist_control * jerk)
+    # Feedback inputs derived from the reference, fixed over the experiment.
+    fb_accs_des = accels_des_vec[:N]
+    if args.feedforward:
+      fb_jerks_des = jerks_des_vec[:N]
+      fb_snaps_des = snaps_des_vec[:N]
+    else:
+      fb_jerks_des = np.zeros((N, DIMS))
+      fb_snaps_des = np.zeros((N, DIMS))
 
-            theta = np.arctan2(-z_b[0], z_b[1])
-            angvel = np.cross(z_b, z_b_dot)
-            angacc = np.cross(z_b, z_b_ddot)
+    if args.system in ['linear', 'linearpos']:
+      fb_angvels_des = fb_jerks_des
+      fb_angaccels_des = fb_snaps_des
 
-            if args.feedforward:
-              self.angvels_des.append(angvel)
-              self.angaccels_des.append(angacc)
-            else:
-              self.angvels_des.append(angvel * 0)
-              self.angaccels_des.append(angacc * 0)
-          else:
-              self.angvels_des.append(0)
-              self.angaccels_des.append(0)
+    elif '2d' in args.system or '3d' in args.system:
+      fb_angvels_des, fb_angaccels_des = get_angular_des()
+
+      if not args.feedforward:
+        fb_angvels_des = np.zeros_like(fb_angvels_des)
+        fb_angaccels_des = np.zeros_like(fb_angaccels_des)
+
+    else:
+      fb_angvels_des = np.zeros(N)
+      fb_angaccels_des = np.zeros(N)
+
+    def get_interp_weights(xs, new_xs):
+      """ Returns the indices and weights of linear interpolation
+          (extrapolation outside xs) from xs to new_xs """
+      inds = np.clip(np.searchsorted(xs, new_xs, side='right') - 1, 0, len(xs) - 2)
+      weights = (new_xs - xs[inds]) / (xs[inds + 1] - xs[inds])
+      return inds, weights[:, np.newaxis]
+
+    # From the ILC grid to the sim steps, recomputed when the grid changes.
+    control_interp = get_interp_weights(ts_ilc[:-1], ts[:-1])
+
+    class Controller:
+      def __init__(self, lifted_control, poke=False):
+        inds, weights = control_interp
+        controls_ilc = lifted_control.reshape((N_ilc, ilc.n_control))
+        self.controls = (1 - weights) * controls_ilc[inds] + weights * controls_ilc[inds + 1]
 
         self.index = 0
 
-        self.compute_feedback_response = False
-        self.feedback_responses = []
-        self.feedback_responses_ana = []
-        self.final_controls = []
+        self.poke = poke
+        self.final_controls = None
+
+        # Time spent in ilc.feedback at every step of get_feedback
+        self.feedback_times = np.zeros(N)
 
-      def get(self, x):
+        if not args.feedback:
+          self.get = self.get_open_loop
+        elif poke:
+          self.get = self.get_poked
+        else:
+          self.get = self.get_feedback
+
+      def start_batch(self, M):
+        """ Controllers with internal state and no feedback_batch get one copy per rollout. """
+        if args.feedback and getattr(ilc, 'feedback_batch', None) is None:
+          self.rollout_ilcs = [copy.deepcopy(ilc) for _ in range(M)]
+          for rollout_ilc in self.rollout_ilcs:
+            rollout_ilc.reset()
+            if getattr(rollout_ilc, 'zs', None) is not None:
+              rollout_ilc.zs.reserve(N)
+
+      def step_kwargs(self, i):
+        """ The arguments of ilc.feedback at step i other than the state """
+        return dict(
+          dt=sim_dt,
+          pos_des=poss_des_vec[i],
+          vel_des=vels_des_vec[i],
+          acc_des=fb_accs_des[i],
+          jerk_des=fb_jerks_des[i],
+          snap_des=fb_snaps_des[i],
+          u_ilc=self.controls[i],
+          angvel_des=fb_angvels_des[i],
+          angaccel_des=fb_angaccels_des[i],
+        )
+
+      def get_batch(self, X):
         ilc_controls = self.controls[self.index]
         if args.feedback:
-          kwargs = dict(
-            x=x,
-            dt=sim_dt,
-            pos_des=self.poss_des[self.index],
-            vel_des=self.vels_des[self.index],
-            acc_des=self.accs_des[self.index],
-            jerk_des=self.jerks_des[self.index],
-            snap_des=self.snaps_des[self.index],
-            u_ilc=ilc_controls,
-            angvel_des=self.angvels_des[self.index],
-            angaccel_des=self.angaccels_des[self.index],
-          )
-
-          if self.compute_feedback_response:
-            feedback = ilc.feedback(integrate=False, **kwargs)
-
-            if args.system in ['3ddediv', '3ddeditd']:
-              if args.system == '3ddediv':
-                feedback[0] = ilc.v1
-              else:
-                feedback[0] = ilc.int_udot
-
-              init_snap = ilc.snap
-              init_acc = ilc.acc
-              init_z = ilc.z
-
-            # Hack TODO XXX To deal with systems where the ILC corrections
-            # are not equal to true system control inputs.
-            if hasattr(ilc, 'n_control_sys'):
-              response = np.zeros((ilc.n_control_sys, ilc.n_state))
-            else:
-              response = np.zeros((ilc.n_control, ilc.n_state))
-
-            try_eps = 1e-6
-            for i in range(len(x)):
-              x_try = x.copy()
-              x_try[i] += try_eps
-
-              kwargs['x'] = x_try
-              feedback_try = ilc.feedback(integrate=False, **kwargs)
-
-              #if i == 6:
-              #  print(ilc.snap, ilc.z)
-              #  print((ilc.snap - init_snap) / try_eps)
-              #  #print((ilc.acc - init_acc) / try_eps)
-              #  #print((ilc.z - init_z) / try_eps)
-
-              if args.system in ['3ddediv', '3ddedis']:
-                feedback_try[0] = ilc.v1
-              if args.system == '3ddeditd':
-                feedback_try[0] = ilc.int_udot
-
-              deriv = (feedback_try - feedback) / try_eps
-
-              response[:, i] = deriv
-
-            if args.system == '3ddediv':
-              kwargs['x'] = x
-              orig_u, orig_udot = ilc.int_u, ilc.int_udot
-              ilc.int_u = orig_u + try_eps
-
-              feedback_try = ilc.feedback(integrate=False, **kwargs)
-              feedback_try[0] = ilc.v1
-
-              deriv = (feedback_try - feedback) / try_eps
-              response[:, 12] = deriv
-
-              ilc.int_u = orig_u
-              ilc.int_udot = orig_udot + try_eps
-
-              feedback_try = ilc.feedback(integrate=False, **kwargs)
-              feedback_try[0] = ilc.v1
-
-              deriv = (feedback_try - feedback) / try_eps
-              response[:, 13] = deriv
-
-              ilc.int_u = orig_u
-              ilc.int_udot = orig_udot
-
-            #if args.system == '3ddeditd':
-            #  kwargs['x'] = x
-            #  orig_u, orig_c = ilc.int_u, ilc.int_c
-            #  ilc.int_u = orig_u + try_eps
-
-            #  feedback_try = ilc.feedback(**kwargs, integrate=False)
-            #  feedback_try[0] = ilc.int_udot
-
-            #  deriv = (feedback_try - feedback) / try_eps
-            #  response[:, 12] = deriv
-
-            #  ilc.int_u = orig_u
-            #  ilc.int_c = orig_c + try_eps
-
-            #  feedback_try = ilc.feedback(**kwargs, integrate=False)
-            #  feedback_try[0] = ilc.int_udot
-
-            #  deriv = (feedback_try - feedback) / try_eps
-            #  response[:, 13] = deriv
-
-            #  ilc.int_u = orig_u
-            #  ilc.int_c = orig_c
-
-            self.feedback_responses.append(response)
-            ilc.pos_des = self.poss_des[self.index]
-            ilc.vel_des = self.vels_des[self.index]
-            ilc.acc_des = self.accs_des[self.index]
-            ilc.jerk_des = self.jerks_des[self.index]
-            ilc.snap_des = self.snaps_des[self.index]
-            if hasattr(ilc, "get_feedback_response"):
-              self.feedback_responses_ana.append(ilc.get_feedback_response(x, ilc_controls, sim_dt)[0])
-
-          kwargs['x'] = x
-          #x[6] += np.random.normal(scale=0.0005)
-          #if self.compute_feedback_response and args.poke:
-            #if 100 < self.index < 150:
-          #    kwargs['x'][6] += 0.1 * np.random.normal()
+          kwargs = self.step_kwargs(self.index)
 
-          feedback = ilc.feedback(**kwargs)
+          if getattr(ilc, 'feedback_batch', None) is not None:
+            controls = ilc.feedback_batch(X, **kwargs)
+          else:
+            controls = np.array([rollout_ilc.feedback(x=x, **kwargs) for rollout_ilc, x in zip(self.rollout_ilcs, X)])
 
-          # Really this should only run on the last iteration.
-          # A "poke" like disturbance.
-          if self.poke:
-            if poke_center - poke_steps / 2 < self.index < poke_center + poke_steps / 2:
-              feedback[1] += args.poke_strength
+        else:
+          controls = np.tile(ilc_controls, (len(X), 1))
 
-          self.index += 1
-          self.final_controls.append(feedback.copy())
-          return feedback
+        self.index += 1
+        return controls
 
+      def get_open_loop(self, x):
+        ilc_controls = self.controls[self.index]
+        self.record_control(ilc_controls)
         self.index += 1
-        self.final_controls.append(ilc_controls.copy())
         return ilc_controls
 
+      def get_feedback(self, x):
+        i = self.index
+        start = time.perf_counter()
+        feedback = ilc.feedback(x=x, dt=sim_dt, pos_des=poss_des_vec[i], vel_des=vels_des_vec[i],
+                                acc_des=fb_accs_des[i], jerk_des=fb_jerks_des[i], snap_des=fb_snaps_des[i],
+                                u_ilc=self.controls[i], angvel_des=fb_angvels_des[i], angaccel_des=fb_angaccels_des[i])
+        self.feedback_times[i] = time.perf_counter() - start
+
+        self.record_control(feedback)
+        self.index = i + 1
+        return feedback
+
+      def get_poked(self, x):
+        """ get_feedback with a "poke" like disturbance of the roll acceleration """
+        feedback = ilc.feedback(x=x, **self.step_kwargs(self.index))
+
+        if poke_center - poke_steps / 2 < self.index < poke_center + poke_steps / 2:
+          feedback[1] += args.poke_strength
+
+        self.record_control(feedback)
+        self.index += 1
+        return feedback
+
+      def record_control(self, control):
+        if self.final_controls is None:
+          self.final_controls = np.zeros((len(self.controls), len(control)))
+
+        self.final_controls[self.index] = control
+
     trial_poss = []
     trial_vels = []
     trial_accels = []
@@ -461,52 +554,262 @@ class ILCExperiment(object):
 
     trial_controls = []
     trial_control_corrections = []
+    trial_events = []
+    trial_ilc_ts = []
+    update_times = []
 
     cached_pinv = None
+    learning_op = None
+
+    # (trial index, time, reason) of the trial that diverged, which ends the experiment.
+    self.diverged = None
+    # Mean and max. position error norm of every trial run.
+    self.avg_pos_errors = []
+    self.max_pos_errors = []
+
+    rollout_cache = None
+    if args.cache_dir is not None:
+      rollout_cache = RolloutCache(args.cache_dir, int(args.cache_size * 1e6))
+      rollout_config = { name : value for name, value in vars(args).items() if name not in rollout_independent_args }
+
+    # Caching and ILC grids placed by the trial's errors need the full states
+    # of stream mode trials (so does checking the feedback response, along
+    # the last one). Otherwise only the states the next update relinearizes
+    # about are kept, resampled to its ILC grid.
+    record_states = rollout_cache is not None or (args.relin_iter and args.ilc_grid == 'error')
+
+    def get_rollout_key(poke):
+      # The controller state of some models carries over from the previous trial.
+      return rollout_cache.key(rollout_config, poke, ilc.get_controller_state(), poss_des_vec, vels_des_vec, fb_accs_des, fb_jerks_des, fb_snaps_des, ts_ilc, lifted_control)
+
+    def get_rollout_entry(states, n, trial_controller, diverged):
+      """ A simulated trial as arrays, see load_rollout """
+      entry = dict(
+        states=states,
+        n=n,
+        controls=trial_controller.final_controls,
+        events=json.dumps(ilc.events.snapshot()),
+        diverged=json.dumps(diverged),
+      )
+      if getattr(ilc, 'zs', None) is not None:
+        entry['zs'] = ilc.zs[:]
+        entry['controller_state'] = ilc.get_controller_state()
+
+      return entry
+
+    def store_rollout(key, states, n, diverged):
+      rollout_cache.put(key, **get_rollout_entry(states, n, controller, diverged))
+
+    def load_rollout(entry):
+      """ Restores a cached trial into the controller and the model (events, controller
+          state and its log) and returns its Trajectory and (time, reason) of its divergence """
+      traj = ilc.new_trajectory(N)
+      traj.data[:] = entry['states']
+      traj.n = int(entry['n'])
+
+      controller.final_controls = entry['controls']
+      ilc.events.load(json.loads(str(entry['events'])))
+      if 'zs' in entry:
+        ilc.zs.load(entry['zs'])
+        ilc.set_controller_state(entry['controller_state'])
+
+      diverged = json.loads(str(entry['diverged']))
+      return traj, diverged and tuple(diverged)
+
+    def get_operator_key(output_inds):
+      return content_key('constant operators', { name : getattr(args, name) for name in constant_operator_args }, ts_ilc, output_inds)
+
+    def get_learning_operator(states, controls, output_inds=None):
+      """ get_cached_learning_operator, through shared_operators for constant_ilc_mats models """
+      if not ilc.constant_ilc_mats or shared_operators is None:
+        return get_cached_learning_operator(states, controls, output_inds)
+
+      key = get_operator_key(output_inds)
+      entry = shared_operators.get(key)
+      if entry is not None and 'calCBpD' in entry:
+        ilc.saved_ilc = entry['calCBpD'], None
+        return ilc.saved_ilc
+
+      calCBpD, G = get_cached_learning_operator(states, controls, output_inds)
+      shared_operators.put(key, calCBpD=calCBpD)
+      return calCBpD, G
+
+    def get_cached_learning_operator(states, controls, output_inds=None):
+      """ ilc.get_learning_operator, through the rollout cache with --cache-linearization """
+      args_ilc = (ilc_dts, states, controls, poss_des_interp, vels_des_interp, accels_des_interp, jerks_des_interp, snaps_des_interp)
+      if rollout_cache is None or not args.cache_linearization:
+        return ilc.get_learning_operator(*args_ilc, output_inds=output_inds)
+
+      zs = getattr(ilc, 'zs', None)
+      key = rollout_cache.key('learning operator', rollout_config, output_inds, zs[:] if zs is not None else None, *[np.array(arg, dtype=float) for arg in args_ilc])
+      entry = rollout_cache.get(key)
+      if entry is not None:
+        op = entry['calCBpD'], entry.get('G')
+        if ilc.constant_ilc_mats:
+          ilc.saved_ilc = op
+        # Linearizing can leave the controller state changed.
+        if 'controller_state' in entry:
+          ilc.set_controller_state(entry['controller_state'])
+        return op
+
+      calCBpD, G = ilc.get_learning_operator(*args_ilc, output_inds=output_inds)
+
+      entry = dict(calCBpD=calCBpD)
+      if G is not None:
+        entry['G'] = G
+      if ilc.get_controller_state() is not None:
+        entry['controller_state'] = ilc.get_controller_state()
+
+      rollout_cache.put(key, **entry)
+      return calCBpD, G
+
+    def new_monitor():
+      if args.abort_pos_error is not None or args.abort_saturation_steps is not None or args.abort_nan:
+        return DivergenceMonitor(poss_des_vec, ilc.state_columns['pos'], ilc.events, args.abort_pos_error, args.abort_saturation_steps, args.abort_nan)
+
+      return None
+
+    def rollout_candidate(candidate_control, poke):
+      """ Simulates a trial with the ILC controls candidate_control. Returns
+          it as a load_rollout entry and its avg. pos error (inf if it diverged). """
+      candidate = Controller(candidate_control, poke=poke)
+      ilc.reset()
+
+      candidate_monitor = new_monitor()
+      traj = ilc.simulate(t_end, candidate.get, dt=sim_dt, monitor=candidate_monitor)
+
+      diverged = None
+      error = np.inf
+      if traj.diverged is not None:
+        diverged = (candidate_monitor.time, candidate_monitor.reason)
+      else:
+        error = np.mean(np.linalg.norm(traj.pos - poss_des_vec, axis=1))
+
+      return get_rollout_entry(traj.data, traj.n, candidate, diverged), error
+
+    def speculative_rollouts(candidate_controls, poke):
+      """ rollout_candidate of every candidate, on forked worker processes
+          (which start from the current model and controller state) """
+      global speculative_rollout
+
+      if 'fork' not in multiprocessing.get_all_start_methods() or multiprocessing.current_process().daemon:
+        controller_state = ilc.get_controller_state()
+        rollouts = []
+        for candidate_control in candidate_controls:
+          rollouts.append(rollout_candidate(candidate_control, poke))
+          ilc.events.reset()
+          if controller_state is not None:
+            ilc.set_controller_state(controller_state)
+
+        return rollouts
+
+      speculative_rollout = lambda k: rollout_candidate(candidate_controls[k], poke)
+      with multiprocessing.get_context('fork').Pool(args.speculative_workers or len(candidate_controls)) as pool:
+        return pool.map(run_speculative_rollout, range(len(candidate_controls)))
+
+    # Rollout of the chosen candidate step size, which is the next trial.
+    speculative = None
 
     for iter_no in range(args.trials):
-      controller = Controller(lifted_control, poss_des_vec, vels_des_vec, accels_des_vec, jerks_des_vec, snaps_des_vec)
-      controller.compute_feedback_response = iter_no == args.trials - 1 and args.feedback and (compute_fb_resp)# or args.save)
-      controller.poke = iter_no == args.trials - 1 and args.poke
+      last_trial = iter_no == args.trials - 1
+      controller = Controller(lifted_control, poke=last_trial and args.poke)
       ilc.reset()
-      data = ilc.simulate(t_end, controller.get, dt=sim_dt)
-
-      if '3d' in args.system:
-        poss_vec = data[:, :3]
-        vels = data[:, 3:6]
-        trial_vels.append(vels)
-        accels_vec = np.diff(vels, axis=0) / sim_dt
-        accels_vec = np.vstack((accels_vec, np.zeros(3)))
-        trial_rpys.append(data[:, 6:9])
-        trial_omegas.append(data[:, 9:12])
-
-      elif '2d' in args.system:
-        poss_vec = data[:, :2]
-        vels = data[:, 2:4]
-        trial_vels.append(vels)
-        accels_vec = np.diff(vels, axis=0) / sim_dt
-        accels_vec = np.vstack((accels_vec, np.zeros(2)))
-        trial_rpys.append(data[:, 4:5])
-        trial_omegas.append(data[:, 5:6])
-
-      elif args.system in ['linear', 'linearpos', 'nl1d']:
-        poss_vec = data[:, 0:1]
-        vels = data[:, 1:2]
-        trial_vels.append(vels)
-        accels_vec = np.diff(vels, axis=0) / sim_dt
-        accels_vec = np.vstack((accels_vec, 0))
-        trial_rpys.append(data[:, 2:3])
-        trial_omegas.append(data[:, 3:4])
-
-      elif args.system == 'simple':
-        poss_vec = data[:, 0:1]
-        accels_vec = np.diff(data[:, 1:2], axis=0) / sim_dt
-        accels_vec = np.vstack((accels_vec, 0))
-
-      elif args.system == 'trivial':
-        poss_vec = data[:, 0:1]
-        accels_vec = np.diff(data[:, 0:1], axis=0) / sim_dt
-        accels_vec = np.vstack((accels_vec, 0))
+      sim_start = time.perf_counter()
+      evals_start = ilc.integrator.n_evals
+
+      monitor = new_monitor()
+
+      # (time, reason) if the trial diverged
+      diverged = None
+
+      # Stream mode Resampler of the states at the next ILC grid
+      state_resampler = None
+
+      cached = None
+      if speculative is not None:
+        cached, speculative = speculative, None
+        cached_from = "the speculative rollout"
+      elif rollout_cache is not None:
+        rollout_key = get_rollout_key(last_trial and args.poke)
+        cached = rollout_cache.get(rollout_key)
+        cached_from = "the rollout cache"
+
+      if cached is not None:
+        traj, diverged = load_rollout(cached)
+
+        n_valid = traj.n
+        poss_vec = traj.pos
+        vels = traj.vel if traj.vel is not None else traj.pos
+        states_vec = traj.data
+
+        if traj.rpy is not None and not args.stream:
+          trial_vels.append(traj.vel)
+          trial_rpys.append(traj.rpy)
+          trial_omegas.append(traj.omega)
+
+      elif args.stream:
+        # Systems without a velocity state (trivial) control the velocity.
+        columns = ilc.state_columns
+        pos_recorder = ColumnRecorder(N, columns['pos'])
+        vel_recorder = ColumnRecorder(N, columns.get('vel', columns['pos']))
+        error_stats = RunningErrorStats(poss_des_vec, columns['pos'])
+        sinks = [pos_recorder, vel_recorder, error_stats]
+
+        if record_states or (last_trial and compute_fb_resp):
+          state_recorder = ColumnRecorder(N, slice(None))
+          sinks.append(state_recorder)
+        elif args.relin_iter and not last_trial:
+          # The grid the update after this trial uses (see the rebuild below).
+          state_resampler = Resampler(ts, make_ts_ilc(int(round(t_end / ilc_dt_schedule(iter_no)))))
+          sinks.append(state_resampler)
+
+        if args.stream_file is not None:
+          sinks.append(Decimator(BinaryAppender("%s-%d.bin" % (args.stream_file, iter_no)), args.stream_decimate))
+
+        records = ilc.simulate_stream(t_end, controller.get, dt=sim_dt)
+        if monitor is not None:
+          records = monitor.watch(records)
+
+        run_stream(stream_chunks(records, args.stream_chunk), sinks)
+
+        n_valid = pos_recorder.n
+        if n_valid == 0:
+          # Diverged at the first record, before any chunk reached the sinks.
+          traj = ilc.new_trajectory(N)
+          traj.data[:] = np.nan
+          poss_vec = traj.pos
+          vels = traj.vel if traj.vel is not None else traj.pos
+          states_vec = traj.data
+        else:
+          poss_vec = pos_recorder.data
+          vels = vel_recorder.data
+          if record_states or (last_trial and compute_fb_resp):
+            states_vec = state_recorder.data
+
+      else:
+        traj = ilc.simulate(t_end, controller.get, dt=sim_dt, monitor=monitor)
+
+        n_valid = traj.n
+        poss_vec = traj.pos
+        vels = traj.vel if traj.vel is not None else traj.pos
+        states_vec = traj.data
+
+        if traj.rpy is not None:
+          trial_vels.append(traj.vel)
+          trial_rpys.append(traj.rpy)
+          trial_omegas.append(traj.omega)
+
+      sim_time = time.perf_counter() - sim_start
+      sim_evals = ilc.integrator.n_evals - evals_start
+
+      if monitor is not None and monitor.reason is not None and cached is None:
+        diverged = (monitor.time, monitor.reason)
+
+      if rollout_cache is not None and cached is None:
+        store_rollout(rollout_key, states_vec, n_valid, diverged)
+
+      accels_vec = np.diff(vels, axis=0) / sim_dt
+      accels_vec = np.vstack((accels_vec, np.zeros(vels.shape[1])))
 
       pos_errors = poss_vec - poss_des_vec
       poserr_norms = np.linalg.norm(pos_errors, axis=1)
@@ -514,18 +817,51 @@ class ILCExperiment(object):
       accel_errors = accels_vec - accels_des_vec
       abs_accel_errors = np.abs(accel_errors)
 
+      if n_valid == 0:
+        # Diverged at the first record: there are no errors to average.
+        avg_poserr = max_poserr = np.inf
+        avg_abs_pos_errors = max_abs_pos_errors = np.full(DIMS, np.inf)
+      elif args.stream and cached is None:
+        avg_poserr, max_poserr = error_stats.mean_norm, error_stats.max_norm
+        avg_abs_pos_errors, max_abs_pos_errors = error_stats.mean_abs, error_stats.max_abs
+      else:
+        avg_poserr, max_poserr = np.mean(poserr_norms[:n_valid]), np.max(poserr_norms[:n_valid])
+        avg_abs_pos_errors, max_abs_pos_errors = np.mean(abs_pos_errors[:n_valid], axis=0), np.max(abs_pos_errors[:n_valid], axis=0)
+
+      self.avg_pos_errors.append(avg_poserr)
+      self.max_pos_errors.append(max_poserr)
+
+      if diverged is not None:
+        self.diverged = (iter_no,) + diverged
+
       if not args.no_stdout:
         title_s = "Iteration %d" % (iter_no + 1)
         print("============")
         print(title_s)
         print("============")
-        print("Avg. pos error:", np.mean(poserr_norms))
-        print("Avg. Y   error:", np.mean(abs_pos_errors[:, AXIS]))
+        print("Avg. pos error:", avg_poserr)
+        print("Avg. Y   error:", avg_abs_pos_errors[AXIS])
         if DIMS > 1:
-          print("Avg. Z   error:", np.mean(abs_pos_errors[:, AXIS + 1]))
+          print("Avg. Z   error:", avg_abs_pos_errors[AXIS + 1])
           if args.step:
-            print("Max. Z   error:", np.max(abs_pos_errors[:, AXIS + 1]))
-        print("Max. pos error:", np.max(poserr_norms))
+            print("Max. Z   error:", max_abs_pos_errors[AXIS + 1])
+        print("Max. pos error:", max_poserr)
+        if self.diverged is not None:
+          print("Diverged at t = %f: %s (stopping)" % self.diverged[1:])
+        if cached is not None:
+          print("Loaded from", cached_from)
+        else:
+          print("Sim steps per second:", max(n_valid - 1, 0) / sim_time)
+        if controller.get == controller.get_feedback and cached is None and n_valid > 1:
+          fb_times = 1e6 * controller.feedback_times[:n_valid - 1]
+          half = len(fb_times) // 2
+          print("Feedback time per step: %.1f us (first half %.1f us, second half %.1f us)" % (np.mean(fb_times), np.mean(fb_times[:half]), np.mean(fb_times[half:])))
+        if ilc.events.counts:
+          print("Events:", ilc.events.summary())
+        if args.integrator != 'euler' and cached is None:
+          print("Dynamics evaluations:", sim_evals)
+        if args.p2p_times is not None:
+          print("Max. P2P error:", np.max(poserr_norms[get_output_inds(ts, args.p2p_times) + 1]))
         #print("Avg. acc error:", np.mean(abs_accel_errors))
         #print("Max. acc error:", np.max(abs_accel_errors))
 
@@ -533,13 +869,45 @@ class ILCExperiment(object):
       trial_accels.append(accels_vec)
 
       trial_controls.append(np.array(controller.final_controls))
+      trial_events.append(ilc.events.snapshot())
+      ilc.events.reset()
       trial_control_corrections.append(lifted_control.copy())
+      trial_ilc_ts.append(ts_ilc)
 
-      if iter_no >= args.trials - 1:
+      if iter_no >= args.trials - 1 or self.diverged is not None:
         break
 
-      if args.relin_iter:
-        data_interp = interp1d(ts, data, axis=0)(ts_ilc)
+      update_start = time.perf_counter()
+
+      if ilc_dt_schedule(iter_no) != ilc_dt or args.ilc_grid == 'error':
+        # Rebuild the ILC grid, carrying over the corrections learned so far.
+        ilc_dt = ilc_dt_schedule(iter_no)
+        old_ts_ilc = ts_ilc
+
+        N_ilc = int(round(t_end / ilc_dt))
+        ts_ilc = make_ts_ilc(N_ilc, pos_errors)
+        ilc_dts = get_ilc_dts(ts_ilc, args.ilc_grid == 'uniform')
+
+        control_interp = get_interp_weights(ts_ilc[:-1], ts[:-1])
+
+        lifted_control = prolong_controls(lifted_control, old_ts_ilc, ts_ilc)
+        cum_updates = prolong_controls(cum_updates, old_ts_ilc, ts_ilc)
+        initial_lifted_control = prolong_controls(initial_lifted_control, old_ts_ilc, ts_ilc)
+
+        poss_des_interp, vels_des_interp, accels_des_interp, jerks_des_interp, snaps_des_interp = desired_on_grid(ts_ilc)
+
+        cached_pinv = None
+        learning_op = None
+        ilc.saved_ilc = None
+
+        if not args.no_stdout and len(ts_ilc) != len(old_ts_ilc):
+          print("No. of ILC steps is now", N_ilc)
+
+      if args.relin_iter and state_resampler is not None:
+        assert np.array_equal(state_resampler.new_ts, ts_ilc)
+        data_interp = state_resampler.data
+      elif args.relin_iter:
+        data_interp = interp1d(ts, states_vec, axis=0)(ts_ilc)
       else:
         ff_states_interp = interp1d(ts, fs_states, axis=0)(ts_ilc)
 
@@ -571,7 +939,7 @@ class ILCExperiment(object):
 
       pos_errors_interp = interp1d(ts, pos_errors, axis=0)(ts_ilc)
 
-      if N_ilc == N:
+      if N_ilc == N and args.ilc_grid == 'uniform':
         assert(np.allclose(pos_errors, pos_errors_interp))
 
       lifted_output_error = np.zeros((ilc.n_out * N_ilc))
@@ -581,6 +949,12 @@ class ILCExperiment(object):
         else:
           lifted_output_error[ilc.n_out * i : ilc.n_out * (i + 1)] = accel_errors[i + 1]
 
+      if args.p2p_times is not None:
+        output_inds = get_output_inds(ts_ilc, args.p2p_times)
+        lifted_output_error = lifted_output_error.reshape((N_ilc, ilc.n_out))[output_inds].ravel()
+      else:
+        output_inds = None
+
       #err_xs = np.linspace(0, 1, N_ilc)
       #err_xs = np.ones(N_ilc)
       #err_xs[:N_ilc//4] = 0
@@ -612,20 +986,53 @@ class ILCExperiment(object):
 
       y = np.hstack((lifted_output_error, np.zeros(N_ilc * ilc.n_control)))
 
-      if not ilc.constant_ilc_mats or cached_pinv is None:
+      if ilc.constant_ilc_mats and shared_operators is not None and cached_pinv is None:
+        entry = shared_operators.get(get_operator_key(output_inds))
+        if entry is not None:
+          cached_pinv = entry.get('pinv')
+
+      if args.update_law == 'gradient':
+        if not ilc.constant_ilc_mats or learning_op is None:
+          As, Bs, Cs, _ = ilc.get_linearization(ilc_dts, states, controls, poss_des_interp, vels_des_interp, accels_des_interp, jerks_des_interp, snaps_des_interp)
+          learning_op = lifted_operator(As, Bs, Cs, output_inds)
+
+          # Any step below 2 / ||P||^2 decreases the linearized error.
+          gradient_step = 1.0 / operator_norm(learning_op) ** 2
+
+          if not args.no_stdout:
+            print("Gradient ILC step size:", gradient_step)
+
+        update = -gradient_step * learning_op.rmatvec(lifted_output_error)
+
+      elif output_inds is not None and args.solver == 'lstsq' and args.w > 0:
+        calCBpD, _ = get_learning_operator(states, controls, output_inds)
+
+        # Only needs a square solve the size of the constrained outputs.
+        update = dual_lstsq(calCBpD, lifted_output_error, args.w * np.tile(ilc.control_normalization, N_ilc))
+
+      elif args.solver == 'lsqr' or not ilc.constant_ilc_mats or cached_pinv is None:
         # ILC update
         # Fu = y => arg min (u)  || Fu - y ||
         # Want: arg min (u) || Fu - y || + alpha || u ||
         min_norm_mat = np.diag(np.tile(ilc.control_normalization, N_ilc))
-        calCBpD, G = ilc.get_learning_operator(ilc_dt, states, controls, poss_des_interp, vels_des_interp, accels_des_interp, jerks_des_interp, snaps_des_interp)
+        calCBpD, G = get_learning_operator(states, controls, output_inds)
 
         #if args.feedback:
         #  min_norm_mat = min_norm_mat.dot(G)
 
         F = np.vstack((calCBpD, args.w * min_norm_mat))
 
-        if ilc.constant_ilc_mats:
+        if args.solver == 'lsqr':
+          deadline = update_start + args.solve_deadline if args.solve_deadline > 0 else None
+          update, residual, converged, lsqr_iters = anytime_lsqr(F, -y, deadline=deadline)
+
+          if not args.no_stdout:
+            print("LSQR: %d iterations in %f s, residual %f, converged: %s" % (lsqr_iters, time.perf_counter() - update_start, residual, converged))
+
+        elif ilc.constant_ilc_mats:
           cached_pinv = np.linalg.pinv(F)
+          if shared_operators is not None:
+            shared_operators.put(get_operator_key(output_inds), pinv=cached_pinv)
           #print(cached_pinv[:20, :20])
           #print(np.count_nonzero(cached_pinv))
           #print(np.count_nonzero(cached_pinv))
@@ -652,17 +1059,34 @@ class ILCExperiment(object):
       if cached_pinv is not None:
         update = cached_pinv.dot(-y)
 
-      update *= args.alpha
+      alpha = args.alpha
+      if args.alpha_candidates is not None:
+        spec_start = time.perf_counter()
+        rollouts = speculative_rollouts([lifted_control + a * update for a in args.alpha_candidates], iter_no + 1 == args.trials - 1 and args.poke)
+        errors = [error for _, error in rollouts]
+
+        best = int(np.argmin(errors))
+        alpha = args.alpha_candidates[best]
+        speculative = rollouts[best][0]
+
+        if not args.no_stdout:
+          print("Step size candidates (%f s): %s, using %g" % (time.perf_counter() - spec_start, ', '.join("%g: %g" % (a, e) for a, e in zip(args.alpha_candidates, errors)), alpha))
+
+      update *= alpha
 
       lifted_control += update
       cum_updates += update
 
+      update_times.append(time.perf_counter() - update_start)
+      if not args.no_stdout:
+        print("Update time: %f s (%d ILC steps)" % (update_times[-1], N_ilc))
+
       if args.plot_updates:
         plt.figure()
         for i in range(ilc.n_control):
           plt.subplot(ilc.n_control, 1, i + 1)
           if not i: plt.title("ILC Control Updates")
-          plt.plot(ts[:-1], update[i::ilc.n_control])
+          plt.plot(ts_ilc[:-1], update[i::ilc.n_control])
           plt.ylabel('Control %d' % (i + 1))
           plt.xlabel("Time (s)")
 
@@ -670,12 +1094,40 @@ class ILCExperiment(object):
         for i in range(ilc.n_control):
           plt.subplot(ilc.n_control, 1, i + 1)
           if not i: plt.title("ILC Cumulative Control Updates")
-          plt.plot(ts[:-1], cum_updates[i::ilc.n_control])
+          plt.plot(ts_ilc[:-1], cum_updates[i::ilc.n_control])
           plt.ylabel('Control %d' % (i + 1))
           plt.xlabel("Time (s)")
 
         plt.show()
 
+    if not args.no_stdout and len(update_times):
+      print("Total update time: %f s" % sum(update_times))
+
+    if not args.no_stdout and rollout_cache is not None:
+      print("Rollout cache:", rollout_cache.summary())
+
+    if args.rollouts > 0:
+      M = args.rollouts
+      rollout_dists = { name : getattr(ilc, name) * np.random.uniform(1 - args.rollout_dist_spread, 1 + args.rollout_dist_spread, size=M) for name in ilc.batch_dist_names }
+
+      rollout_controller = Controller(lifted_control)
+      rollout_controller.start_batch(M)
+      ilc.reset()
+
+      rollout_start = time.perf_counter()
+      rollout_traj = ilc.simulate_batch(t_end, rollout_controller.get_batch, sim_dt, M, rollout_dists)
+      rollout_time = time.perf_counter() - rollout_start
+
+      rollout_errors = np.mean(np.linalg.norm(rollout_traj.pos - poss_des_vec, axis=2), axis=1)
+
+      if not args.no_stdout:
+        print("============")
+        print("%d rollouts" % M)
+        print("============")
+        print("Rollout steps per second:", M * N / rollout_time)
+        print("Avg. pos error (mean over rollouts):", np.mean(rollout_errors))
+        print("Avg. pos error (worst rollout):", np.max(rollout_errors))
+
     start_color = np.array((1, 0, 0, 0.5))
     end_color = np.array((0, 1, 0, 0.5))
 
@@ -718,9 +1170,7 @@ class ILCExperiment(object):
       #plt.savefig("ilc_%s.png" % title.lower())
 
     if args.save:
-      import json
       import os
-      import time
       timepath = time.strftime("%Y%m%d-%H%M%S")
       dir_leafname = args.save_dir_prefix + "-" + timepath
       dirname = os.path.join("data", dir_leafname)
@@ -734,13 +1184,17 @@ class ILCExperiment(object):
         suffix = "%02d.txt" % i
         np.savetxt(os.path.join(dirname, "pos" + suffix), trial_poss[i], delimiter=',')
 
-        if '3d' in args.system or '2d' in args.system:
+        if trial_rpys and ('3d' in args.system or '2d' in args.system):
           np.savetxt(os.path.join(dirname, "rpy" + suffix), trial_rpys[i], delimiter=',')
           np.savetxt(os.path.join(dirname, "angvel" + suffix), trial_omegas[i], delimiter=',')
 
         np.savetxt(os.path.join(dirname, "control-corrections" + suffix), trial_control_corrections[i], delimiter=',')
         np.savetxt(os.path.join(dirname, "controls" + suffix), trial_controls[i], delimiter=',')
 
+        with open(os.path.join(dirname, "events" + suffix), 'w') as f:
+          for name, (count, first, last) in sorted(trial_events[i].items()):
+            f.write("%s,%d,%f,%f\n" % (name, count, first, last))
+
       #if args.feedback:
       #  resp = np.array((controller.feedback_responses))
       #  for i in range(resp.shape[1]):
@@ -758,7 +1212,7 @@ class ILCExperiment(object):
       #plot_trials(trial_vels, vels_des_vec, "Velocity", "Vel. %s (m/s)")
       #plot_trials(trial_accels, accels_des_vec, "Acceleration", "Accel. %s (m/s^2)")
 
-      if '3d' in args.system or '2d' in args.system:
+      if trial_rpys and ('3d' in args.system or '2d' in args.system):
         #plot_trials(trial_omegas, None, "Angular Velocity", "$\omega$ %s (rad/s)")
         plot_trials(trial_rpys, None, "Angle", "$\\alpha$ %s (rad/s^2)")
 
@@ -781,7 +1235,7 @@ class ILCExperiment(object):
           if i == 0 or i == len(trial_control_corrections) - 1:
             plot_args['label'] = "Trial %d" % (i + 1)
 
-          plt.plot(ts_ilc[:-1], trial_data[j::ilc.n_control], color=line_color, linewidth=2, **plot_args)
+          plt.plot(trial_ilc_ts[i][:-1], trial_data[j::ilc.n_control], color=line_color, linewidth=2, **plot_args)
 
         plt.xlabel("Time (s)")
         plt.ylabel(title_s)
@@ -815,25 +1269,45 @@ class ILCExperiment(object):
         plt.title(title_s)
 
     if compute_fb_resp:
-      resp = np.array((controller.feedback_responses))
-      resp_ana = np.array((controller.feedback_responses_ana))
+      # Post hoc, along the final trajectory (up to a divergence).
+      n_steps = n_valid - 1
+      method = args.fb_resp_method
+      if method == 'complex' and not ilc.complex_step_feedback:
+        print("Complex step differentiation is not supported by %s, using central differences" % ilc_c.__name__)
+        method = 'central'
 
-      for i, tit in enumerate(ilc.state_labels):
-        for j, ctit in enumerate(ilc.control_labels):
+      check_start = time.perf_counter()
+      resp = feedback_jacobians(ilc, states_vec[:n_steps], controller.step_kwargs, args.fb_resp_eps, method)
 
-          if np.linalg.norm(resp[:, j, i]) < 1e-4 and (not len(resp_ana) or np.linalg.norm(resp_ana[:, j, i]) < 1e-6):
-            continue
+      resp_ana = []
+      if hasattr(ilc, "get_feedback_response"):
+        desired = (poss_des_vec, vels_des_vec, fb_accs_des, fb_jerks_des, fb_snaps_des)
+        resp_ana = analytic_responses(ilc, states_vec[:n_steps], controller.controls, sim_dt, desired)
 
-          if len(resp_ana):
-            if not np.allclose(resp_ana[:, j, i], resp[:, j, i]):
-              err = np.mean(np.abs(resp_ana[:, j, i] - resp[:, j, i]))
-              print("ERROR: FB resp for", ctit, "/", tit, "doesn't match! Avg. error is", err)
+      if not args.no_stdout:
+        print("Feedback response check (%s, %d steps) took %f s" % (dict(forward="forward differences", central="central differences", complex="complex step")[method], n_steps, time.perf_counter() - check_start))
+
+      if len(resp_ana):
+        # Fails e.g. for an analytic response in other coordinates than the ILC state.
+        assert resp.shape == resp_ana.shape, "Numerical FB resp has shape %s, but get_feedback_response of %s gives %s" % (resp.shape[1:], ilc_c.__name__, resp_ana.shape[1:])
+        mismatches = mismatch_report(resp, resp_ana)
+        if mismatches:
+          print("ERROR: FB resp doesn't match for %d entries:" % len(mismatches))
+          for j, i, max_err, mean_err, max_rel_err, worst in mismatches:
+            print("  d %s / d %s: max. error %g (t = %.3f), avg. error %g, max. rel. error %g" % (ilc.control_labels[j], ilc.state_labels[i], max_err, ts[worst], mean_err, max_rel_err))
+        elif not args.no_stdout:
+          print("FB resp matches the analytic response")
+
+      if args.plot_fb_resp:
+        for i, tit in enumerate(ilc.state_labels[:resp.shape[2]]):
+          for j, ctit in enumerate(ilc.control_labels[:resp.shape[1]]):
+            if np.linalg.norm(resp[:, j, i]) < 1e-4 and (not len(resp_ana) or np.linalg.norm(resp_ana[:, j, i]) < 1e-6):
+              continue
 
-          if args.plot_fb_resp:
             plt.figure()
-            plt.plot(ts[:-1], resp[:, j, i], label='d%d / d%d' % (j, i))
+            plt.plot(ts[:n_steps], resp[:, j, i], label='d%d / d%d' % (j, i))
             if len(resp_ana):
-              plt.plot(ts[:-1], resp_ana[:, j, i], label='d%d / d%d (ana)' % (j, i))
+              plt.plot(ts[:n_steps], resp_ana[:, j, i], label='d%d / d%d (ana)' % (j, i))
 
             plt.title("d %s / d %s" % (ctit, tit))
             plt.legend()
@@ -1,16 +1,40 @@
 import numpy as np
 
+from ilc_models.events import EventRecorder
+from ilc_models.integrators import get_integrator, zoh_discretize
+from ilc_models.trajectory import Trajectory
+
 g = 9.81
 g2 = np.array((0, g))
 g3 = np.array((0, 0, g))
 
+def row_dot(a, b):
+  """ Dot products of the rows of a and b """
+  return np.einsum('ij,ij->i', a, b)
+
 class ILCBase(object):
   control_normalization = 1
   constant_ilc_mats = False
   saved_ilc = None
 
+  # Disturbance parameters that can differ between rollouts of simulate_batch.
+  batch_dist_names = ()
+
+  # Columns of the simulated states (see Trajectory).
+  state_columns = {}
+
+  # Whether feedback_batch is analytic in the states (complex step differentiation, see fb_check).
+  complex_step_feedback = False
+
   def __init__(self, **kwargs):
     self.use_feedback = kwargs['feedback']
+    self.integrator_name = kwargs['integrator']
+    self.sim_substeps = kwargs['sim_substeps']
+    self.integrator = get_integrator(self.integrator_name, rtol=kwargs['integrator_tol'], atol=kwargs['integrator_tol'])
+    self.events = EventRecorder(kwargs['event_log_interval'])
+    self.discretization = kwargs['discretization']
+    self.init_pos_offset = kwargs['init_pos_offset']
+    self.init_vel_offset = kwargs['init_vel_offset']
     self.reset()
 
   def reset(self):
@@ -19,7 +43,195 @@ class ILCBase(object):
   def get_ilc_state(self, state, ind):
     return state
 
-  def get_learning_operator(self, dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap):
+  def get_controller_state(self):
+    """ The internal controller state as logged in zs (None without one) """
+    return None
+
+  def set_controller_state(self, z):
+    """ Restores the internal controller state z logged in zs """
+    pass
+
+  def fb_resp_output(self, control):
+    """ The outputs of feedback (right after the call) whose response get_feedback_response gives """
+    return control
+
+  def get_batch_dists(self, M, dists=None):
+    """ Returns the disturbance parameters of M rollouts as (M,) arrays.
+        Parameters missing from dists use the model's own value. """
+    if dists is None:
+      dists = {}
+
+    return { name : np.broadcast_to(np.asarray(dists.get(name, getattr(self, name)), dtype=float), (M,)) for name in self.batch_dist_names }
+
+  def initial_state(self):
+    """ The simulated state at t = 0: at rest at the start of the reference,
+        offset by init_pos_offset and init_vel_offset (per axis, or one
+        value for all axes) where the model has those columns. """
+    x = np.zeros(getattr(self, 'n_sim_state', self.n_state))
+    for name, offset in (('pos', self.init_pos_offset), ('vel', self.init_vel_offset)):
+      if offset is not None and name in self.state_columns:
+        x[self.state_columns[name]] = offset
+
+    return x
+
+  def new_trajectory(self, N, batch_shape=()):
+    return Trajectory(N, getattr(self, 'n_sim_state', self.n_state), self.state_columns, batch_shape)
+
+  def simulate(self, t_end, fun, dt, monitor=None):
+    """ Records simulate_stream into a Trajectory, stopping early
+        if the DivergenceMonitor monitor detects divergence. """
+    N = int(round(t_end / dt))
+    traj = self.new_trajectory(N)
+    xs = traj.data
+
+    records = self.simulate_stream(t_end, fun, dt)
+    if monitor is not None:
+      records = monitor.watch(records)
+
+    traj.n = 0
+    for t, x, u in records:
+      xs[traj.n] = x
+      traj.n += 1
+
+    if monitor is not None and monitor.reason is not None:
+      xs[traj.n:] = np.nan
+      traj.diverged = monitor.reason
+
+    return traj
+
+  def simulate_stream(self, t_end, fun, dt):
+    """ Integrates dynamics with the model's integrator, holding the
+        control from fun constant (zero-order hold) over every dt.
+        The physics takes sim_substeps steps per call of fun.
+
+        Yields a (t, x, u) record per call of fun and (t_end, x, None)
+        for the final state. x is only valid until the next record. """
+    dists = self.get_batch_dists(1)
+    self.integrator.reset()
+    sub_dt = dt / self.sim_substeps
+
+    N = int(round(t_end / dt))
+    x = self.initial_state()
+
+    for i in range(N):
+      self.events.clock = i * dt
+      u = fun(x)
+      yield i * dt, x, u
+
+      U = np.reshape(u, (1, -1))
+      self.record_control_events(i * dt, U)
+      X = x[np.newaxis]
+      for j in range(self.sim_substeps):
+        X = self.integrator.step(lambda X: self.dynamics(X, U, dists), X, sub_dt)
+
+      x = self.correct_step(x, X[0], dt)
+
+    yield N * dt, x, None
+
+  def correct_step(self, x, x_new, dt):
+    """ Lets subclasses adjust every integrator step of simulate from x to x_new """
+    return x_new
+
+  def record_control_events(self, t, U):
+    """ Records the events (see EventRecorder) of the (M, n_control) controls
+        U applied over the step at t, once per step whatever the integrator """
+    pass
+
+  def simulate_batch(self, t_end, fun, dt, M, dists=None):
+    """ Simulates M vehicles at once, stepping dynamics like simulate.
+        fun maps the (M, n_state) states to (M, n_control) controls.
+        Returns a Trajectory with (M, N + 1, n_state) data. """
+    dists = self.get_batch_dists(M, dists)
+    self.integrator.reset()
+    sub_dt = dt / self.sim_substeps
+
+    N = int(round(t_end / dt))
+    traj = self.new_trajectory(N, (M,))
+    Xs = traj.data
+    Xs[:, 0] = self.initial_state()
+
+    for i in range(N):
+      U = np.reshape(fun(Xs[:, i]), (M, -1))
+      self.record_control_events(i * dt, U)
+      X = Xs[:, i]
+      for j in range(self.sim_substeps):
+        X = self.integrator.step(lambda X: self.dynamics(X, U, dists), X, sub_dt)
+      Xs[:, i + 1] = X
+
+    return traj
+
+  def linearize_step(self, i, dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap):
+    """ Returns the ILC state and the (A, B, C, D) linearization at step i
+
+        dt is either the ILC time step or an array with the duration of
+        every step of a nonuniform ILC grid. """
+    N = len(states) - 1
+
+    if np.ndim(dt):
+      dt = dt[min(i, N - 1)]
+
+    self.step_dt = dt
+
+    state = states[i]
+
+    if i < N:
+      control_ind = i
+    else:
+      control_ind = i - 1
+
+    if not self.constant_ilc_mats:
+      state = self.get_ilc_state(state, control_ind)
+
+    control = controls[i]
+
+    self.pos_des = desired_pos[i]
+    self.vel_des = desired_vel[i]
+    self.acc_des = desired_acc[i]
+    self.jerk_des = desired_jerk[i]
+    self.snap_des = desired_snap[i]
+
+    self.iter = i
+    A, B, C, D = self.get_ABCD(state, control, dt)
+
+    # TODO: Use D
+    assert np.all(D == 0)
+
+    return state, A, B, C, D
+
+  def discretize(self, As, Bs):
+    """ The per step As and Bs of get_ABCD, which discretizes with explicit
+        Euler, or with discretization 'zoh' their exact zero-order hold
+        counterparts (see zoh_discretize) """
+    if self.discretization != 'zoh':
+      return As, Bs
+
+    As, Bs = zoh_discretize(np.array(As), np.array(Bs))
+    return list(As), list(Bs)
+
+  def get_linearization(self, dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap):
+    """ Returns the per step As, Bs, Cs and Ds without forming the lifted operator """
+    assert len(desired_pos) == len(desired_vel) == len(desired_acc) == len(desired_jerk) == len(desired_snap) == len(controls) == len(states)
+
+    As = []
+    Bs = []
+    Cs = []
+    Ds = []
+
+    for i in range(len(states)):
+      _, A, B, C, D = self.linearize_step(i, dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap)
+
+      As.append(A)
+      Bs.append(B)
+      Cs.append(C)
+      Ds.append(D)
+
+    As, Bs = self.discretize(As, Bs)
+    return As, Bs, Cs, Ds
+
+  def get_learning_operator(self, dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap, output_inds=None):
+    """ output_inds selects the ILC steps whose outputs are constrained
+        (point-to-point ILC). Only those rows of calCBpD are assembled
+        and G is not computed. """
     assert len(desired_pos) == len(desired_vel) == len(desired_acc) == len(desired_jerk) == len(desired_snap) == len(controls) == len(states)
 
     if self.constant_ilc_mats and self.saved_ilc is not None:
@@ -27,6 +239,23 @@ class ILCBase(object):
 
     N = len(states) - 1
 
+    if output_inds is not None:
+      As, Bs, Cs, _ = self.get_linearization(dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap)
+
+      calCBpD = np.zeros((len(output_inds) * self.n_out, N * self.n_control))
+      for k, row_ind in enumerate(output_inds):
+        # Walk back from the output: C_{r+1} A_r ... A_{j+1} B_j
+        CA = Cs[row_ind + 1]
+        for col_ind in range(row_ind, -1, -1):
+          calCBpD[self.n_out *       k : self.n_out * (k + 1),
+                  self.n_control * col_ind : self.n_control * (col_ind + 1)] = CA.dot(Bs[col_ind])
+          CA = CA.dot(As[col_ind])
+
+      if self.constant_ilc_mats:
+        self.saved_ilc = calCBpD, None
+
+      return calCBpD, None
+
     As = []
     Bs = []
     Cs = []
@@ -37,39 +266,19 @@ class ILCBase(object):
 
     # First we linearize the dynamics around the controls and resulting states.
     for i in range(N + 1):
-      state = states[i]
-
-      if i < N:
-        control_ind = i
-      else:
-        control_ind = i - 1
-
-      if not self.constant_ilc_mats:
-        state = self.get_ilc_state(state, control_ind)
-
-      control = controls[i]
-
-      self.pos_des = desired_pos[i]
-      self.vel_des = desired_vel[i]
-      self.acc_des = desired_acc[i]
-      self.jerk_des = desired_jerk[i]
-      self.snap_des = desired_snap[i]
-
-      self.iter = i
-      A, B, C, D = self.get_ABCD(state, control, dt)
+      state, A, B, C, D = self.linearize_step(i, dt, states, controls, desired_pos, desired_vel, desired_acc, desired_jerk, desired_snap)
 
       As.append(A)
       Bs.append(B)
       Cs.append(C)
       Ds.append(D)
 
-      K_x, K_u = self.get_feedback_response(state, control, dt)
+      K_x, K_u = self.get_feedback_response(state, controls[i], self.step_dt)
 
       K_xs.append(K_x)
       K_us.append(K_u)
 
-      # TODO: Use D
-      assert np.all(D == 0)
+    As, Bs = self.discretize(As, Bs)
 
     calCBpD = np.zeros((N * self.n_out, N * self.n_control))
     G = np.zeros((N * self.n_control, N * self.n_control))
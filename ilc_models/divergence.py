@@ -0,0 +1,55 @@
+import numpy as np
+
+class DivergenceMonitor(object):
+  """ Ends a simulate_stream early once the vehicle diverges, i.e. at the
+      first record whose state is not finite, whose position error norm
+      exceeds max_pos_error, or that follows max_saturation_steps steps in
+      a row with saturation or clipping events. The diverging record is
+      not passed on.
+
+      After watch returns, reason and time describe the divergence
+      (both None if there was none). """
+  saturation_events = ('angaccel_limit', 'accel_limit', 'negative_thrust', 'angvel_clip', 'vel_clip')
+
+  def __init__(self, poss_des, pos_cols, events, max_pos_error=None, max_saturation_steps=None, check_nan=True):
+    self.poss_des = poss_des
+    self.pos_cols = pos_cols
+    self.events = events
+    self.max_pos_error = max_pos_error
+    self.max_saturation_steps = max_saturation_steps
+    self.check_nan = check_nan
+
+    self.reason = None
+    self.time = None
+
+  def saturation_count(self):
+    return sum(self.events.counts.get(name, 0) for name in self.saturation_events)
+
+  def watch(self, records):
+    self.reason = None
+    self.time = None
+
+    streak = 0
+    last_count = self.saturation_count()
+
+    for i, (t, x, u) in enumerate(records):
+      if self.check_nan and not np.isfinite(x.sum()):
+        self.reason = "state is not finite"
+
+      elif self.max_pos_error is not None and np.linalg.norm(x[self.pos_cols] - self.poss_des[i]) > self.max_pos_error:
+        self.reason = "pos error above %f" % self.max_pos_error
+
+      elif self.max_saturation_steps is not None:
+        count = self.saturation_count()
+        streak = streak + 1 if count > last_count else 0
+        last_count = count
+
+        if streak >= self.max_saturation_steps:
+          self.reason = "saturated for %d steps" % streak
+
+      if self.reason is not None:
+        self.time = t
+        records.close()
+        return
+
+      yield t, x, u
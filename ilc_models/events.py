@@ -0,0 +1,59 @@
+messages = {
+  'low_acc_norm' : "acc norm too low!",
+  'angaccel_limit' : "Ang accel is very high! (%s; limit %f)",
+  'accel_limit' : "Accel is very high! (%f; limit %f)",
+  'negative_thrust' : "THRUST IS NEGATIVE",
+  'angvel_clip' : "Clipping vehicle ang. vel.",
+  'vel_clip' : "Clipping vehicle velocity",
+}
+
+class EventRecorder(object):
+  """ Counts simulation events (see messages) with the (simulated) time
+      of their first and last occurrence.
+
+      Code without its own notion of time (e.g. dynamics) records at
+      clock, which the simulators set every step.
+
+      With a log_interval, the message of an event is also printed, at
+      most once per log_interval seconds of simulated time per event.
+      The message arguments are only formatted when printed.
+  """
+  def __init__(self, log_interval=None):
+    self.log_interval = log_interval
+    self.reset()
+
+  def reset(self):
+    self.clock = 0.0
+    self.counts = {}
+    self.first = {}
+    self.last = {}
+    self.last_logged = {}
+
+  def record(self, name, t=None, *args):
+    if t is None:
+      t = self.clock
+
+    if name in self.counts:
+      self.counts[name] += 1
+    else:
+      self.counts[name] = 1
+      self.first[name] = t
+
+    self.last[name] = t
+
+    if self.log_interval is not None and (name not in self.last_logged or t - self.last_logged[name] >= self.log_interval):
+      self.last_logged[name] = t
+      print("WARNING (t = %.3f): %s" % (t, messages[name] % args))
+
+  def snapshot(self):
+    """ Returns { name : (count, first time, last time) } """
+    return { name : (count, self.first[name], self.last[name]) for name, count in self.counts.items() }
+
+  def load(self, snapshot):
+    """ Replaces the counts with those of a snapshot """
+    self.counts = { name : count for name, (count, first, last) in snapshot.items() }
+    self.first = { name : first for name, (count, first, last) in snapshot.items() }
+    self.last = { name : last for name, (count, first, last) in snapshot.items() }
+
+  def summary(self):
+    return ", ".join("%s x %d (t = %.3f .. %.3f)" % (name, count, self.first[name], self.last[name]) for name, count in sorted(self.counts.items()))
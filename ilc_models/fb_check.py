@@ -0,0 +1,125 @@
+import numpy as np
+
+def get_perturbations(n, eps, method):
+  """ The state offsets a Jacobian with n columns is differentiated from:
+      the unperturbed state and one offset per column (forward),
+      +- one offset per column (central) or one imaginary offset per
+      column (complex, a step of eps * 1j). """
+  if method == 'forward':
+    return np.vstack((np.zeros(n), eps * np.eye(n)))
+  if method == 'central':
+    return np.vstack((eps * np.eye(n), -eps * np.eye(n)))
+  if method == 'complex':
+    return 1j * eps * np.eye(n)
+
+  raise ValueError("Unknown differentiation method %s" % method)
+
+def get_jacobian(outputs, n, eps, method):
+  """ Jacobians (..., n_out, n) from the feedback outputs (..., n_perturbations,
+      n_out) of the perturbations of get_perturbations """
+  if method == 'forward':
+    jacobian = (outputs[..., 1:, :] - outputs[..., :1, :]) / eps
+  elif method == 'central':
+    jacobian = (outputs[..., :n, :] - outputs[..., n:, :]) / (2 * eps)
+  else:
+    jacobian = outputs.imag / eps
+
+  return np.swapaxes(jacobian, -1, -2)
+
+def feedback_outputs(ilc, X, Z, kwargs):
+  """ The outputs of ilc.feedback (see fb_resp_output) for the states X,
+      with the controller states Z (rows, None to leave them alone).
+      kwargs holds one row per state (scalars are shared). All of them
+      go in one feedback_batch or fb_resp_output_batch call when the
+      model has one, else feedback is called once per state. """
+  if Z is None and getattr(ilc, 'feedback_batch', None) is not None:
+    return ilc.feedback_batch(X, **kwargs)
+
+  if Z is not None and getattr(ilc, 'fb_resp_output_batch', None) is not None:
+    return ilc.fb_resp_output_batch(X, Z, **kwargs)
+
+  outputs = []
+  for k, x in enumerate(X):
+    if Z is not None:
+      ilc.set_controller_state(Z[k])
+
+    row_kwargs = { name : value[k] if np.ndim(value) else value for name, value in kwargs.items() }
+    outputs.append(ilc.fb_resp_output(ilc.feedback(x=x, integrate=False, **row_kwargs)))
+
+  return np.array(outputs)
+
+def feedback_jacobians(ilc, states, step_kwargs, eps=1e-6, method='central'):
+  """ Numerical feedback response (n_steps, n_out, n_ilc_state) along the
+      recorded states, i.e. the derivative of the feedback outputs with
+      respect to the ILC state (see get_ilc_state). step_kwargs(i) gives
+      the feedback arguments other than the state of step i. The
+      perturbations of all steps are evaluated together (feedback_outputs).
+
+      Runs after a trial: controllers with internal state (logged in zs)
+      use the state they had at every step. ILC states longer than the
+      simulated state perturb that controller state. """
+  states = np.asarray(states)
+  n_steps, n_x = states.shape
+  n = len(ilc.get_ilc_state(states[0], 0))
+
+  offsets = get_perturbations(n, eps, method)
+  n_pert = len(offsets)
+
+  X = (states[:, np.newaxis] + offsets[:, :n_x]).reshape((-1, n_x))
+
+  zs = getattr(ilc, 'zs', None)
+  Z = None
+  if zs is not None:
+    Z = np.repeat(np.asarray(zs[:n_steps], dtype=offsets.dtype), n_pert, axis=0)
+    if n > n_x:
+      Z += np.tile(offsets[:, n_x:], (n_steps, 1))
+
+  # Arrays and scalars that change between steps get a row per state.
+  steps = [step_kwargs(i) for i in range(n_steps)]
+  kwargs = {}
+  for name, value in steps[0].items():
+    values = [step[name] for step in steps]
+    if np.ndim(value) or any(v != value for v in values):
+      kwargs[name] = np.repeat(values, n_pert, axis=0)
+    else:
+      kwargs[name] = value
+
+  outputs = feedback_outputs(ilc, X, Z, kwargs)
+
+  if zs is not None:
+    ilc.set_controller_state(zs[n_steps - 1])
+
+  return get_jacobian(outputs.reshape((n_steps, n_pert, -1)), n, eps, method)
+
+def analytic_responses(ilc, states, controls, dt, desired):
+  """ get_feedback_response K_x (n_steps, n_out, n_ilc_state) along the recorded
+      states, with the desired (pos, vel, acc, jerk, snap) of every step """
+  zs = getattr(ilc, 'zs', None)
+
+  responses = []
+  for i, x in enumerate(states):
+    if zs is not None:
+      ilc.set_controller_state(zs[i])
+
+    ilc.pos_des, ilc.vel_des, ilc.acc_des, ilc.jerk_des, ilc.snap_des = [d[i] for d in desired]
+    responses.append(ilc.get_feedback_response(ilc.get_ilc_state(x, i), controls[i], dt)[0])
+
+  return np.array(responses)
+
+def mismatch_report(resp, resp_ana, rtol=1e-4, atol=1e-6):
+  """ Compares the numerical responses resp with the analytic ones entry by entry.
+      Returns (control index, state index, max. abs. error, mean abs. error,
+      max. relative error, step of the max. error) of every entry where
+      they differ by more than atol + rtol * |resp_ana|, worst first. """
+  errors = np.abs(resp - resp_ana)
+  bad = errors > atol + rtol * np.abs(resp_ana)
+
+  rows = []
+  for j, i in zip(*np.nonzero(bad.any(axis=0))):
+    entry_errors = errors[:, j, i]
+    rel_errors = entry_errors / np.maximum(np.abs(resp_ana[:, j, i]), atol)
+    worst = np.argmax(entry_errors)
+    rows.append((j, i, entry_errors[worst], np.mean(entry_errors), np.max(rel_errors), worst))
+
+  rows.sort(key=lambda row: -row[2])
+  return rows
@@ -0,0 +1,173 @@
+import numpy as np
+
+from scipy.linalg import expm
+
+class Euler:
+  """ Explicit Euler, the integrator the models have always used. """
+  def __init__(self, **kwargs):
+    self.n_evals = 0
+
+  def reset(self):
+    pass
+
+  def step(self, f, x, dt):
+    self.n_evals += 1
+    return x + dt * f(x)
+
+class RK4:
+  """ Classical 4th order Runge-Kutta. """
+  def __init__(self, **kwargs):
+    self.n_evals = 0
+
+  def reset(self):
+    pass
+
+  def step(self, f, x, dt):
+    k1 = f(x)
+    k2 = f(x + 0.5 * dt * k1)
+    k3 = f(x + 0.5 * dt * k2)
+    k4 = f(x + dt * k3)
+    self.n_evals += 4
+    return x + (dt / 6.0) * (k1 + 2 * k2 + 2 * k3 + k4)
+
+class DormandPrince:
+  """ Embedded Runge-Kutta 5(4) (Dormand and Prince 1980) with error control.
+
+      Each call to step integrates over the full dt, taking as many
+      substeps as needed to keep the local error estimate within
+      atol + rtol * |x|. The substep size is carried over between calls
+      until reset, the start of every simulation.
+  """
+  a = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+    (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+  )
+  # 5th order weights are the last row of a (first same as last).
+  e = np.array((71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40))
+
+  def __init__(self, rtol=1e-6, atol=1e-6, **kwargs):
+    self.rtol = rtol
+    self.atol = atol
+    self.n_evals = 0
+    self.reset()
+
+  def reset(self):
+    self.h = None
+
+  def step(self, f, x, dt):
+    h = dt if self.h is None else self.h
+    t = 0.0
+
+    k1 = f(x)
+    self.n_evals += 1
+
+    while dt - t > 1e-12 * dt:
+      h_step = min(h, dt - t)
+
+      ks = [k1]
+      for i in range(1, 7):
+        x_stage = x + h_step * sum(a_ij * k for a_ij, k in zip(self.a[i], ks) if a_ij)
+        ks.append(f(x_stage))
+      self.n_evals += 6
+
+      # The last stage is evaluated at the 5th order solution.
+      x_new = x_stage
+      err = h_step * sum(e_i * k for e_i, k in zip(self.e, ks) if e_i)
+
+      scale = self.atol + self.rtol * np.maximum(np.abs(x), np.abs(x_new))
+      err_norm = np.sqrt(np.mean((err / scale) ** 2))
+
+      factor = min(5.0, max(0.2, 0.9 * (err_norm + 1e-16) ** -0.2))
+      if err_norm <= 1:
+        t += h_step
+        x = x_new
+        k1 = ks[-1]
+
+        # A step cut short to end at dt may only grow h, not shrink it.
+        h = max(h, h_step * factor) if h_step < h else h_step * factor
+      else:
+        h = h_step * factor
+
+    self.h = h
+    return x
+
+integrators = {
+  'euler' : Euler,
+  'rk4' : RK4,
+  'rk45' : DormandPrince,
+}
+
+def get_integrator(name, **kwargs):
+  return integrators[name](**kwargs)
+
+def chain_step_matrices(ks, dt, method):
+  """ Returns per axis (4, 4) matrices M that turn an explicit Euler step d
+      of the flat state (pos, vel, acc, jerk) of a chain of four integrators
+      under the linear feedback snap = -k1 e - k2 e' - k3 e'' - k4 e'''
+      into a step x + M d that treats that feedback implicitly.
+
+      'implicit' is the linearly implicit Euler step (I - dt A_cl)^-1 and
+      'exponential' the exponential Euler step phi1(dt A_cl). Both are
+      stable for any dt and tend to the identity as dt -> 0.
+
+      ks are the (n, n) diagonal gain matrices of each axis.
+  """
+  Ms = []
+  for axis in range(ks[0].shape[0]):
+    A_cl = np.diag(np.ones(3), 1)
+    A_cl[3] = [-k[axis, axis] for k in ks]
+
+    if method == 'implicit':
+      M = np.linalg.inv(np.eye(4) - dt * A_cl)
+    elif method == 'exponential':
+      # phi1(dt A_cl) = int_0^1 exp(s dt A_cl) ds
+      E = np.zeros((8, 8))
+      E[:4, :4] = dt * A_cl
+      E[:4, 4:] = np.eye(4)
+      M = expm(E)[:4, 4:]
+    else:
+      raise ValueError("Unknown stiff integrator %s" % method)
+
+    Ms.append(M)
+
+  return Ms
+
+def chain_feedback(ks, flat, flat_des, snap_des, out, scratch):
+  """ Writes the snap of the linear feedback of chain_step_matrices,
+      snap_des - sum_i ks[i] * (flat[i] - flat_des[i]) for the per axis
+      gain vectors ks and flat = (pos, vel, acc, jerk), to out.
+      Uses out and scratch as its only buffers. """
+  np.subtract(flat[0], flat_des[0], out=out)
+  out *= -ks[0]
+  for k, value, value_des in zip(ks[1:], flat[1:], flat_des[1:]):
+    np.subtract(value, value_des, out=scratch)
+    scratch *= k
+    out -= scratch
+
+  out += snap_des
+  return out
+
+def correct_chain_step(flat, flat_new, Ms):
+  """ Applies chain_step_matrices Ms to the explicit step from flat to
+      flat_new, both (4, n) arrays of (pos, vel, acc, jerk). """
+  delta = flat_new - flat
+  return flat + np.stack([M.dot(delta[:, axis]) for axis, M in enumerate(Ms)], axis=1)
+
+def zoh_discretize(As, Bs):
+  """ Turns the explicit Euler discretizations A = I + dt Ac, B = dt Bc
+      of continuous linear systems, stacked as (N, n, n) and (N, n, m),
+      into their exact zero-order hold discretizations
+        A = exp(dt Ac), B = int_0^dt exp(s Ac) ds Bc
+      read off exp([[dt Ac, dt Bc], [0, 0]]), all N in one expm call. """
+  n = As.shape[1]
+  E = np.zeros((len(As), n + Bs.shape[2], n + Bs.shape[2]))
+  E[:, :n, :n] = As - np.eye(n)
+  E[:, :n, n:] = Bs
+
+  M = expm(E)
+  return M[:, :n, :n], M[:, :n, n:]
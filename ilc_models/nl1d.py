@@ -11,6 +11,8 @@ class NL1D(ILCBase):
   n_control = 1
   n_out = 1
 
+  state_columns = dict(pos=slice(0, 1), vel=slice(1, 2), rpy=slice(2, 3), omega=slice(3, 4))
+
   c = 100
 
   def get_ABCD(self, state, control, dt):
@@ -25,24 +27,6 @@ class NL1D(ILCBase):
 
     return A, B, C, D
 
-  def simulate(self, t_end, fun, dt):
-    pos, vel, theta, jerk = x = np.zeros(4)
-
-    xs = [x.copy()]
-
-    for i in range(int(round(t_end / dt))):
-      u_out = fun(x)
-
-      snap = u_out[0]
-
-      acc = self.c * np.sin(theta / self.c)
-
-      pos += vel * dt
-      vel += acc * dt
-      theta += jerk * dt
-      jerk += snap * dt
-
-      x = np.hstack((pos.copy(), vel.copy(), theta.copy(), jerk.copy()))
-      xs.append(x)
-
-    return np.array(xs)
+  def dynamics(self, X, U, dists):
+    acc = self.c * np.sin(X[:, 2:3] / self.c)
+    return np.hstack((X[:, 1:2], acc, X[:, 3:4], U))
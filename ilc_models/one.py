@@ -11,6 +11,10 @@ class One(ILCBase):
   n_control = n_control_sys = 1
   n_out = 1
 
+  complex_step_feedback = True
+
+  state_columns = dict(pos=slice(0, 1), vel=slice(1, 2))
+
   k_pos = 40
   k_vel = 20
 
@@ -43,18 +47,15 @@ class One(ILCBase):
 
     return A, B, C, D
 
-  def simulate(self, t_end, fun, dt):
-    pos, vel = x = np.zeros(2)
-    xs = [x.copy()]
-    for i in range(int(round(t_end / dt))):
-      acc = fun(x)
-      pos += vel * dt
-      vel += acc * dt
-      x = np.hstack((pos, vel))
-      xs.append(x)
-    return np.array(xs)
+  def dynamics(self, X, U, dists):
+    return np.hstack((X[:, 1:2], U))
 
   def feedback(self, x, pos_des, vel_des, u_ilc, **kwargs):
     K_pos = np.array((self.k_pos, self.k_vel))
     pos_vel_des = np.hstack((pos_des, vel_des))
     return -K_pos.dot(x - pos_vel_des) + u_ilc
+
+  def feedback_batch(self, X, pos_des, vel_des, u_ilc, **kwargs):
+    K_pos = np.array((self.k_pos, self.k_vel))
+    pos_vel_des = np.hstack((pos_des, vel_des))
+    return -(X - pos_vel_des).dot(K_pos)[:, np.newaxis] + u_ilc
@@ -1,6 +1,6 @@
 import numpy as np
 
-from ilc_models.base import ILCBase, g, g2
+from ilc_models.base import ILCBase, g, g2, row_dot
 
 class Quad2D(ILCBase):
   """
@@ -11,6 +11,10 @@ class Quad2D(ILCBase):
   n_control = 2
   n_out = 2
 
+  n_sim_state = 6
+  state_columns = dict(pos=slice(0, 2), vel=slice(2, 4), rpy=slice(4, 5), omega=slice(5, 6))
+  batch_dist_names = ('thrust_dist', 'drag_dist')
+
   state_labels = [
     "Position X",
     "Position Z",
@@ -117,12 +121,23 @@ class Quad2D(ILCBase):
 
     return np.hstack((a_norm + u_ilc[0], u_ang_accel + u_ilc[1]))
 
+  def feedback_batch(self, X, pos_des, vel_des, acc_des, angvel_des, angaccel_des, u_ilc, **kwargs):
+    accel_des = -(X[:, :4] - np.hstack((pos_des, vel_des))).dot(self.K_pos.T) + acc_des + g2
+    a_norm = np.linalg.norm(accel_des, axis=1)
+    theta_des = np.arctan2(accel_des[:, 1], accel_des[:, 0]) - np.pi / 2
+
+    theta_err = X[:, 4] - theta_des
+    angvel_error = X[:, 5] - angvel_des
+    u_ang_accel = -self.K_att[0] * theta_err - self.K_att[1] * angvel_error + angaccel_des
+
+    return np.stack((a_norm + u_ilc[..., 0], u_ang_accel + u_ilc[..., 1]), axis=1)
+
   def feedforward(self, pos, vel, acc, jerk, snap):
     acc_vec = acc + g2
     u = np.linalg.norm(acc_vec)
 
     if u < 1e-3:
-      print("WARNING: acc norm too low!")
+      self.events.record('low_acc_norm')
 
     z_b      = (1.0 / u) * acc_vec
     z_b_dot  = (1.0 / u) * (jerk - z_b.dot(jerk) * z_b)
@@ -137,36 +152,37 @@ class Quad2D(ILCBase):
 
     return state, control
 
-  def simulate(self, t_end, fun, dt):
-    pos = np.zeros(2)
-    vel = np.zeros(2)
-    theta = 0
-    angvel = 0
-
-    x = np.zeros(6)
+  def feedforward_batch(self, pos, vel, acc, jerk, snap, ts):
+    """ feedforward for (N, 2) derivative arrays at the times ts """
+    acc_vec = acc + g2
+    u = np.linalg.norm(acc_vec, axis=1)
 
-    xs = [x.copy()]
+    for i in np.flatnonzero(u < 1e-3):
+      self.events.record('low_acc_norm', ts[i])
 
-    for i in range(int(round(t_end / dt))):
-      u_out = fun(x)
+    u_fact = (1.0 / u)[:, np.newaxis]
+    z_b      = u_fact * acc_vec
+    z_b_dot  = u_fact * (jerk - row_dot(z_b, jerk)[:, np.newaxis] * z_b)
+    z_b_ddot = u_fact * (snap - (row_dot(snap, z_b) + row_dot(jerk, z_b_dot))[:, np.newaxis] * z_b - 2 * row_dot(jerk, z_b)[:, np.newaxis] * z_b_dot)
 
-      u, angaccel = u_out
+    theta = np.arctan2(-z_b[:, 0], z_b[:, 1])
+    ang_vel = z_b[:, 0] * z_b_dot[:, 1] - z_b[:, 1] * z_b_dot[:, 0]
+    ang_acc = z_b[:, 0] * z_b_ddot[:, 1] - z_b[:, 1] * z_b_ddot[:, 0]
 
-      if u < 0:
-        u = 0
-        print("WARNING: THRUST IS NEGATIVE!")
+    states = np.column_stack((pos, vel, theta, ang_vel))
+    controls = np.column_stack((u, ang_acc))
 
-      st = np.sin(theta)
-      ct = np.cos(theta)
+    return states, controls
 
-      acc = self.thrust_dist * u * np.array((-st, ct)) - g2 - self.drag_dist * vel
+  def record_control_events(self, t, U):
+    if np.any(U[:, 0] < 0):
+      self.events.record('negative_thrust', t)
 
-      pos += vel * dt
-      vel += acc * dt
-      theta += angvel * dt
-      angvel += angaccel * dt
+  def dynamics(self, X, U, dists):
+    theta = X[:, 4]
+    u = np.maximum(U[:, 0], 0)
 
-      x = np.hstack((pos.copy(), vel.copy(), theta, angvel))
-      xs.append(x)
+    thrust_dir = np.stack((-np.sin(theta), np.cos(theta)), axis=1)
+    acc = (dists['thrust_dist'] * u)[:, np.newaxis] * thrust_dir - g2 - dists['drag_dist'][:, np.newaxis] * X[:, 2:4]
 
-    return np.array(xs)
+    return np.hstack((X[:, 2:4], acc, X[:, 5:6], U[:, 1:2]))
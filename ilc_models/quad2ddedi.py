@@ -1,7 +1,11 @@
+import math
+
 import numpy as np
 
 from ilc_models.base import g, g2
+from ilc_models.integrators import chain_feedback, chain_step_matrices, correct_chain_step
 from ilc_models.quad2d import Quad2D
+from ilc_models.trajectory import StateLog
 
 K1 = 840
 K2 = 480
@@ -35,6 +39,9 @@ class Quad2DDEDI(Quad2D):
 
   control_normalization = np.array((1e-3, 1e-2))
 
+  # The dynamic extension controller keeps integrator state, so rollouts need their own copy.
+  feedback_batch = None
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.reset()
@@ -43,11 +50,100 @@ class Quad2DDEDI(Quad2D):
     self.k2 = K2 * np.eye(2)
     self.k3 = K3 * np.eye(2)
     self.k4 = K4 * np.eye(2)
+    self.gain_diags = (K1 * np.ones(2), K2 * np.ones(2), K3 * np.ones(2), K4 * np.ones(2))
+
+    # Scratch buffers of feedback.
+    self.z = np.zeros(2)
+    self.zdot = np.zeros(2)
+    self.acc = np.zeros(2)
+    self.jerk = np.zeros(2)
+    self.snap = np.zeros(2)
+    self.fb_scratch = np.zeros(2)
+
+    self.fl_integrator = kwargs['fl_integrator']
 
   def reset(self):
     self.int_udot = 0
     self.int_u = g
-    self.zs = []
+    self.zs = StateLog(2)
+
+  def get_controller_state(self):
+    return self.int_u, self.int_udot
+
+  def set_controller_state(self, z):
+    self.int_u, self.int_udot = z
+
+  def update_flat_derivs(self, x):
+    """ Fills z, zdot and the acc and jerk of the thrust state for the state x """
+    st, ct = math.sin(x[4]), math.cos(x[4])
+    angvel = x[5]
+
+    z, zdot, acc, jerk = self.z, self.zdot, self.acc, self.jerk
+    z[0] = -st
+    z[1] = ct
+    zdot[0] = -ct * angvel
+    zdot[1] = -st * angvel
+
+    np.multiply(z, self.int_u, out=acc)
+    acc -= g2
+    np.multiply(z, self.int_udot, out=jerk)
+    np.multiply(zdot, self.int_u, out=self.fb_scratch)
+    jerk += self.fb_scratch
+
+  def get_u_ang_accel(self, snap):
+    """ (1 / u) z x (snap - 2 udot zdot) """
+    w = self.fb_scratch
+    np.multiply(self.zdot, 2 * self.int_udot, out=w)
+    np.subtract(snap, w, out=w)
+    return (1.0 / self.int_u) * (self.z[0] * w[1] - self.z[1] * w[0])
+
+  def get_flat_state(self, x, u, udot):
+    """ The (pos, vel, acc, jerk) that feedback sees for the vehicle
+        state x and the thrust state (u, udot) """
+    theta = x[4]
+    z = np.array((-np.sin(theta), np.cos(theta)))
+    zdot = np.array((-np.cos(theta), -np.sin(theta))) * x[5]
+
+    return np.array((x[0:2], x[2:4], u * z - g2, udot * z + u * zdot))
+
+  def simulate_stream(self, t_end, fun, dt):
+    self.zs.reserve(int(round(t_end / dt)))
+    if self.fl_integrator == 'explicit':
+      return Quad2D.simulate_stream(self, t_end, fun, dt)
+
+    self.step_matrices = chain_step_matrices((self.k1, self.k2, self.k3, self.k4), dt, self.fl_integrator)
+
+    def fun_step(x):
+      self.start_thrust_state = self.int_u, self.int_udot
+      return fun(x)
+
+    return Quad2D.simulate_stream(self, t_end, fun_step, dt)
+
+  def correct_step(self, x, x_new, dt):
+    """ Redoes the explicit step from x to x_new (vehicle and controller
+        thrust state) in flat coordinates with the linear feedback treated
+        implicitly and maps the result back. """
+    if self.fl_integrator == 'explicit':
+      return x_new
+
+    flat = correct_chain_step(self.get_flat_state(x, *self.start_thrust_state),
+                              self.get_flat_state(x_new, self.int_u, self.int_udot),
+                              self.step_matrices)
+    pos, vel, acc, jerk = flat
+
+    thrust_acc = acc + g2
+    u = np.linalg.norm(thrust_acc)
+    z = thrust_acc / u
+    udot = jerk.dot(z)
+    zdot = (jerk - udot * z) / u
+
+    theta = np.arctan2(-z[0], z[1])
+    angvel = np.cross(z, zdot)
+
+    self.int_u = u
+    self.int_udot = udot
+
+    return np.hstack((pos, vel, theta, angvel))
 
   def get_ilc_state(self, state, ind):
     return np.hstack((state, self.zs[ind]))
@@ -162,28 +258,21 @@ class Quad2DDEDI(Quad2D):
     return A, B, C, D
 
   def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
-    pos = x[0:2]
-    vel = x[2:4]
-    theta = x[4]
-    angvel = x[5]
-
-    z = np.array((-np.sin(theta), np.cos(theta)))
-    zdot = np.array((-np.cos(theta) * angvel, -np.sin(theta) * angvel))
-
-    self.zs.append(np.array((self.int_u, self.int_udot)))
+    if integrate:
+      self.zs.append(self.int_u, self.int_udot)
 
-    acc = self.int_u * z - g2
-    jerk = self.int_udot * z + self.int_u * zdot
+    self.update_flat_derivs(x)
+    z, zdot = self.z, self.zdot
 
     uddot_ilc, angaccel_ilc = u_ilc
 
-    snap = -self.k1.dot(pos - pos_des) - self.k2.dot(vel - vel_des) - self.k3.dot(acc - acc_des) -self.k4.dot(jerk - jerk_des) + snap_des
+    snap = chain_feedback(self.gain_diags, (x[0:2], x[2:4], self.acc, self.jerk), (pos_des, vel_des, acc_des, jerk_des), snap_des, self.snap, self.fb_scratch)
 
-    uddot = snap.dot(z) + self.int_u * zdot.T.dot(zdot) + uddot_ilc
-    u_ang_accel = (1.0 / self.int_u) * np.cross(z, snap - 2 * self.int_udot * zdot) + angaccel_ilc
+    uddot = snap.dot(z) + self.int_u * zdot.dot(zdot) + uddot_ilc
+    u_ang_accel = self.get_u_ang_accel(snap) + angaccel_ilc
 
     if integrate:
       self.int_u += self.int_udot * dt
       self.int_udot += uddot * dt
 
-    return np.hstack((self.int_u, u_ang_accel))
+    return np.array((self.int_u, u_ang_accel))
@@ -1,6 +1,7 @@
 import numpy as np
 
-from ilc_models.base import g, g2
+from ilc_models.base import g
+from ilc_models.integrators import chain_feedback
 from ilc_models.quad2ddedi import Quad2DDEDI
 
 class Quad2DDEDIS(Quad2DDEDI):
@@ -39,28 +40,20 @@ class Quad2DDEDIS(Quad2DDEDI):
     return A, B, C, D
 
   def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
-    pos = x[0:2]
-    vel = x[2:4]
-    theta = x[4]
-    angvel = x[5]
-
-    z = np.array((-np.sin(theta), np.cos(theta)))
-    zdot = np.array((-np.cos(theta) * angvel, -np.sin(theta) * angvel))
-
-    self.zs.append(np.array((self.int_u, self.int_udot)))
-
-    acc = self.int_u * z - g2
-    jerk = self.int_udot * z + self.int_u * zdot
+    if integrate:
+      self.zs.append(self.int_u, self.int_udot)
 
-    uddot_ilc, angaccel_ilc = u_ilc
+    self.update_flat_derivs(x)
+    z, zdot = self.z, self.zdot
 
-    snap = -self.k1.dot(pos - pos_des) - self.k2.dot(vel - vel_des) - self.k3.dot(acc - acc_des) -self.k4.dot(jerk - jerk_des) + snap_des + u_ilc
+    snap = chain_feedback(self.gain_diags, (x[0:2], x[2:4], self.acc, self.jerk), (pos_des, vel_des, acc_des, jerk_des), snap_des, self.snap, self.fb_scratch)
+    snap += u_ilc
 
-    uddot = snap.dot(z) + self.int_u * zdot.T.dot(zdot)
-    u_ang_accel = (1.0 / self.int_u) * np.cross(z, snap - 2 * self.int_udot * zdot)
+    uddot = snap.dot(z) + self.int_u * zdot.dot(zdot)
+    u_ang_accel = self.get_u_ang_accel(snap)
 
     if integrate:
       self.int_u += self.int_udot * dt
       self.int_udot += uddot * dt
 
-    return np.hstack((self.int_u, u_ang_accel))
+    return np.array((self.int_u, u_ang_accel))
@@ -10,6 +10,8 @@ class Quad2DLin(ILCBase):
   n_control = 2
   n_out = 2
 
+  state_columns = dict(pos=slice(0, 2), vel=slice(2, 4), rpy=slice(4, 5), omega=slice(5, 6))
+
   control_normalization = np.array((1e-1, 1e-3))
 
   g_vec = g2
@@ -44,29 +46,7 @@ class Quad2DLin(ILCBase):
 
     return A, B, C, D
 
-  def simulate(self, t_end, fun, dt):
-    pos = np.zeros(2)
-    vel = np.zeros(2)
-    theta = 0
-    angvel = 0
-
-    x = np.zeros(6)
-
-    xs = [x.copy()]
-
-    for i in range(int(round(t_end / dt))):
-      u_out = fun(x)
-
-      u, angaccel = u_out
-
-      acc = u * np.array((-theta, 1)) - g2
-
-      pos += vel * dt
-      vel += acc * dt
-      theta += angvel * dt
-      angvel += angaccel * dt
-
-      x = np.hstack((pos.copy(), vel.copy(), theta, angvel))
-      xs.append(x)
-
-    return np.array(xs)
+  def dynamics(self, X, U, dists):
+    theta = X[:, 4]
+    acc = U[:, 0:1] * np.stack((-theta, np.ones(len(X))), axis=1) - g2
+    return np.hstack((X[:, 2:4], acc, X[:, 5:6], U[:, 1:2]))
@@ -1,17 +1,19 @@
+import math
+
 import numpy as np
 
 from python_utils import mathu
 
 from scipy.spatial.transform import Rotation
 
-from ilc_models.base import ILCBase, g, g3
+from ilc_models.base import ILCBase, g, g3, row_dot
 from lqr_gain_match.match_full_state import accel_to_euler_rpy
 from python_utils.rigid_body_lie import RigidBody3D
 
 class U_AccelNorm:
   @staticmethod
   def u(a, z):
-    return np.linalg.norm(a)
+    return np.linalg.norm(a, axis=-1)
 
   @staticmethod
   def duda(a, z):
@@ -24,7 +26,7 @@ class U_AccelNorm:
 class U_AccelProj:
   @staticmethod
   def u(a, z):
-    return a.dot(z)
+    return np.sum(a * z, axis=-1)
 
   @staticmethod
   def duda(a, z):
@@ -37,7 +39,7 @@ class U_AccelProj:
 class U_AccelZPri:
   @staticmethod
   def u(a, z):
-    return a[2] / z[2]
+    return a[..., 2] / z[..., 2]
 
   @staticmethod
   def duda(a, z):
@@ -47,6 +49,65 @@ class U_AccelZPri:
   def dudz(a, z):
     return np.array((0, 0, -a[2] / (z[2] ** 2)))
 
+def quat_to_matrix(q):
+  """ Rotation matrices of the (M, 4) quaternions (w, x, y, z) """
+  q = q / np.linalg.norm(q, axis=1)[:, np.newaxis]
+  qw, qx, qy, qz = q.T
+
+  return np.stack((
+    np.stack((1 - 2 * (qy * qy + qz * qz), 2 * (qx * qy - qz * qw), 2 * (qx * qz + qy * qw)), axis=1),
+    np.stack((2 * (qx * qy + qz * qw), 1 - 2 * (qx * qx + qz * qz), 2 * (qy * qz - qx * qw)), axis=1),
+    np.stack((2 * (qx * qz - qy * qw), 2 * (qy * qz + qx * qw), 1 - 2 * (qx * qx + qy * qy)), axis=1),
+  ), axis=1)
+
+def quat_multiply(p, q):
+  """ Product p * q of the quaternions (w, x, y, z) """
+  pw, px, py, pz = p
+  qw, qx, qy, qz = q
+
+  return np.array((pw * qw - px * qx - py * qy - pz * qz,
+                   pw * qx + px * qw + py * qz - pz * qy,
+                   pw * qy - px * qz + py * qw + pz * qx,
+                   pw * qz + px * qy - py * qx + pz * qw))
+
+def euler_to_matrix(rpy, out):
+  """ Writes the rotation matrix of the ZYX Euler angles rpy = (roll, pitch, yaw) to out """
+  sr, cr = math.sin(rpy[0]), math.cos(rpy[0])
+  sp, cp = math.sin(rpy[1]), math.cos(rpy[1])
+  sy, cy = math.sin(rpy[2]), math.cos(rpy[2])
+
+  out[0, 0] = cy * cp
+  out[0, 1] = cy * sp * sr - sy * cr
+  out[0, 2] = cy * sp * cr + sy * sr
+  out[1, 0] = sy * cp
+  out[1, 1] = sy * sp * sr + cy * cr
+  out[1, 2] = sy * sp * cr - cy * sr
+  out[2, 0] = -sp
+  out[2, 1] = cp * sr
+  out[2, 2] = cp * cr
+  return out
+
+def euler_to_matrices(rpy):
+  """ euler_to_matrix of the rows of rpy, as an (M, 3, 3) array """
+  sr, cr = np.sin(rpy[:, 0]), np.cos(rpy[:, 0])
+  sp, cp = np.sin(rpy[:, 1]), np.cos(rpy[:, 1])
+  sy, cy = np.sin(rpy[:, 2]), np.cos(rpy[:, 2])
+
+  return np.stack((
+    np.stack((cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr), axis=1),
+    np.stack((sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr), axis=1),
+    np.stack((-sp, cp * sr, cp * cr), axis=1),
+  ), axis=1)
+
+def cross3(a, b, out):
+  """ Writes the cross product a x b of 3 vectors to out """
+  a0, a1, a2 = a
+  b0, b1, b2 = b
+  out[0] = a1 * b2 - a2 * b1
+  out[1] = a2 * b0 - a0 * b2
+  out[2] = a0 * b1 - a1 * b0
+  return out
+
 class Delay:
   """
      v dot = - tau * (v - v_des)
@@ -74,6 +135,10 @@ class Quad3D(ILCBase):
 
   n_control_sys = 4
 
+  n_sim_state = 12
+  state_columns = dict(pos=slice(0, 3), vel=slice(3, 6), rpy=slice(6, 9), omega=slice(9, 12))
+  batch_dist_names = ('thrust_dist', 'drag_dist', 'angaccel_dist', 'delay_timeconstant')
+
   state_labels = [
     "Position X",
     "Position Y",
@@ -142,6 +207,8 @@ class Quad3D(ILCBase):
     self.accel_limit = kwargs['accel_limit']
     self.angaccel_limit = kwargs['angaccel_limit']
 
+    self.fast_sim = kwargs['fast_sim']
+
     ttype = kwargs['cascaded_thrust']
     if ttype == 'norm':
       self.U = U_AccelNorm
@@ -326,7 +393,7 @@ class Quad3D(ILCBase):
     u = np.linalg.norm(acc_vec)
 
     if u < 1e-3:
-      print("WARNING: acc norm too low!")
+      self.events.record('low_acc_norm')
 
     z_b      = (1.0 / u) * acc_vec
     z_b_dot  = (1.0 / u) * (jerk - z_b.dot(jerk) * z_b)
@@ -351,31 +418,65 @@ class Quad3D(ILCBase):
 
     return state, control
 
-  def simulate(self, t_end, fun, dt):
-    from random import gauss
-    vec = np.array([gauss(0, 1) for i in range(3)])
-    pos = vec * 0.02 / np.linalg.norm(vec)
-    vec = np.array([gauss(0, 1) for i in range(3)])
-    vel = vec * 0.05 / np.linalg.norm(vec)
+  def feedforward_batch(self, pos, vel, acc, jerk, snap, ts):
+    """ feedforward for (N, 3) derivative arrays at the times ts """
+    acc_vec = acc + g3
+    u = np.linalg.norm(acc_vec, axis=1)
+
+    for i in np.flatnonzero(u < 1e-3):
+      self.events.record('low_acc_norm', ts[i])
+
+    u_fact = (1.0 / u)[:, np.newaxis]
+    z_b      = u_fact * acc_vec
+    z_b_dot  = u_fact * (jerk - row_dot(z_b, jerk)[:, np.newaxis] * z_b)
+
+    ang_vel = np.cross(z_b, z_b_dot)
+
+    z_b_ddot = u_fact * (snap - (row_dot(snap, z_b) + row_dot(jerk, z_b_dot))[:, np.newaxis] * z_b - 2 * row_dot(jerk, z_b)[:, np.newaxis] * z_b_dot) - np.cross(ang_vel, z_b_dot)
+
+    y_b = np.cross(z_b, np.array((1, 0, 0)))
+    y_b /= np.linalg.norm(y_b, axis=1)[:, np.newaxis]
+    x_b = np.cross(y_b, z_b)
+
+    dp = -row_dot(z_b_ddot, y_b)
+    dq =  row_dot(z_b_ddot, x_b)
+
+    ang_vel_body = np.column_stack((row_dot(ang_vel, x_b), row_dot(ang_vel, y_b), row_dot(ang_vel, z_b)))
 
-    #pos = np.array((0.00, -0.02, 0.00))
-    #vel = np.array((0.00, -0.05, 0.00))
+    states = np.hstack((pos, vel, z_b, ang_vel_body))
+    controls = np.column_stack((u, dp, dq, np.zeros(len(u))))
 
-    pos *= 0
-    vel *= 0
+    return states, controls
+
+  def simulate_stream(self, t_end, fun, dt):
+    if self.integrator_name != 'euler':
+      return self.stream_ode(t_end, fun, dt)
+
+    if self.fast_sim:
+      return self.stream_fast(t_end, fun, dt)
+
+    return self.stream_rigid_body(t_end, fun, dt)
+
+  def stream_rigid_body(self, t_end, fun, dt):
+    """ simulate_stream using RigidBody3D and scipy rotations """
+    x = self.initial_state()
+    pos = x[0:3].copy()
+    vel = x[3:6].copy()
 
     rot = Rotation.from_euler('ZYX', np.zeros(3))
     rigid_body = RigidBody3D(pos=pos, vel=vel, quat=np.array((1.0, 0, 0, 0)), ang=np.zeros(3))
 
-    x = np.zeros(12)
-    xs = [x.copy()]
+    N = int(round(t_end / dt))
 
     delay = Delay(self.delay_timeconstant, np.zeros(4))
 
-    for i in range(int(round(t_end / dt))):
+    sub_dt = dt / self.sim_substeps
+
+    for i in range(N):
       time = i * dt
 
       u_out = fun(x)
+      yield time, x, u_out
 
       if self.delay_control:
         if not i:
@@ -393,46 +494,378 @@ class Quad3D(ILCBase):
       u_use, aa_use = u_mixed[0], u_mixed[1:]
 
       if np.any(np.abs(aa_use) > self.angaccel_limit):
-        print("WARNING: Ang accel is very high! (%s; limit %f)" % (aa_use, self.angaccel_limit))
+        self.events.record('angaccel_limit', time, aa_use, self.angaccel_limit)
         aa_use = np.clip(aa_use, -self.angaccel_limit, self.angaccel_limit)
 
       if abs(u_use) > self.accel_limit:
-        print("WARNING: Accel is very high! (%f; limit %f)" % (u_use, self.accel_limit))
+        self.events.record('accel_limit', time, u_use, self.accel_limit)
         u_use = np.clip(u_use, -self.accel_limit, self.accel_limit)
 
       if self.positive_thrust_only and u_use < 0:
         u_use = 0
-        print("WARNING: THRUST IS NEGATIVE")
+        self.events.record('negative_thrust', time)
+
+      aa_use *= self.angaccel_dist
+
+      aa_use[2] = 0
+
+      # The physics runs sim_substeps times per controller call.
+      for j in range(self.sim_substeps):
+        sub_time = time + j * sub_dt
+
+        vel = rigid_body.get_vel()
+        acc = self.thrust_dist * u_use * rot.apply(np.array((0, 0, 1))) - g3 - self.drag_dist * vel
+
+        if abs(self.periodic_accel_dist_mag) > 1e-6:
+          acc += self.periodic_accel_dist_mag * np.sin(2 * np.pi * self.periodic_accel_dist_periods * sub_time)
+
+        ang_accel_world = rot.apply(aa_use)
+
+        rigid_body.step(sub_dt, acc, ang_accel_world)
 
-      vel = rigid_body.get_vel()
-      acc = self.thrust_dist * u_use * rot.apply(np.array((0, 0, 1))) - g3 - self.drag_dist * vel
+        if np.any(np.abs(rigid_body.ang) > 10000):
+          rigid_body.ang = np.clip(rigid_body.ang, -10000, 10000)
+          self.events.record('angvel_clip', sub_time)
 
-      if abs(self.periodic_accel_dist_mag) > 1e-6:
-        acc += self.periodic_accel_dist_mag * np.sin(2 * np.pi * self.periodic_accel_dist_periods * time)
+        if np.any(np.abs(rigid_body.vel) > 100):
+          rigid_body.vel = np.clip(rigid_body.vel, -100, 100)
+          self.events.record('vel_clip', sub_time)
+
+        rot = Rotation.from_matrix(rigid_body.get_rot())
+
+      x[0:3] = rigid_body.get_pos()
+      x[3:6] = rigid_body.get_vel()
+      x[6:9] = rot.as_euler('ZYX')[::-1]
+      x[9:12] = rot.inv().apply(rigid_body.get_ang())
+
+    yield N * dt, x, None
+
+  def stream_fast(self, t_end, fun, dt):
+    """ Same vehicle model as stream_rigid_body, but the attitude is kept
+        as a unit quaternion (w, x, y, z) updated in closed form, and all
+        vectors live in preallocated buffers, including the yielded state. """
+    N = int(round(t_end / dt))
+    x = self.initial_state()
+
+    pos = x[0:3].copy()
+    vel = x[3:6].copy()
+    ang = np.zeros(3)
+    qw, qx, qy, qz = 1.0, 0.0, 0.0, 0.0
+    rot = np.eye(3)
+
+    mixer = self.mixer_true.dot(self.mixer_inv)
+    u_mixed = np.zeros(4)
+    aa_use = np.zeros(3)
+    acc = np.zeros(3)
+    ang_accel_world = np.zeros(3)
+    scratch = np.zeros(3)
+
+    delay_v = np.zeros(4)
+
+    sub_dt = dt / self.sim_substeps
+
+    for i in range(N):
+      time = i * dt
+
+      u_out = fun(x)
+      yield time, x, u_out
+
+      if self.delay_control:
+        if not i:
+          delay_v[:] = u_out
+
+        np.dot(mixer, delay_v, out=u_mixed)
+        delay_v += -self.delay_timeconstant * (delay_v - u_out) * dt
+
+      else:
+        np.dot(mixer, u_out, out=u_mixed)
+
+      u_use = u_mixed[0]
+      aa_use[:] = u_mixed[1:]
+
+      if abs(aa_use[0]) > self.angaccel_limit or abs(aa_use[1]) > self.angaccel_limit or abs(aa_use[2]) > self.angaccel_limit:
+        self.events.record('angaccel_limit', time, aa_use, self.angaccel_limit)
+        np.clip(aa_use, -self.angaccel_limit, self.angaccel_limit, out=aa_use)
+
+      if abs(u_use) > self.accel_limit:
+        self.events.record('accel_limit', time, u_use, self.accel_limit)
+        u_use = min(max(u_use, -self.accel_limit), self.accel_limit)
+
+      if self.positive_thrust_only and u_use < 0:
+        u_use = 0
+        self.events.record('negative_thrust', time)
 
       aa_use *= self.angaccel_dist
+      aa_use[2] = 0
+
+      for j in range(self.sim_substeps):
+        sub_time = time + j * sub_dt
+
+        np.multiply(rot[:, 2], self.thrust_dist * u_use, out=acc)
+        acc -= g3
+        np.multiply(vel, self.drag_dist, out=scratch)
+        acc -= scratch
+
+        if abs(self.periodic_accel_dist_mag) > 1e-6:
+          acc += self.periodic_accel_dist_mag * np.sin(2 * np.pi * self.periodic_accel_dist_periods * sub_time)
+
+        np.dot(rot, aa_use, out=ang_accel_world)
+
+        np.multiply(vel, sub_dt, out=scratch)
+        pos += scratch
+        np.multiply(acc, sub_dt, out=scratch)
+        vel += scratch
+
+        # q <- exp(ang * sub_dt) q
+        wx, wy, wz = ang[0] * sub_dt, ang[1] * sub_dt, ang[2] * sub_dt
+        half_angle = 0.5 * math.sqrt(wx * wx + wy * wy + wz * wz)
+        if half_angle > 1e-12:
+          s = math.sin(half_angle) / (2 * half_angle)
+          dw, dx, dy, dz = math.cos(half_angle), s * wx, s * wy, s * wz
+          qw, qx, qy, qz = (dw * qw - dx * qx - dy * qy - dz * qz,
+                            dw * qx + dx * qw + dy * qz - dz * qy,
+                            dw * qy - dx * qz + dy * qw + dz * qx,
+                            dw * qz + dx * qy - dy * qx + dz * qw)
+          qnorm = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+          qw, qx, qy, qz = qw / qnorm, qx / qnorm, qy / qnorm, qz / qnorm
+
+        np.multiply(ang_accel_world, sub_dt, out=scratch)
+        ang += scratch
+
+        if abs(ang[0]) > 10000 or abs(ang[1]) > 10000 or abs(ang[2]) > 10000:
+          np.clip(ang, -10000, 10000, out=ang)
+          self.events.record('angvel_clip', sub_time)
+
+        if abs(vel[0]) > 100 or abs(vel[1]) > 100 or abs(vel[2]) > 100:
+          np.clip(vel, -100, 100, out=vel)
+          self.events.record('vel_clip', sub_time)
+
+        rot[0, 0] = 1 - 2 * (qy * qy + qz * qz)
+        rot[0, 1] = 2 * (qx * qy - qz * qw)
+        rot[0, 2] = 2 * (qx * qz + qy * qw)
+        rot[1, 0] = 2 * (qx * qy + qz * qw)
+        rot[1, 1] = 1 - 2 * (qx * qx + qz * qz)
+        rot[1, 2] = 2 * (qy * qz - qx * qw)
+        rot[2, 0] = 2 * (qx * qz - qy * qw)
+        rot[2, 1] = 2 * (qy * qz + qx * qw)
+        rot[2, 2] = 1 - 2 * (qx * qx + qy * qy)
+
+      x[0:3] = pos
+      x[3:6] = vel
+      # ZYX Euler angles, stored as (roll, pitch, yaw)
+      x[6] = math.atan2(rot[2, 1], rot[2, 2])
+      x[7] = math.asin(min(max(-rot[2, 0], -1.0), 1.0))
+      x[8] = math.atan2(rot[1, 0], rot[0, 0])
+      np.dot(ang, rot, out=x[9:12])
+
+    yield N * dt, x, None
+
+  def rigid_body_dynamics(self, S, u_use, aa_body, accel_dist, thrust_dist, drag_dist):
+    """ Derivative of the (M, 13) states (pos, vel, quaternion (w, x, y, z),
+        world angular velocity) with thrust u_use and body angular
+        acceleration aa_body held constant. The controls and disturbances
+        are shared or given per row ((M, 1) and (M, 3)). """
+    vel = S[:, 3:6]
+    qw, qx, qy, qz = S[:, 6:10].T
+    wx, wy, wz = S[:, 10:13].T
+
+    rot = quat_to_matrix(S[:, 6:10])
+
+    acc = thrust_dist * u_use * rot[:, :, 2] - g3 - drag_dist * vel + accel_dist
+
+    # qdot = 0.5 * (0, ang) * q
+    qdot = 0.5 * np.stack((-wx * qx - wy * qy - wz * qz,
+                            wx * qw + wy * qz - wz * qy,
+                            wy * qw - wx * qz + wz * qx,
+                            wz * qw + wx * qy - wy * qx), axis=1)
+
+    if np.ndim(aa_body) == 1:
+      ang_accel_world = rot.dot(aa_body)
+    else:
+      ang_accel_world = np.einsum('mij,mj->mi', rot, aa_body)
+
+    return np.hstack((vel, acc, qdot, ang_accel_world))
 
+  def stream_ode(self, t_end, fun, dt):
+    """ simulate_stream using the model's integrator (e.g. RK4) on the
+        quaternion rigid body dynamics. The mixed and limited controls
+        and the periodic disturbance are held over each (sub)step, and
+        the quaternion is renormalized after every one. """
+    self.integrator.reset()
+    N = int(round(t_end / dt))
+    x = self.initial_state()
+
+    s = np.zeros(13)
+    s[0:6] = x[0:6]
+    s[6] = 1.0
+
+    sub_dt = dt / self.sim_substeps
+
+    mixer = self.mixer_true.dot(self.mixer_inv)
+    delay_v = np.zeros(4)
+
+    for i in range(N):
+      time = i * dt
+
+      u_out = fun(x)
+      yield time, x, u_out
+
+      if self.delay_control:
+        if not i:
+          delay_v[:] = u_out
+
+        u_mixed = mixer.dot(delay_v)
+        delay_v += -self.delay_timeconstant * (delay_v - u_out) * dt
+
+      else:
+        u_mixed = mixer.dot(u_out)
+
+      u_use, aa_use = u_mixed[0], u_mixed[1:]
+
+      if np.any(np.abs(aa_use) > self.angaccel_limit):
+        self.events.record('angaccel_limit', time, aa_use, self.angaccel_limit)
+        aa_use = np.clip(aa_use, -self.angaccel_limit, self.angaccel_limit)
+
+      if abs(u_use) > self.accel_limit:
+        self.events.record('accel_limit', time, u_use, self.accel_limit)
+        u_use = np.clip(u_use, -self.accel_limit, self.accel_limit)
+
+      if self.positive_thrust_only and u_use < 0:
+        u_use = 0
+        self.events.record('negative_thrust', time)
+
+      aa_use = aa_use * self.angaccel_dist
       aa_use[2] = 0
 
-      ang_accel_world = rot.apply(aa_use)
+      s_new = s
+      for j in range(self.sim_substeps):
+        accel_dist = 0.0
+        if abs(self.periodic_accel_dist_mag) > 1e-6:
+          accel_dist = self.periodic_accel_dist_mag * np.sin(2 * np.pi * self.periodic_accel_dist_periods * (time + j * sub_dt))
+
+        s_new = self.integrator.step(lambda S: self.rigid_body_dynamics(S, u_use, aa_use, accel_dist, self.thrust_dist, self.drag_dist), s_new[np.newaxis], sub_dt)[0]
+        s_new[6:10] /= np.linalg.norm(s_new[6:10])
+
+      s = self.correct_step(s, s_new, dt)
+
+      if np.any(np.abs(s[10:13]) > 10000):
+        s[10:13] = np.clip(s[10:13], -10000, 10000)
+        self.events.record('angvel_clip', time + dt)
+
+      if np.any(np.abs(s[3:6]) > 100):
+        s[3:6] = np.clip(s[3:6], -100, 100)
+        self.events.record('vel_clip', time + dt)
+
+      rot = quat_to_matrix(s[np.newaxis, 6:10])[0]
+
+      x[0:6] = s[0:6]
+      # ZYX Euler angles, stored as (roll, pitch, yaw)
+      x[6] = math.atan2(rot[2, 1], rot[2, 2])
+      x[7] = math.asin(min(max(-rot[2, 0], -1.0), 1.0))
+      x[8] = math.atan2(rot[1, 0], rot[0, 0])
+      x[9:12] = s[10:13].dot(rot)
+
+    yield N * dt, x, None
+
+  def simulate_batch(self, t_end, fun, dt, M, dists=None):
+    """ Vectorized version of simulate for M vehicles. Euler steps the
+        vehicles like stream_fast, other integrators like stream_ode.
+        dists holds per rollout values of batch_dist_names. """
+    dists = self.get_batch_dists(M, dists)
+    self.integrator.reset()
+    thrust_dist = dists['thrust_dist'][:, np.newaxis]
+    drag_dist = dists['drag_dist'][:, np.newaxis]
+    angaccel_dist = dists['angaccel_dist'][:, np.newaxis]
+    delay_timeconstant = dists['delay_timeconstant'][:, np.newaxis]
+
+    N = int(round(t_end / dt))
+    traj = self.new_trajectory(N, (M,))
+    Xs = traj.data
+    Xs[:, 0] = self.initial_state()
+
+    ode = self.integrator_name != 'euler'
+    if ode:
+      S = np.zeros((M, 13))
+      S[:, 0:6] = Xs[:, 0, 0:6]
+      S[:, 6] = 1.0
+    else:
+      pos = Xs[:, 0, 0:3].copy()
+      vel = Xs[:, 0, 3:6].copy()
+      ang = np.zeros((M, 3))
+      rot = Rotation.identity(M)
+
+    mixer = self.mixer_true.dot(self.mixer_inv)
+
+    sub_dt = dt / self.sim_substeps
+
+    for i in range(N):
+      time = i * dt
+
+      U_out = np.array(fun(Xs[:, i]), dtype=float)
+
+      if self.delay_control:
+        if not i:
+          delay_v = U_out.copy()
+
+        U_delayed = delay_v.copy()
+        delay_v += -delay_timeconstant * (delay_v - U_out) * dt
+
+      else:
+        U_delayed = U_out
 
-      rigid_body.step(dt, acc, ang_accel_world)
+      u_mixed = U_delayed.dot(mixer.T)
 
-      if np.any(np.abs(rigid_body.ang) > 10000):
-        rigid_body.ang = np.clip(rigid_body.ang, -10000, 10000)
-        print("WARNING: Clipping vehicle ang. vel.")
+      u_use = np.clip(u_mixed[:, 0:1], -self.accel_limit, self.accel_limit)
+      aa_use = np.clip(u_mixed[:, 1:], -self.angaccel_limit, self.angaccel_limit)
 
-      if np.any(np.abs(rigid_body.vel) > 100):
-        rigid_body.vel = np.clip(rigid_body.vel, -100, 100)
-        print("WARNING: Clipping vehicle velocity")
+      if self.positive_thrust_only:
+        u_use = np.maximum(u_use, 0)
 
-      rot = Rotation.from_matrix(rigid_body.get_rot())
+      aa_use = aa_use * angaccel_dist
+      aa_use[:, 2] = 0
+
+      X = Xs[:, i + 1]
+
+      if ode:
+        for j in range(self.sim_substeps):
+          accel_dist = 0.0
+          if abs(self.periodic_accel_dist_mag) > 1e-6:
+            accel_dist = self.periodic_accel_dist_mag * np.sin(2 * np.pi * self.periodic_accel_dist_periods * (time + j * sub_dt))
+
+          S = self.integrator.step(lambda S: self.rigid_body_dynamics(S, u_use, aa_use, accel_dist, thrust_dist, drag_dist), S, sub_dt)
+          S[:, 6:10] /= np.linalg.norm(S[:, 6:10], axis=1)[:, np.newaxis]
+
+        S[:, 10:13] = np.clip(S[:, 10:13], -10000, 10000)
+        S[:, 3:6] = np.clip(S[:, 3:6], -100, 100)
+
+        rots = quat_to_matrix(S[:, 6:10])
+        X[:, 0:6] = S[:, 0:6]
+        # ZYX Euler angles, stored as (roll, pitch, yaw)
+        X[:, 6] = np.arctan2(rots[:, 2, 1], rots[:, 2, 2])
+        X[:, 7] = np.arcsin(np.clip(-rots[:, 2, 0], -1.0, 1.0))
+        X[:, 8] = np.arctan2(rots[:, 1, 0], rots[:, 0, 0])
+        X[:, 9:12] = np.einsum('mi,mij->mj', S[:, 10:13], rots)
+
+      else:
+        for j in range(self.sim_substeps):
+          acc = thrust_dist * u_use * rot.as_matrix()[:, :, 2] - g3 - drag_dist * vel
 
-      x = np.hstack((rigid_body.get_pos(), rigid_body.get_vel(), rot.as_euler('ZYX')[::-1], rot.inv().apply(rigid_body.get_ang())))
+          if abs(self.periodic_accel_dist_mag) > 1e-6:
+            acc += self.periodic_accel_dist_mag * np.sin(2 * np.pi * self.periodic_accel_dist_periods * (time + j * sub_dt))
 
-      xs.append(x)
+          ang_accel_world = rot.apply(aa_use)
 
-    return np.array(xs)
+          pos = pos + vel * sub_dt
+          vel = np.clip(vel + acc * sub_dt, -100, 100)
+          rot = Rotation.from_rotvec(ang * sub_dt) * rot
+          ang = np.clip(ang + ang_accel_world * sub_dt, -10000, 10000)
+
+        X[:, 0:3] = pos
+        X[:, 3:6] = vel
+        X[:, 6:9] = rot.as_euler('ZYX')[:, ::-1]
+        X[:, 9:12] = rot.inv().apply(ang)
+
+    return traj
 
   def feedback(self, x, pos_des, vel_des, acc_des, angvel_des, angaccel_des, u_ilc, **kwargs):
     pos_vel = x[:6]
@@ -465,3 +898,28 @@ class Quad3D(ILCBase):
     u_ang_accel = -self.K_att.dot(euler_angvel) + angaccel_des
 
     return np.hstack((u_accel + u_ilc[0], u_ang_accel + u_ilc[1:]))
+
+  def feedback_batch(self, X, pos_des, vel_des, acc_des, angvel_des, angaccel_des, u_ilc, **kwargs):
+    """ feedback for the rows of X. The desired values and u_ilc are shared
+        or given per row. """
+    rot = Rotation.from_euler('ZYX', X[:, 6:9][:, ::-1])
+    z_b = rot.as_matrix()[:, :, 2]
+
+    if self.model_drag:
+      drag_dist_control = self.drag_dist
+    else:
+      drag_dist_control = 0
+
+    # Position Control
+    pos_vel_error = X[:, :6] - np.hstack((pos_des, vel_des))
+    accel_des = -pos_vel_error.dot(self.K_pos.T) + acc_des + drag_dist_control * X[:, 3:6]
+
+    # Reference Conversion (accel_to_euler_rpy takes one acceleration)
+    euler_des = np.array([accel_to_euler_rpy(a, g) for a in accel_des])
+    u_accel = self.U.u(accel_des + g3, z_b)
+
+    # Attitude Control
+    euler_angvel = np.hstack((X[:, 6:9] - euler_des, X[:, 9:12] - angvel_des))
+    u_ang_accel = -euler_angvel.dot(self.K_att.T) + angaccel_des
+
+    return np.hstack(((u_accel + u_ilc[..., 0])[:, np.newaxis], u_ang_accel + u_ilc[..., 1:]))
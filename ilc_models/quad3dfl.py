@@ -4,22 +4,200 @@ from python_utils import mathu
 
 from scipy.spatial.transform import Rotation
 
-from ilc_models.base import g, g3
-from ilc_models.quad3d import Quad3D
+from ilc_models.base import g, g3, row_dot
+from ilc_models.integrators import chain_feedback, chain_step_matrices, correct_chain_step
+from ilc_models.quad3d import Quad3D, cross3, euler_to_matrices, euler_to_matrix, quat_multiply, quat_to_matrix
+from ilc_models.trajectory import StateLog
 
 class Quad3DFL(Quad3D):
   duration = 1.0
   int_u = g
   int_udot = 0
 
+  # The dynamic extension controller keeps integrator state, so rollouts need their own copy.
+  feedback_batch = None
+
   def __init__(self, **kwargs):
     Quad3D.__init__(self, **kwargs)
 
+    self.fl_integrator = kwargs['fl_integrator']
+
+    # Diagonals of feedback_gains, set on the first call of feedback.
+    self.gain_diags = None
+
+    # Scratch buffers of feedback.
+    self.rot_m = np.zeros((3, 3))
+    self.ang_world = np.zeros(3)
+    self.z_b_dot_act = np.zeros(3)
+    self.start_acc = np.zeros(3)
+    self.start_jerk = np.zeros(3)
+    self.snap = np.zeros(3)
+    self.z_ddot = np.zeros(3)
+    self.ang_acc_world = np.zeros(3)
+    self.fb_scratch = np.zeros(3)
+
   def reset(self):
     self.int_u = g
     self.int_c = g
     self.int_dot = 0
-    self.zs = []
+    self.zs = StateLog(2)
+
+  def get_controller_state(self):
+    return self.int_u, self.int_udot
+
+  def set_controller_state(self, z):
+    self.int_u, self.int_udot = z
+
+  def feedback_gains(self):
+    """ The gains (k1, k2, k3, k4) of the linear controller in feedback """
+    return (840 * np.eye(3) / self.duration ** 4,
+            480 * np.eye(3) / self.duration ** 3,
+            120 * np.eye(3) / self.duration ** 2,
+             16 * np.eye(3) / self.duration ** 1)
+
+  def get_gain_diags(self):
+    if self.gain_diags is None:
+      self.gain_diags = tuple(np.diag(k).copy() for k in self.feedback_gains())
+
+    return self.gain_diags
+
+  def update_attitude(self, x):
+    """ Fills rot_m, ang_world and z_b_dot_act for the state x and
+        returns the thrust axis (a column of rot_m) """
+    euler_to_matrix(x[6:9], self.rot_m)
+    self.x_b_act = self.rot_m[:, 0]
+    self.y_b_act = self.rot_m[:, 1]
+    self.z_b_act = z_b_act = self.rot_m[:, 2]
+
+    np.dot(self.rot_m, x[9:12], out=self.ang_world)
+    cross3(self.ang_world, z_b_act, self.z_b_dot_act)
+    return z_b_act
+
+  def update_start_derivs(self, vel, u, udot, drag):
+    """ Fills start_acc = u z - g3 - drag vel and
+        start_jerk = u z_dot + udot z - drag start_acc """
+    acc, jerk, scratch = self.start_acc, self.start_jerk, self.fb_scratch
+
+    np.multiply(self.z_b_act, u, out=acc)
+    acc -= g3
+    np.multiply(vel, drag, out=scratch)
+    acc -= scratch
+
+    np.multiply(self.z_b_dot_act, u, out=jerk)
+    np.multiply(self.z_b_act, udot, out=scratch)
+    jerk += scratch
+    np.multiply(acc, drag, out=scratch)
+    jerk -= scratch
+
+  def feedback_terms_batch(self, X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des):
+    """ The terms of feedback for the rows of X with the controller states
+        Z (rows): (rot_m, ang_world, z, z_dot, u, udot, start_jerk, snap,
+        drag), with u and udot as columns. The desired values are shared
+        or given per row. """
+    rot = euler_to_matrices(X[:, 6:9])
+    z = rot[:, :, 2]
+    ang_world = np.einsum('kij,kj->ki', rot, X[:, 9:12])
+    z_dot = np.cross(ang_world, z)
+
+    thrust = Z.dot(self.get_thrust_map().T)
+    u, udot = thrust[:, 0:1], thrust[:, 1:2]
+    drag = self.drag_dist if self.model_drag else 0
+
+    acc = u * z - g3 - drag * X[:, 3:6]
+    jerk = u * z_dot + udot * z - drag * acc
+
+    k1, k2, k3, k4 = self.get_gain_diags()
+    snap = -k1 * (X[:, 0:3] - pos_des) - k2 * (X[:, 3:6] - vel_des) - k3 * (acc - acc_des) - k4 * (jerk - jerk_des) + snap_des
+
+    return rot, ang_world, z, z_dot, u, udot, jerk, snap, drag
+
+  def fb_resp_output_batch(self, X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, **kwargs):
+    """ fb_resp_output of feedback (without integrating) for the rows of X
+        with the controller states Z (rows), in one call """
+    rot, ang_world, z, z_dot, u, udot, jerk, snap, drag = self.feedback_terms_batch(X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des)
+
+    v1 = row_dot(snap, z) + u[:, 0] * row_dot(z_dot, z_dot) + drag * row_dot(jerk, z)
+    z_ddot = (snap - v1[:, np.newaxis] * z - 2 * udot * z_dot + drag * jerk) / u - np.cross(ang_world, z_dot)
+
+    controls = np.empty((len(X), 4), dtype=np.result_type(X, Z))
+    controls[:, 0] = Z[:, 0] + u_ilc[..., 0]
+    controls[:, 1:] = np.einsum('ki,kij->kj', np.cross(z, z_ddot), rot) + u_ilc[..., 1:]
+    return controls
+
+  def get_thrust_map(self):
+    """ The matrix taking the controller state (see get_controller_state)
+        to the thrust and its derivative (u, udot) """
+    return np.eye(2)
+
+  def get_flat_state(self, s, z):
+    """ The (pos, vel, acc, jerk) that feedback sees for the stream_ode
+        state s and the controller state z """
+    u, udot = self.get_thrust_map().dot(z)
+    drag_dist_control = self.drag_dist if self.model_drag else 0
+
+    z = quat_to_matrix(s[np.newaxis, 6:10])[0][:, 2]
+    z_dot = np.cross(s[10:13], z)
+
+    acc = u * z - g3 - drag_dist_control * s[3:6]
+    jerk = udot * z + u * z_dot - drag_dist_control * acc
+
+    return np.array((s[0:3], s[3:6], acc, jerk))
+
+  def simulate_batch(self, t_end, fun, dt, M, dists=None):
+    # correct_step needs the controller state, which the rollouts keep in their own copies.
+    assert self.fl_integrator == 'explicit', "simulate_batch only supports --fl-integrator explicit"
+    return Quad3D.simulate_batch(self, t_end, fun, dt, M, dists)
+
+  def simulate_stream(self, t_end, fun, dt):
+    self.zs.reserve(int(round(t_end / dt)))
+    if self.fl_integrator == 'explicit':
+      return Quad3D.simulate_stream(self, t_end, fun, dt)
+
+    self.step_matrices = chain_step_matrices(self.feedback_gains(), dt, self.fl_integrator)
+
+    def fun_step(x):
+      self.start_controller_state = self.get_controller_state()
+      return fun(x)
+
+    return self.stream_ode(t_end, fun_step, dt)
+
+  def correct_step(self, s, s_new, dt):
+    """ Redoes the explicit step from s to s_new (vehicle and controller
+        thrust state) in flat coordinates with the linear feedback treated
+        implicitly and maps the result back.
+        The yaw and the angular velocity about the thrust axis are kept. """
+    if self.fl_integrator == 'explicit':
+      return s_new
+
+    flat = correct_chain_step(self.get_flat_state(s, self.start_controller_state),
+                              self.get_flat_state(s_new, self.get_controller_state()),
+                              self.step_matrices)
+    pos, vel, acc, jerk = flat
+
+    drag_dist_control = self.drag_dist if self.model_drag else 0
+
+    thrust_acc = acc + g3 + drag_dist_control * vel
+    u = np.linalg.norm(thrust_acc)
+    z = thrust_acc / u
+
+    thrust_jerk = jerk + drag_dist_control * acc
+    udot = thrust_jerk.dot(z)
+    z_dot = (thrust_jerk - udot * z) / u
+
+    # Smallest rotation from the stepped thrust axis to z
+    z_step = quat_to_matrix(s_new[np.newaxis, 6:10])[0][:, 2]
+    axis = np.cross(z_step, z)
+    sin_angle = np.linalg.norm(axis)
+    quat = s_new[6:10]
+    if sin_angle > 1e-12:
+      half_angle = 0.5 * np.arctan2(sin_angle, z_step.dot(z))
+      quat = quat_multiply(np.hstack((np.cos(half_angle), np.sin(half_angle) * axis / sin_angle)), quat)
+
+    ang = np.cross(z, z_dot) + s_new[10:13].dot(z) * z
+
+    self.set_controller_state(np.linalg.solve(self.get_thrust_map(), (u, udot)))
+
+    return np.hstack((pos, vel, quat, ang))
 
   def get_feedback_response(self, state, control, dt, nou=False):
     X = slice(0, 3)
@@ -201,22 +379,13 @@ class Quad3DFL(Quad3D):
     return A, B, C, D
 
   def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
-    pos = x[:3]
-    vel = x[3:6]
-    rpy = x[6:9]
-    ang_vel = x[9:]
-
-    self.zs.append(np.array((self.int_u, self.int_udot)))
-
-    rot = Rotation.from_euler('ZYX', rpy[::-1])
-    ang_vel = x[9:]
-    rot_m = rot.as_matrix()
-    self.x_b_act = rot_m[:, 0]
-    self.y_b_act = rot_m[:, 1]
-    self.z_b_act = z_b_act = rot_m[:, 2]
+    """ Works in the preallocated scratch buffers; only the returned control is allocated. """
+    if integrate:
+      self.zs.append(self.int_u, self.int_udot)
 
-    ang_vel_w = rot.apply(ang_vel)
-    z_b_dot_act = np.cross(ang_vel_w, z_b_act)
+    z_b_act = self.update_attitude(x)
+    z_b_dot_act = self.z_b_dot_act
+    scratch = self.fb_scratch
 
     u = self.int_u
     udot = self.int_udot
@@ -226,36 +395,36 @@ class Quad3DFL(Quad3D):
     else:
       DRAG_DIST_CONTROL = 0
 
-    start_acc = u * z_b_act - g3 - DRAG_DIST_CONTROL * vel
-    start_jerk = u * z_b_dot_act + udot * z_b_act - DRAG_DIST_CONTROL * start_acc
-
-    pos_err = pos - pos_des
-    vel_err = vel - vel_des
-    acc_err = start_acc - acc_des
-    jerk_err = start_jerk - jerk_des
-
-    k1 = 840 * np.eye(3) / self.duration ** 4
-    k2 = 480 * np.eye(3) / self.duration ** 3
-    k3 = 120 * np.eye(3) / self.duration ** 2
-    k4 = 16 * np.eye(3) / self.duration ** 1
+    self.update_start_derivs(x[3:6], u, udot, DRAG_DIST_CONTROL)
+    start_jerk = self.start_jerk
 
     # Linear controller
-    snap = -k1.dot(pos_err) - k2.dot(vel_err) - k3.dot(acc_err) - k4.dot(jerk_err) + snap_des
+    snap = chain_feedback(self.get_gain_diags(), (x[0:3], x[3:6], self.start_acc, start_jerk), (pos_des, vel_des, acc_des, jerk_des), snap_des, self.snap, scratch)
 
     v1 = snap.dot(z_b_act) + u * z_b_dot_act.dot(z_b_dot_act) + DRAG_DIST_CONTROL * start_jerk.dot(z_b_act)
 
-    z_ddot = (1 / u) * (snap - v1 * z_b_act - 2 * udot * z_b_dot_act + DRAG_DIST_CONTROL * start_jerk)
+    # z_ddot = (1 / u) * (snap - v1 * z_b_act - 2 * udot * z_b_dot_act + DRAG_DIST_CONTROL * start_jerk)
+    z_ddot = self.z_ddot
+    np.multiply(z_b_act, v1, out=scratch)
+    np.subtract(snap, scratch, out=z_ddot)
+    np.multiply(z_b_dot_act, 2 * udot, out=scratch)
+    z_ddot -= scratch
+    np.multiply(start_jerk, DRAG_DIST_CONTROL, out=scratch)
+    z_ddot += scratch
+    z_ddot *= 1 / u
 
-    angaccel_cross_z = z_ddot - np.cross(ang_vel_w, z_b_dot_act)
+    # angaccel_cross_z = z_ddot - ang_world x z_b_dot_act
+    z_ddot -= cross3(self.ang_world, z_b_dot_act, scratch)
 
-    ang_acc_world = np.cross(z_b_act, angaccel_cross_z)
-    ang_acc_body = rot.inv().apply(ang_acc_world) + u_ilc[1:]
+    cross3(z_b_act, z_ddot, self.ang_acc_world)
 
-    u_ret = self.int_u + u_ilc[0]
+    control = np.empty(4)
+    control[0] = self.int_u + u_ilc[0]
+    np.dot(self.ang_acc_world, self.rot_m, out=control[1:])
+    control[1:] += u_ilc[1:]
 
     if integrate:
       self.int_u += self.int_udot * dt + 0.5 * v1 * dt ** 2
       self.int_udot += v1 * dt
 
-    control = np.hstack((u_ret, ang_acc_body))
     return control
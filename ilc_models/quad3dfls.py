@@ -1,8 +1,7 @@
 import numpy as np
 
-from scipy.spatial.transform import Rotation
-
-from ilc_models.base import g, g3
+from ilc_models.base import g
+from ilc_models.integrators import chain_feedback
 from ilc_models.quad3dflv import Quad3DFLV
 
 K1xy = 1040
@@ -62,6 +61,17 @@ class Quad3DFLS(Quad3DFLV):
     self.k3[2, 2] = K3z
     self.k4[2, 2] = K4z
 
+  def feedback_gains(self):
+    return self.k1, self.k2, self.k3, self.k4
+
+  def fb_resp_output(self, control):
+    # get_feedback_response is that of the snap (the ILC controls), not of the body controls feedback returns.
+    return self.snap.copy()
+
+  def fb_resp_output_batch(self, X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, **kwargs):
+    rot, ang_world, z, z_dot, u, udot, jerk, snap, drag = self.feedback_terms_batch(X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des)
+    return snap + u_ilc
+
   def get_feedback_response(self, state, control, dt):
     dims = 3
     devs = 4
@@ -100,18 +110,11 @@ class Quad3DFLS(Quad3DFLV):
     return A, B, C, D
 
   def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
-    pos = x[:3]
-    vel = x[3:6]
-    rpy = x[6:9]
-    ang_vel = x[9:]
-
-    self.zs.append(np.array((self.int_u, self.int_udot)))
-
-    rot = Rotation.from_euler('ZYX', rpy[::-1])
-    self.z_b_act = z_b_act = rot.apply(np.array((0, 0, 1)))
+    if integrate:
+      self.zs.append(self.int_u, self.int_udot)
 
-    ang_world = rot.apply(ang_vel)
-    z_b_dot_act = np.cross(ang_world, z_b_act)
+    z_b_act = self.update_attitude(x)
+    z_b_dot_act = self.z_b_dot_act
 
     u = self.int_u
     udot = self.int_udot
@@ -121,31 +124,22 @@ class Quad3DFLS(Quad3DFLV):
     else:
       drag_dist_control = 0
 
-    start_acc = u * z_b_act - g3 - drag_dist_control * vel
-    start_jerk = u * z_b_dot_act + udot * z_b_act - drag_dist_control * start_acc
+    self.update_start_derivs(x[3:6], u, udot, drag_dist_control)
+    start_jerk = self.start_jerk
 
     self.z = z_b_act
-    self.acc = start_acc
-
-    pos_err = pos - pos_des
-    vel_err = vel - vel_des
-    acc_err = start_acc - acc_des
-    jerk_err = start_jerk - jerk_des
+    self.acc = self.start_acc
 
     # Linear controller
-    snap = -self.k1.dot(pos_err) - self.k2.dot(vel_err) - self.k3.dot(acc_err) - self.k4.dot(jerk_err) + snap_des + u_ilc
-    self.snap = snap
+    snap = chain_feedback(self.get_gain_diags(), (x[0:3], x[3:6], self.start_acc, start_jerk), (pos_des, vel_des, acc_des, jerk_des), snap_des, self.snap, self.fb_scratch)
+    snap += u_ilc
 
     v1 = snap.dot(z_b_act) + u * z_b_dot_act.dot(z_b_dot_act) + drag_dist_control * start_jerk.dot(z_b_act)
     self.v1 = v1
 
-    # Here we don't include v1 * z_b_act, because when crossed with Z, this term is zero.
-    z_ddot = (1 / u) * (snap - 2 * udot * z_b_dot_act + drag_dist_control * start_jerk)
-
-    ang_acc_world = np.cross(z_b_act, z_ddot) - (ang_world.dot(z_b_act)) * np.cross(z_b_act, ang_world)
-    ang_acc_body = rot.inv().apply(ang_acc_world)
-
-    u_ret = self.int_u
+    control = np.empty(4)
+    control[0] = self.int_u
+    self.get_ang_acc_body(snap, u, udot, drag_dist_control, control[1:])
 
     if integrate:
       self.int_u += self.int_udot * dt
@@ -154,5 +148,4 @@ class Quad3DFLS(Quad3DFLV):
       self.int_u = np.clip(self.int_u, -10000, 10000)
       self.int_udot = np.clip(self.int_udot, -10000, 10000)
 
-    control = np.hstack((u_ret, ang_acc_body))
     return control
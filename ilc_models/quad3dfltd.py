@@ -1,8 +1,7 @@
 import numpy as np
 
-from scipy.spatial.transform import Rotation
-
-from ilc_models.base import g, g3
+from ilc_models.base import g, row_dot
+from ilc_models.integrators import chain_feedback
 from ilc_models.quad3dfls import Quad3DFLS
 
 K1 = 1040
@@ -52,19 +51,42 @@ class Quad3DFLTD(Quad3DFLS):
     super(Quad3DFLTD, self).__init__(*args, **kwargs)
     self.T_c = kwargs['delay_timeconstant_control']
 
-  def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
-    pos = x[:3]
-    vel = x[3:6]
-    rpy = x[6:9]
-    ang_vel = x[9:]
+  def feedback_gains(self):
+    return (K1 * np.eye(3) / self.duration ** 4,
+            K2 * np.eye(3) / self.duration ** 3,
+            K3 * np.eye(3) / self.duration ** 2,
+            K4 * np.eye(3) / self.duration ** 1)
+
+  def get_thrust_map(self):
+    # The thrust is the delayed int_c, driven by int_u: udot = -T_c (int_c - int_u).
+    return np.array(((0, 1), (self.T_c, -self.T_c)))
+
+  def get_controller_state(self):
+    return self.int_u, self.int_c
+
+  def set_controller_state(self, z):
+    self.int_u, self.int_c = z
+
+  def fb_resp_output(self, control):
+    output = control.copy()
+    output[0] = self.int_udot
+    return output
+
+  def fb_resp_output_batch(self, X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, **kwargs):
+    rot, ang_world, z, z_dot, u, udot, jerk, snap, drag = self.feedback_terms_batch(X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des)
+    snap = snap + u_ilc
 
-    self.zs.append(np.array((self.int_u, self.int_c)))
+    # udot is the thrust delay cdot.
+    int_udot = (row_dot(snap, z) + u[:, 0] * row_dot(z_dot, z_dot)) / self.T_c + udot[:, 0]
+    ang_acc_body = self.get_ang_acc_body_batch(rot, ang_world, z, z_dot, jerk, snap, u, int_udot[:, np.newaxis], drag)
+    return np.hstack((int_udot[:, np.newaxis], ang_acc_body))
 
-    rot = Rotation.from_euler('ZYX', rpy[::-1])
-    self.z_b_act = z_b_act = rot.apply(np.array((0, 0, 1)))
+  def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
+    if integrate:
+      self.zs.append(self.int_u, self.int_c)
 
-    ang_world = rot.apply(ang_vel)
-    z_b_dot_act = np.cross(ang_world, z_b_act)
+    z_b_act = self.update_attitude(x)
+    z_b_dot_act = self.z_b_dot_act
 
     # thrust delay
     cdot = -self.T_c * (self.int_c - self.int_u)
@@ -77,38 +99,21 @@ class Quad3DFLTD(Quad3DFLS):
     else:
       drag_dist_control = 0
 
-    start_acc = u * z_b_act - g3 - drag_dist_control * vel
-    start_jerk = u * z_b_dot_act + udot * z_b_act - drag_dist_control * start_acc
+    self.update_start_derivs(x[3:6], u, udot, drag_dist_control)
 
     self.z = z_b_act
-    self.acc = start_acc
-
-    pos_err = pos - pos_des
-    vel_err = vel - vel_des
-    acc_err = start_acc - acc_des
-    jerk_err = start_jerk - jerk_des
-
-    k1 = K1 * np.eye(3) / self.duration ** 4
-    k2 = K2 * np.eye(3) / self.duration ** 3
-    k3 = K3 * np.eye(3) / self.duration ** 2
-    k4 = K4 * np.eye(3) / self.duration ** 1
+    self.acc = self.start_acc
 
     # Linear controller
-    snap = -k1.dot(pos_err) - k2.dot(vel_err) - k3.dot(acc_err) - k4.dot(jerk_err) + snap_des + u_ilc
-    self.snap = snap
+    snap = chain_feedback(self.get_gain_diags(), (x[0:3], x[3:6], self.start_acc, self.start_jerk), (pos_des, vel_des, acc_des, jerk_des), snap_des, self.snap, self.fb_scratch)
+    snap += u_ilc
 
     # thrust delay
     self.int_udot = (snap.dot(z_b_act) + u * z_b_dot_act.dot(z_b_dot_act)) / self.T_c + cdot# + u_ilc[0]
 
-    udot = self.int_udot
-
-    # Here we don't include v1 * z_b_act, because when crossed with Z, this term is zero.
-    z_ddot = (1 / u) * (snap - 2 * udot * z_b_dot_act + drag_dist_control * start_jerk)
-
-    ang_acc_world = np.cross(z_b_act, z_ddot) - (ang_world.dot(z_b_act)) * np.cross(z_b_act, ang_world)
-    ang_acc_body = rot.inv().apply(ang_acc_world)
-
-    u_ret = self.int_u
+    control = np.empty(4)
+    control[0] = self.int_u
+    self.get_ang_acc_body(snap, u, self.int_udot, drag_dist_control, control[1:])
 
     if integrate:
       self.int_u += self.int_udot * dt
@@ -117,5 +122,4 @@ class Quad3DFLTD(Quad3DFLS):
       self.int_u = np.clip(self.int_u, -10000, 10000)
       self.int_c = np.clip(self.int_c, -10000, 10000)
 
-    control = np.hstack((u_ret, ang_acc_body))
     return control
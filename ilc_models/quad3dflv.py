@@ -4,7 +4,9 @@ from python_utils import mathu
 
 from scipy.spatial.transform import Rotation
 
-from ilc_models.base import g, g3
+from ilc_models.base import g, g3, row_dot
+from ilc_models.integrators import chain_feedback
+from ilc_models.quad3d import cross3
 from ilc_models.quad3dfl import Quad3DFL
 
 K1 = 1040
@@ -47,6 +49,37 @@ class Quad3DFLV(Quad3DFL):
 
   control_normalization = np.array((1e-3, 1e-2, 1e-2, 1e-2))
 
+  def feedback_gains(self):
+    return (K1 * np.eye(3) / self.duration ** 4,
+            K2 * np.eye(3) / self.duration ** 3,
+            K3 * np.eye(3) / self.duration ** 2,
+            K4 * np.eye(3) / self.duration ** 1)
+
+  def get_ang_acc_body(self, snap, u, udot, drag, out):
+    """ Writes R^T (z x z_ddot - (w . z) z x w) to out, with
+        z_ddot = (snap - 2 udot z_dot + drag start_jerk) / u.
+        We don't include v1 * z in z_ddot, because when crossed with z, this term is zero. """
+    z_ddot, scratch = self.z_ddot, self.fb_scratch
+
+    np.multiply(self.z_b_dot_act, 2 * udot, out=scratch)
+    np.subtract(snap, scratch, out=z_ddot)
+    np.multiply(self.start_jerk, drag, out=scratch)
+    z_ddot += scratch
+    z_ddot *= 1 / u
+
+    ang_acc_world = cross3(self.z_b_act, z_ddot, self.ang_acc_world)
+    cross3(self.z_b_act, self.ang_world, scratch)
+    scratch *= self.ang_world.dot(self.z_b_act)
+    ang_acc_world -= scratch
+
+    np.dot(ang_acc_world, self.rot_m, out=out)
+
+  def get_ang_acc_body_batch(self, rot, ang_world, z, z_dot, jerk, snap, u, udot, drag):
+    """ get_ang_acc_body for the rows of feedback_terms_batch """
+    z_ddot = (snap - 2 * udot * z_dot + drag * jerk) / u
+    ang_acc_world = np.cross(z, z_ddot) - row_dot(ang_world, z)[:, np.newaxis] * np.cross(z, ang_world)
+    return np.einsum('ki,kij->kj', ang_acc_world, rot)
+
   def get_feedback_response(self, state, control, dt):
     X = slice(0, 3)
     V = slice(3, 6)
@@ -248,7 +281,7 @@ class Quad3DFLV(Quad3DFL):
     u = np.linalg.norm(acc_vec)
 
     if u < 1e-3:
-      print("WARNING: acc norm too low!")
+      self.events.record('low_acc_norm')
 
     z_b      = (1.0 / u) * acc_vec
     z_b_dot  = (1.0 / u) * (jerk - z_b.dot(jerk) * z_b)
@@ -266,23 +299,38 @@ class Quad3DFLV(Quad3DFL):
 
     return state, control
 
-  def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
-    pos = x[:3]
-    vel = x[3:6]
-    rpy = x[6:9]
-    ang_vel = x[9:]
+  def feedforward_batch(self, pos, vel, acc, jerk, snap, ts):
+    """ feedforward for (N, 3) derivative arrays at the times ts """
+    acc_vec = acc + g3
+    u = np.linalg.norm(acc_vec, axis=1)
 
-    self.zs.append(np.array((self.int_u, self.int_udot)))
+    for i in np.flatnonzero(u < 1e-3):
+      self.events.record('low_acc_norm', ts[i])
 
-    rot = Rotation.from_euler('ZYX', rpy[::-1])
-    ang_vel = x[9:]
-    rot_m = rot.as_matrix()
-    self.x_b_act = rot_m[:, 0]
-    self.y_b_act = rot_m[:, 1]
-    self.z_b_act = z_b_act = rot_m[:, 2]
+    u_fact = (1.0 / u)[:, np.newaxis]
+    z_b      = u_fact * acc_vec
+    z_b_dot  = u_fact * (jerk - row_dot(z_b, jerk)[:, np.newaxis] * z_b)
+
+    ang_vel = np.cross(z_b, z_b_dot)
+
+    y_b = np.cross(z_b, np.array((1, 0, 0)))
+    y_b /= np.linalg.norm(y_b, axis=1)[:, np.newaxis]
+    x_b = np.cross(y_b, z_b)
+
+    ang_vel_body = np.column_stack((row_dot(ang_vel, x_b), row_dot(ang_vel, y_b), row_dot(ang_vel, z_b)))
+
+    N = len(u)
+    states = np.hstack((pos, vel, z_b, ang_vel_body, np.full((N, 1), g), np.zeros((N, 1))))
+    controls = np.zeros((N, 4))
+
+    return states, controls
+
+  def feedback(self, x, dt, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, integrate=True, **kwargs):
+    if integrate:
+      self.zs.append(self.int_u, self.int_udot)
 
-    ang_world = rot.apply(ang_vel)
-    z_b_dot_act = np.cross(ang_world, z_b_act)
+    z_b_act = self.update_attitude(x)
+    z_b_dot_act = self.z_b_dot_act
 
     u = self.int_u
     udot = self.int_udot
@@ -292,26 +340,14 @@ class Quad3DFLV(Quad3DFL):
     else:
       drag_dist_control = 0
 
-    start_acc = u * z_b_act - g3 - drag_dist_control * vel
-    start_jerk = u * z_b_dot_act + udot * z_b_act - drag_dist_control * start_acc
+    self.update_start_derivs(x[3:6], u, udot, drag_dist_control)
+    start_jerk = self.start_jerk
 
     self.z = z_b_act
-    self.acc = start_acc
-
-    pos_err = pos - pos_des
-    vel_err = vel - vel_des
-    acc_err = start_acc - acc_des
-    jerk_err = start_jerk - jerk_des
-
-    k1 = K1 * np.eye(3) / self.duration ** 4
-    k2 = K2 * np.eye(3) / self.duration ** 3
-    k3 = K3 * np.eye(3) / self.duration ** 2
-    k4 = K4 * np.eye(3) / self.duration ** 1
+    self.acc = self.start_acc
 
     # Linear controller
-    snap = -k1.dot(pos_err) - k2.dot(vel_err) - k3.dot(acc_err) - k4.dot(jerk_err) + snap_des
-
-    self.snap = snap
+    snap = chain_feedback(self.get_gain_diags(), (x[0:3], x[3:6], self.start_acc, start_jerk), (pos_des, vel_des, acc_des, jerk_des), snap_des, self.snap, self.fb_scratch)
 
     v1 = snap.dot(z_b_act) + u * z_b_dot_act.dot(z_b_dot_act) + drag_dist_control * start_jerk.dot(z_b_act) + u_ilc[0]
 
@@ -320,22 +356,29 @@ class Quad3DFLV(Quad3DFL):
     # approx. thrust delay
     #self.int_udot = 0.065 * (snap.dot(z_b_act) + u * z_b_dot_act.dot(z_b_dot_act))
 
-    udot = self.int_udot
-
-    # Here we don't include v1 * z_b_act, because when crossed with Z, this term is zero.
-    z_ddot = (1 / u) * (snap - 2 * udot * z_b_dot_act + drag_dist_control * start_jerk)
-
-    ang_acc_world = np.cross(z_b_act, z_ddot) - (ang_world.dot(z_b_act)) * np.cross(z_b_act, ang_world)
-    ang_acc_body = rot.inv().apply(ang_acc_world) + u_ilc[1:]
-
-    u_ret = self.int_u
+    control = np.empty(4)
+    control[0] = self.int_u
+    self.get_ang_acc_body(snap, u, self.int_udot, drag_dist_control, control[1:])
+    control[1:] += u_ilc[1:]
 
     if integrate:
       self.int_u += self.int_udot * dt
       self.int_udot += v1 * dt
 
-    control = np.hstack((u_ret, ang_acc_body))
     return control
 
   def get_ilc_state(self, state, ind):
     return np.hstack((state, self.zs[ind]))
+
+  def fb_resp_output(self, control):
+    # The response is that of the thrust second derivative, not the thrust.
+    output = control.copy()
+    output[0] = self.v1
+    return output
+
+  def fb_resp_output_batch(self, X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des, u_ilc, **kwargs):
+    rot, ang_world, z, z_dot, u, udot, jerk, snap, drag = self.feedback_terms_batch(X, Z, pos_des, vel_des, acc_des, jerk_des, snap_des)
+
+    v1 = row_dot(snap, z) + u[:, 0] * row_dot(z_dot, z_dot) + drag * row_dot(jerk, z) + u_ilc[..., 0]
+    ang_acc_body = self.get_ang_acc_body_batch(rot, ang_world, z, z_dot, jerk, snap, u, udot, drag) + u_ilc[..., 1:]
+    return np.hstack((v1[:, np.newaxis], ang_acc_body))
@@ -177,3 +177,26 @@ class Quad3DTV(Quad3D):
     u_ang_accel = -self.K_att.dot(rot_angvel) + angaccel_des
 
     return np.hstack((u_accel + u_ilc[0], u_ang_accel + u_ilc[1:]))
+
+  def feedback_batch(self, X, pos_des, vel_des, acc_des, angvel_des, angaccel_des, u_ilc, **kwargs):
+    rot = Rotation.from_euler('ZYX', X[:, 6:9][:, ::-1])
+    z = rot.as_matrix()[:, :, 2]
+
+    if self.model_drag:
+      drag_dist_control = self.drag_dist
+    else:
+      drag_dist_control = 0
+
+    # Position Control
+    pos_vel_error = X[:, :6] - np.hstack((pos_des, vel_des))
+    accel_des = -pos_vel_error.dot(self.K_pos.T) + acc_des + self.g_vec + drag_dist_control * X[:, 3:6]
+    z_des = accel_des / np.linalg.norm(accel_des, axis=1)[:, np.newaxis]
+
+    u_accel = self.U.u(accel_des, z)
+
+    # Attitude Control
+    rot_error_b = rot.inv().apply(np.cross(z_des, z))
+    angvel_error = X[:, 9:12] - angvel_des
+    u_ang_accel = -np.hstack((rot_error_b, angvel_error)).dot(self.K_att.T) + angaccel_des
+
+    return np.hstack(((u_accel + u_ilc[..., 0])[:, np.newaxis], u_ang_accel + u_ilc[..., 1:]))
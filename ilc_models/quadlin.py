@@ -13,6 +13,10 @@ class QuadLin(ILCBase):
   n_control = n_control_sys = 1
   n_out = 1
 
+  complex_step_feedback = True
+
+  state_columns = dict(pos=slice(0, 1), vel=slice(1, 2), rpy=slice(2, 3), omega=slice(3, 4))
+
   control_labels = sys_control_labels = ["Snap"]
 
   K_pos = np.array((6, 3))
@@ -38,25 +42,8 @@ class QuadLin(ILCBase):
 
     return A, B, C, D
 
-  def simulate(self, t_end, fun, dt):
-    pos, vel, acc, jerk = x = np.zeros(4)
-
-    xs = [x.copy()]
-
-    for i in range(int(round(t_end / dt))):
-      u_out = fun(x)
-
-      snap = u_out[0]
-
-      pos += vel * dt
-      vel += acc * dt
-      acc += jerk * dt
-      jerk += snap * dt
-
-      x = np.hstack((pos.copy(), vel.copy(), acc.copy(), jerk.copy()))
-      xs.append(x)
-
-    return np.array(xs)
+  def dynamics(self, X, U, dists):
+    return np.hstack((X[:, 1:4], U))
 
   def feedback(self, x, pos_des, vel_des, acc_des, angvel_des, angaccel_des, u_ilc, **kwargs):
     pos_vel = x[:2]
@@ -72,5 +59,20 @@ class QuadLin(ILCBase):
 
     return np.array((u_ang_accel,))
 
+  def feedback_batch(self, X, pos_des, vel_des, acc_des, angvel_des, angaccel_des, u_ilc, **kwargs):
+    """ feedback for the rows of X. The desired values and u_ilc are shared
+        or given per row. """
+    accel_des = -(X[:, :2] - np.hstack((pos_des, vel_des))).dot(self.K_pos) + np.reshape(acc_des, -1)
+    theta_des = accel_des
+
+    theta_err = X[:, 2] - theta_des
+    angvel_error = X[:, 3] - np.reshape(angvel_des, -1)
+    u_ang_accel = -self.K_att[0] * theta_err - self.K_att[1] * angvel_error + np.reshape(angaccel_des, -1) + np.reshape(u_ilc, -1)
+
+    return u_ang_accel[:, np.newaxis]
+
   def feedforward(self, pos, vel, acc, jerk, snap):
     return np.hstack((pos, vel, acc, jerk)), np.hstack((snap))
+
+  def feedforward_batch(self, pos, vel, acc, jerk, snap, ts):
+    return np.hstack((pos, vel, acc, jerk)), snap.copy()
@@ -0,0 +1,19 @@
+# Only the standard library here: workers set the BLAS threads before importing NumPy.
+
+# Thread count variables of the BLAS / OpenMP libraries NumPy may be linked against.
+blas_thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def blas_environment(n_threads):
+  return { name : str(n_threads) for name in blas_thread_vars }
+
+def memory_usage():
+  """ (Pss, private) bytes of this process, or None where /proc does not
+      tell. Pss splits the shared pages between the processes mapping them. """
+  try:
+    with open('/proc/self/smaps_rollup') as f:
+      fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+  except (OSError, ValueError):
+    return None
+
+  kb = lambda name: 1024 * int(fields.get(name, '0').split()[0])
+  return kb('Pss'), kb('Private_Clean') + kb('Private_Dirty')
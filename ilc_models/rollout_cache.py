@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+def content_key(*parts):
+  """ Hash of parts: arrays (by dtype, shape and contents), dicts
+      (by their sorted items) and anything else by repr """
+  h = hashlib.sha256()
+  for part in parts:
+    if isinstance(part, np.ndarray):
+      part = np.ascontiguousarray(part)
+      h.update(("array %s %s" % (part.dtype.str, part.shape)).encode())
+      h.update(part.tobytes())
+    elif isinstance(part, dict):
+      h.update(json.dumps(part, sort_keys=True, default=repr).encode())
+    else:
+      h.update(repr(part).encode())
+    h.update(b'|')
+
+  return h.hexdigest()
+
+class RolloutCache(object):
+  """ On-disk store of simulated trials (and linearizations) as .npz files
+      in directory, named by a hash of everything they depend on (see key).
+
+      Once the files take more than max_bytes, the least recently used
+      ones are removed. The hash does not cover the model code, so clear
+      the directory after changing a model.
+
+      Several caches (processes) can share directory: entries another
+      one removes count as misses, and temporary files of writes that
+      did not finish are removed once they are tmp_timeout seconds old. """
+  tmp_timeout = 3600.0
+
+  def __init__(self, directory, max_bytes):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+    os.makedirs(directory, exist_ok=True)
+
+  def key(self, *parts):
+    return content_key(*parts)
+
+  def path(self, key):
+    return os.path.join(self.directory, key + '.npz')
+
+  def get(self, key):
+    """ The arrays stored under key as a dict, or None """
+    path = self.path(key)
+    try:
+      with np.load(path, allow_pickle=False) as f:
+        entry = { name : f[name] for name in f.files }
+    except (OSError, ValueError, EOFError):
+      # Missing, or unreadable (e.g. a partial write); the latter is removed.
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      self.misses += 1
+      return None
+
+    # The modification time orders the entries for eviction.
+    try:
+      os.utime(path)
+    except OSError:
+      # Evicted by another cache since it was read
+      pass
+    self.hits += 1
+    return entry
+
+  def put(self, key, **arrays):
+    """ Stores arrays under key, then evicts down to max_bytes """
+    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+
+      os.replace(tmp_path, self.path(key))
+    except BaseException:
+      os.remove(tmp_path)
+      raise
+
+    self.evict()
+
+  def evict(self):
+    """ Removes the least recently used entries down to max_bytes, and
+        temporary files older than tmp_timeout """
+    now = time.time()
+    entries = []
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+        if name.endswith('.npz'):
+          entries.append((stat.st_mtime, stat.st_size, name))
+        elif name.endswith('.tmp') and now - stat.st_mtime > self.tmp_timeout:
+          os.remove(path)
+      except OSError:
+        # Removed (or renamed into place) by another cache
+        continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+      if total <= self.max_bytes:
+        break
+
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
+
+  def summary(self):
+    return "%d hits, %d misses" % (self.hits, self.misses)
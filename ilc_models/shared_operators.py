@@ -0,0 +1,67 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+class SharedOperators(object):
+  """ Learning operators (e.g. calCBpD and the cached pseudoinverse) of
+      the constant_ilc_mats models in multiprocessing.shared_memory blocks,
+      so that processes running the same model and ILC grid hold one copy.
+
+      The process that publishes the arrays owns the blocks. Others build
+      a SharedOperators from its registry (key : array name : (block name,
+      shape, dtype)) and get read-only views of the blocks, attached on
+      first use. put does nothing: runs only read them. """
+  def __init__(self, registry=None):
+    self.registry = {} if registry is None else registry
+    self.blocks = {}
+
+  def publish(self, key, arrays):
+    for name, array in arrays.items():
+      array = np.ascontiguousarray(array)
+      block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+      np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+
+      self.blocks[block.name] = block
+      self.registry.setdefault(key, {})[name] = (block.name, array.shape, array.dtype.str)
+
+  def get(self, key):
+    """ The arrays published under key as a dict of views, or None """
+    if key not in self.registry:
+      return None
+
+    entry = {}
+    for name, (block_name, shape, dtype) in self.registry[key].items():
+      if block_name not in self.blocks:
+        self.blocks[block_name] = shared_memory.SharedMemory(name=block_name)
+
+      view = np.ndarray(shape, dtype, buffer=self.blocks[block_name].buf)
+      view.flags.writeable = False
+      entry[name] = view
+
+    return entry
+
+  def put(self, key, **arrays):
+    pass
+
+  def nbytes(self):
+    return sum(block.size for block in self.blocks.values())
+
+  def close(self, unlink=False):
+    """ Detaches from the blocks. The publisher unlinks them once no one needs them anymore. """
+    for block in self.blocks.values():
+      block.close()
+      if unlink:
+        block.unlink()
+
+    self.blocks = {}
+
+class OperatorCollector(object):
+  """ Keeps the arrays a run puts (see SharedOperators), for publishing them elsewhere """
+  def __init__(self):
+    self.operators = {}
+
+  def get(self, key):
+    return None
+
+  def put(self, key, **arrays):
+    self.operators.setdefault(key, {}).update(arrays)
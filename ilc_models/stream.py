@@ -0,0 +1,177 @@
+import json
+
+import numpy as np
+
+def stream_chunks(records, chunk_size):
+  """ Groups the (t, x, u) records of simulate_stream into (ts, xs, us)
+      chunks of up to chunk_size rows. The chunk arrays are reused, so
+      they are only valid until the next chunk. The control of the final
+      record (None) is stored as NaNs. """
+  ts = xs = us = None
+  n = 0
+
+  for t, x, u in records:
+    if xs is None:
+      ts = np.zeros(chunk_size)
+      xs = np.zeros((chunk_size, len(x)))
+      us = np.full((chunk_size, len(u)), np.nan)
+
+    ts[n] = t
+    xs[n] = x
+    if u is None:
+      us[n] = np.nan
+    else:
+      us[n] = u
+
+    n += 1
+    if n == chunk_size:
+      yield ts, xs, us
+      n = 0
+
+  if n:
+    yield ts[:n], xs[:n], us[:n]
+
+def run_stream(chunks, sinks):
+  """ Feeds every chunk to every sink, then closes the sinks.
+      A sink has write(ts, xs, us), called with every (ts, xs, us) chunk
+      of stream_chunks in turn, and close(), called once at the end. """
+  for ts, xs, us in chunks:
+    for sink in sinks:
+      sink.write(ts, xs, us)
+
+  for sink in sinks:
+    sink.close()
+
+class BinaryAppender(object):
+  """ Writes the records to path chunk by chunk as rows (t, x, u) of
+      little endian float64. The row layout is written to path + '.json'
+      on close. """
+  def __init__(self, path):
+    self.path = path
+    self.f = open(path, 'wb')
+    self.n_state = self.n_control = None
+
+  def write(self, ts, xs, us):
+    self.n_state = xs.shape[1]
+    self.n_control = us.shape[1]
+    self.f.write(np.hstack((ts[:, np.newaxis], xs, us)).astype('<f8').tobytes())
+
+  def close(self):
+    self.f.close()
+    with open(self.path + '.json', 'w') as f:
+      json.dump(dict(n_state=self.n_state, n_control=self.n_control), f)
+
+def load_binary(path):
+  """ Reads a BinaryAppender file back as (ts, xs, us) """
+  with open(path + '.json') as f:
+    layout = json.load(f)
+
+  rows = np.fromfile(path, dtype='<f8').reshape((-1, 1 + layout['n_state'] + layout['n_control']))
+  return rows[:, 0], rows[:, 1 : 1 + layout['n_state']], rows[:, 1 + layout['n_state']:]
+
+class Decimator(object):
+  """ Forwards every factor-th record to sink """
+  def __init__(self, sink, factor):
+    self.sink = sink
+    self.factor = factor
+    self.n = 0
+
+  def write(self, ts, xs, us):
+    first = -self.n % self.factor
+    self.n += len(ts)
+    if first < len(ts):
+      self.sink.write(ts[first::self.factor], xs[first::self.factor], us[first::self.factor])
+
+  def close(self):
+    self.sink.close()
+
+class ColumnRecorder(object):
+  """ Keeps only the state columns cols (e.g. Trajectory columns) of the
+      N + 1 records. Rows not written (e.g. after a divergence) are NaN. """
+  def __init__(self, N, cols):
+    self.cols = cols
+    self.data = None
+    self.N = N
+    self.n = 0
+
+  def write(self, ts, xs, us):
+    values = xs[:, self.cols]
+    if self.data is None:
+      self.data = np.full((self.N + 1, values.shape[1]), np.nan)
+
+    self.data[self.n : self.n + len(ts)] = values
+    self.n += len(ts)
+
+  def close(self):
+    pass
+
+class Resampler(object):
+  """ Keeps only the states at the times new_ts, linearly interpolated
+      from the records at the times ts (the same values as scipy's
+      interp1d). Each is computed once the two records around it pass. """
+  def __init__(self, ts, new_ts):
+    self.new_ts = new_ts
+    self.hi = np.clip(np.searchsorted(ts, new_ts), 1, len(ts) - 1)
+    self.ts_lo = ts[self.hi - 1]
+    self.ts_hi = ts[self.hi]
+    self.data = None
+    self.n = 0
+
+  def write(self, ts, xs, us):
+    if self.data is None:
+      self.data = np.full((len(self.new_ts), xs.shape[1]), np.nan)
+
+    end = self.n + len(ts)
+
+    # Keep the record before every time, then interpolate at the one after it.
+    lo = np.flatnonzero((self.hi - 1 >= self.n) & (self.hi - 1 < end))
+    self.data[lo] = xs[self.hi[lo] - 1 - self.n]
+
+    hi = np.flatnonzero((self.hi >= self.n) & (self.hi < end))
+    y_lo = self.data[hi]
+    slope = (xs[self.hi[hi] - self.n] - y_lo) / (self.ts_hi[hi] - self.ts_lo[hi])[:, np.newaxis]
+    self.data[hi] = slope * (self.new_ts[hi] - self.ts_lo[hi])[:, np.newaxis] + y_lo
+
+    self.n = end
+
+  def close(self):
+    pass
+
+class RunningErrorStats(object):
+  """ Running mean and max of the position error norm and of the
+      per axis absolute position errors, against the desired positions
+      poss_des of every record. """
+  def __init__(self, poss_des, pos_cols):
+    self.poss_des = poss_des
+    self.pos_cols = pos_cols
+    self.n = 0
+
+    n_axes = poss_des.shape[1]
+    self.sum_norm = 0.0
+    self.max_norm = 0.0
+    self.sum_abs = np.zeros(n_axes)
+    self.max_abs = np.zeros(n_axes)
+
+  def write(self, ts, xs, us):
+    errors = xs[:, self.pos_cols] - self.poss_des[self.n : self.n + len(ts)]
+    self.n += len(ts)
+
+    norms = np.linalg.norm(errors, axis=1)
+    self.sum_norm += norms.sum()
+    self.max_norm = max(self.max_norm, norms.max())
+
+    abs_errors = np.abs(errors)
+    self.sum_abs += abs_errors.sum(axis=0)
+    self.max_abs = np.maximum(self.max_abs, abs_errors.max(axis=0))
+
+  def close(self):
+    pass
+
+  @property
+  def mean_norm(self):
+    """ NaN before any records """
+    return self.sum_norm / self.n if self.n else np.nan
+
+  @property
+  def mean_abs(self):
+    return self.sum_abs / self.n if self.n else np.full(len(self.sum_abs), np.nan)
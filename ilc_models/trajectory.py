@@ -0,0 +1,55 @@
+import numpy as np
+
+class Trajectory(object):
+  """ Preallocated state history filled in by simulate.
+
+      data is an (N + 1, n_state) array, or (M, N + 1, n_state) for
+      simulate_batch. The pos, vel, rpy, omega and aux attributes are
+      zero-copy column views of data as given by the model's
+      state_columns. Columns a model does not have are None.
+
+      n is the no. of recorded states. If a DivergenceMonitor ended the
+      simulation early, the remaining rows are NaN and diverged holds
+      its reason.
+  """
+  names = ('pos', 'vel', 'rpy', 'omega', 'aux')
+
+  def __init__(self, N, n_state, columns, batch_shape=()):
+    self.data = np.zeros(tuple(batch_shape) + (N + 1, n_state))
+    self.columns = columns
+    self.n = N + 1
+    self.diverged = None
+
+    for name in self.names:
+      setattr(self, name, self.data[..., columns[name]] if name in columns else None)
+
+class StateLog(object):
+  """ Per step log of a controller's internal state (e.g. the thrust
+      integrators) in an array preallocated for the steps of a simulation
+      (see reserve). Indexing and len only see the logged rows. """
+  def __init__(self, n_state, n_rows=0):
+    self.data = np.zeros((n_rows, n_state))
+    self.n = 0
+
+  def reserve(self, n_rows):
+    """ Makes room for n_rows more rows, one per step of the simulation about to start """
+    if self.n + n_rows > len(self.data):
+      data = np.zeros((self.n + n_rows, self.data.shape[1]))
+      data[:self.n] = self.data[:self.n]
+      self.data = data
+
+  def append(self, *values):
+    self.data[self.n] = values
+    self.n += 1
+
+  def __len__(self):
+    return self.n
+
+  def __getitem__(self, ind):
+    return self.data[:self.n][ind]
+
+  def load(self, rows):
+    """ Replaces the log with the (n, n_state) rows """
+    self.data = np.zeros((len(rows), self.data.shape[1]))
+    self.data[:len(rows)] = rows
+    self.n = len(rows)
@@ -45,6 +45,10 @@ class Trivial(ILCBase):
   n_control = n_control_sys = 1
   n_out = 1
 
+  complex_step_feedback = True
+
+  state_columns = dict(pos=slice(0, 1))
+
   control_labels = sys_control_labels = ["Vel"]
 
   k_pos = 100
@@ -71,15 +75,11 @@ class Trivial(ILCBase):
 
     return A, B, C, D
 
-  def simulate(self, t_end, fun, dt):
-    vel = x = np.zeros(1)
-    xs = [x.copy()]
-    for i in range(int(round(t_end / dt))):
-      acc = fun(x)
-      vel += acc * dt
-      x = vel.copy()
-      xs.append(x)
-    return np.array(xs)
+  def dynamics(self, X, U, dists):
+    return U.copy()
 
   def feedback(self, x, pos_des, u_ilc, **kwargs):
     return np.array( -self.k_pos * (x - 0) + u_ilc,)
+
+  def feedback_batch(self, X, pos_des, u_ilc, **kwargs):
+    return -self.k_pos * X + u_ilc
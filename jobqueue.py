@@ -0,0 +1,346 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# Only the standard library at the top: a worker sets its BLAS threads
+# before importing the experiment code (and with it NumPy).
+from ilc_models.resources import blas_environment
+
+states = ('pending', 'running', 'done', 'failed', 'workers')
+
+class JobQueue(object):
+  """ Queue of ilc.py experiments in a directory, which can be shared by
+      several hosts (e.g. over NFS). Every job is a JSON file that moves
+      from pending/ to running/ (claimed by an atomic rename) and then to
+      done/ with its results row, or failed/ after max_attempts attempts.
+      A claim stores a token in the running file, and only the holder of
+      that token moves the job on from running/.
+
+      Workers touch the file of the job they run every heartbeat seconds,
+      and their own file in workers/. A running job whose file is older
+      than timeout seconds lost its worker and goes back to pending/ (any
+      worker or waiting client does this when polling). """
+  def __init__(self, directory, timeout=60.0):
+    self.directory = directory
+    self.timeout = timeout
+
+    for state in states:
+      os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+  def path(self, state, name):
+    return os.path.join(self.directory, state, name + '.json')
+
+  def write(self, state, name, data):
+    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f)
+
+    os.replace(tmp_path, self.path(state, name))
+
+  def read(self, state, name):
+    try:
+      with open(self.path(state, name)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def names(self, state):
+    return sorted(name[:-5] for name in os.listdir(os.path.join(self.directory, state)) if name.endswith('.json'))
+
+  def counts(self):
+    return { state : len(self.names(state)) for state in states }
+
+  def submit(self, jobs, max_attempts):
+    """ Adds the (id, config, argv, ...) jobs of sweep.get_jobs not already
+        queued or done. Returns the no. of jobs added. """
+    queued = set()
+    for state in ('pending', 'running', 'done'):
+      queued.update(self.names(state))
+
+    n = 0
+    for job in jobs:
+      if job[0] not in queued:
+        self.write('pending', job[0], dict(id=job[0], config=job[1], argv=job[2], attempts=0, max_attempts=max_attempts))
+        n += 1
+
+    return n
+
+  def claim(self, worker=None):
+    """ Moves the first pending job to running/, marks it as claimed by
+        worker and returns it (with its claim token), or None """
+    for name in self.names('pending'):
+      try:
+        # The rename keeps the modification time, which is the first heartbeat.
+        os.utime(self.path('pending', name))
+        os.rename(self.path('pending', name), self.path('running', name))
+      except OSError:
+        # Claimed by another worker
+        continue
+
+      if os.path.exists(self.path('done', name)):
+        # Rerun of a requeued job that finished after all
+        os.remove(self.path('running', name))
+        continue
+
+      job = self.read('running', name)
+      if job is None:
+        # Requeued (and claimed again) in the meantime
+        continue
+
+      job.update(claim=uuid.uuid4().hex, worker=worker)
+      self.write('running', name, job)
+      return job
+
+    return None
+
+  def release(self, name, claim):
+    """ Removes running/name if it still holds claim. Returns whether it did. """
+    job = self.read('running', name)
+    if job is None or job.get('claim') != claim:
+      return False
+
+    try:
+      os.remove(self.path('running', name))
+    except OSError:
+      return False
+
+    return True
+
+  def heartbeat(self, name):
+    try:
+      os.utime(self.path('running', name))
+    except OSError:
+      pass
+
+  def finish(self, job, row):
+    """ Stores the row of a job, or queues the job again if it failed
+        (status error) and has attempts left. If the job was requeued
+        since its claim, only a row without error is stored and the
+        running file (of its new claimant) is left alone. """
+    claim = job['claim']
+    running = self.read('running', job['id'])
+    claimed = running is not None and running.get('claim') == claim
+    if not claimed and row['status'] == 'error':
+      return
+
+    job = { key : value for key, value in job.items() if key not in ('claim', 'worker') }
+    job['attempts'] += 1
+    if row['status'] == 'error' and job['attempts'] < job['max_attempts']:
+      job['last_error'] = row['error']
+      self.write('pending', job['id'], job)
+    else:
+      self.write('done' if row['status'] != 'error' else 'failed', job['id'], dict(job, row=row))
+
+    if claimed:
+      self.release(job['id'], claim)
+
+  def requeue_stale(self):
+    """ Returns running jobs without a heartbeat for timeout seconds to
+        pending/ (failed/ after max_attempts). Returns their no. """
+    n = 0
+    now = time.time()
+    for name in self.names('running'):
+      try:
+        stale = now - os.stat(self.path('running', name)).st_mtime > self.timeout
+      except OSError:
+        continue
+
+      job = self.read('running', name) if stale else None
+      if job is None:
+        continue
+
+      claim = job.pop('claim', None)
+      job.pop('worker', None)
+      job['attempts'] += 1
+      job['last_error'] = "worker lost (no heartbeat for %g s)" % self.timeout
+      if job['attempts'] < job['max_attempts']:
+        self.write('pending', name, job)
+      else:
+        self.write('failed', name, dict(job, row=dict(id=name, status='error', error=job['last_error'], **job['config'])))
+
+      self.release(name, claim)
+      n += 1
+
+    return n
+
+def work(queue, name, heartbeat, poll, exit_when_empty):
+  """ Warm worker: imports the experiment code once, then runs the jobs it
+      claims in this process until the queue is empty (exit_when_empty)
+      or forever """
+  from sweep import run_config
+
+  current = [None]
+  stop = threading.Event()
+  info = dict(host=socket.gethostname(), pid=os.getpid(), started=time.time(), jobs=0)
+
+  def beat():
+    while not stop.wait(heartbeat):
+      if current[0] is not None:
+        queue.heartbeat(current[0])
+      queue.write('workers', name, dict(info, beat=time.time(), job=current[0]))
+
+  queue.write('workers', name, dict(info, beat=time.time(), job=None))
+  beat_thread = threading.Thread(target=beat, daemon=True)
+  beat_thread.start()
+
+  try:
+    while True:
+      queue.requeue_stale()
+      job = queue.claim(name)
+      if job is None:
+        counts = queue.counts()
+        if exit_when_empty and not counts['pending'] and not counts['running']:
+          break
+
+        time.sleep(poll)
+        continue
+
+      current[0] = job['id']
+      row = run_config(job['argv'], job['id'])
+      row['id'] = job['id']
+      row.update(job['config'])
+      queue.finish(job, row)
+      current[0] = None
+
+      info['jobs'] += 1
+      print("%s: %s %s (%.1f s)" % (name, job['id'], row['status'], row['time']))
+      sys.stdout.flush()
+
+  finally:
+    stop.set()
+    beat_thread.join()
+    os.remove(queue.path('workers', name))
+
+def collect(queue, out):
+  """ Writes the rows of the done and failed jobs that out does not have yet
+      to the results table out. Returns the no. of rows written. """
+  from sweep import ResultsTable
+
+  jobs = [queue.read(state, name) for state in ('done', 'failed') for name in queue.names(state)]
+  jobs = [job for job in jobs if job is not None]
+
+  param_names = []
+  for job in jobs:
+    param_names += [name for name in job['config'] if name not in param_names]
+
+  # A failed job is written once, and not at all once it is done.
+  done = set(queue.names('done'))
+
+  table = ResultsTable(out, param_names)
+  n = 0
+  for job in jobs:
+    if job['row']['status'] == 'error':
+      skip = job['id'] in table.ids or job['id'] in done
+    else:
+      skip = job['id'] in table.completed
+
+    if not skip:
+      table.write(job['row'])
+      n += 1
+
+  table.close()
+  return n
+
+def print_status(queue):
+  counts = queue.counts()
+  print(', '.join("%d %s" % (counts[state], state) for state in states[:-1]))
+
+  now = time.time()
+  for name in queue.names('workers'):
+    worker = queue.read('workers', name)
+    if worker is not None:
+      age = now - worker['beat']
+      print("  %s on %s (pid %d): %d jobs, last heartbeat %.1f s ago%s" % (name, worker['host'], worker['pid'], worker['jobs'], age, " (lost)" if age > queue.timeout else ", running %s" % worker['job'] if worker['job'] else ""))
+
+def submit(queue, args, base_argv):
+  from sweep import get_jobs, load_manifest, parse_grid
+
+  configs = parse_grid(args.grid)
+  if args.manifest is not None:
+    configs = [dict(m, **g) for m in load_manifest(args.manifest) for g in configs]
+
+  jobs = get_jobs(base_argv, configs)
+  n = queue.submit(jobs, args.max_attempts)
+  print("Submitted %d of %d configurations to %s" % (n, len(jobs), queue.directory))
+
+def get_jobqueue_parser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, allow_abbrev=False,
+    description="Job queue of ilc.py experiments in a shared directory, run by long-lived worker processes on one or several hosts.")
+  parser.add_argument("queue", type=str, help="Queue directory (shared between the hosts).")
+  parser.add_argument("--timeout", default=60.0, type=float, help="Seconds without a heartbeat after which a running job is given to another worker.")
+
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  def add_submit_args(command):
+    command.add_argument("--grid", default=[], nargs='+', type=str, help="Parameters to sweep, as name=v1,v2,... (see sweep.py).")
+    command.add_argument("--manifest", default=None, type=str, help="File of configurations, one JSON object of option values per line (see sweep.py).")
+    command.add_argument("--max-attempts", default=3, type=int, help="No. of times a job is tried before it is failed.")
+
+  def add_worker_args(command):
+    command.add_argument("--blas-threads", default=1, type=int, help="No. of BLAS threads per worker.")
+    command.add_argument("--heartbeat", default=5.0, type=float, help="Seconds between heartbeats.")
+    command.add_argument("--poll", default=1.0, type=float, help="Seconds between looks at an empty queue.")
+
+  submit_parser = commands.add_parser('submit', allow_abbrev=False, help="Queue experiments. Arguments not listed are passed to every run (e.g. --system 3d --fb --ff).")
+  add_submit_args(submit_parser)
+
+  worker_parser = commands.add_parser('worker', allow_abbrev=False, help="Run queued experiments.")
+  add_worker_args(worker_parser)
+  worker_parser.add_argument("--name", default=None, type=str, help="Worker name (host-pid by default).")
+  worker_parser.add_argument("--exit-when-empty", default=False, action='store_true', help="Stop once no jobs are pending or running instead of waiting for more.")
+
+  collect_parser = commands.add_parser('collect', allow_abbrev=False, help="Write the finished jobs to a results table.")
+  collect_parser.add_argument("--out", default="sweep.csv", type=str, help="Results table (see sweep.py).")
+
+  commands.add_parser('status', allow_abbrev=False, help="Print the no. of jobs per state and the workers.")
+
+  local_parser = commands.add_parser('local', allow_abbrev=False, help="Single machine stand-in: queue experiments, run them on local workers and collect the results.")
+  add_submit_args(local_parser)
+  add_worker_args(local_parser)
+  local_parser.add_argument("--workers", default=os.cpu_count(), type=int, help="No. of local worker processes.")
+  local_parser.add_argument("--out", default="sweep.csv", type=str, help="Results table (see sweep.py).")
+
+  return parser
+
+if __name__ == "__main__":
+  args, base_argv = get_jobqueue_parser().parse_known_args()
+  queue = JobQueue(args.queue, args.timeout)
+
+  if args.command == 'submit':
+    submit(queue, args, base_argv)
+
+  elif args.command == 'worker':
+    os.environ.update(blas_environment(args.blas_threads))
+    os.environ['MPLBACKEND'] = 'Agg'
+    name = args.name or "%s-%d" % (socket.gethostname(), os.getpid())
+    work(queue, name, args.heartbeat, args.poll, args.exit_when_empty)
+
+  elif args.command == 'collect':
+    print("Wrote %d rows to %s" % (collect(queue, args.out), args.out))
+
+  elif args.command == 'status':
+    print_status(queue)
+
+  elif args.command == 'local':
+    submit(queue, args, base_argv)
+
+    worker_argv = [sys.executable, os.path.abspath(__file__), args.queue, '--timeout', str(args.timeout), 'worker', '--exit-when-empty',
+                   '--blas-threads', str(args.blas_threads), '--heartbeat', str(args.heartbeat), '--poll', str(args.poll)]
+    workers = [subprocess.Popen(worker_argv + ['--name', "local-%d" % i]) for i in range(args.workers)]
+
+    start = time.perf_counter()
+    for worker in workers:
+      worker.wait()
+
+    print_status(queue)
+    print("Wrote %d rows to %s (%f s)" % (collect(queue, args.out), args.out, time.perf_counter() - start))
@@ -0,0 +1,163 @@
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from ilc import get_parser, system_map
+from sweep import ResultsTable, get_jobs, option_action, run_jobs
+
+# Options with one value per axis.
+vector_options = ('init_pos_offset', 'init_vel_offset')
+
+def parse_distribution(spec):
+  """ name=kind:p1[:p2] as (name, kind, params) """
+  name, _, dist = spec.partition('=')
+  kind, _, params = dist.partition(':')
+  params = [float(p) for p in params.split(':')] if params else []
+
+  n_params = dict(uniform=2, normal=2, lognormal=2, sphere=1)
+  assert n_params.get(kind) == len(params), "Distribution %s is not one of uniform:low:high, normal:mean:std, lognormal:mean:sigma or sphere:radius" % dist
+  name = name.lstrip('-').replace('-', '_')
+  option_action(name)
+  return name, kind, params
+
+def draw(rng, kind, params, size):
+  """ size values from a distribution of parse_distribution. sphere draws
+      a vector of the given length in a uniformly random direction. """
+  if kind == 'sphere':
+    vec = rng.standard_normal(size)
+    return params[0] * vec / np.linalg.norm(vec)
+
+  return getattr(rng, kind)(*params, size=size)
+
+def option_value(name, value):
+  """ A drawn value as the type of the ilc.py option name (integer
+      options are rounded) """
+  option_type = option_action(name).type
+  if option_type is int:
+    return int(round(value))
+
+  return option_type(value) if option_type is not None else float(value)
+
+def get_samples(distributions, n_samples, seed, dims):
+  """ Option values of every sample. Sample k draws from its own stream,
+      seeded by (seed, k), so it does not depend on the other samples. """
+  samples = []
+  for k in range(n_samples):
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(k,)))
+
+    sample = {}
+    for name, kind, params in distributions:
+      if name in vector_options:
+        sample[name] = [option_value(name, v) for v in draw(rng, kind, params, dims)]
+      else:
+        sample[name] = option_value(name, draw(rng, kind, params, 1)[0])
+
+    samples.append(sample)
+
+  return samples
+
+class ErrorStats(object):
+  """ Running reduction of results rows: run and divergence counts and the
+      avg. pos errors of every trial (only these scalars are kept). Errors
+      of a run that diverged count for the trials up to the divergence. """
+  def __init__(self):
+    self.n = 0
+    self.n_diverged = 0
+    self.n_failed = 0
+    self.final_errors = []
+    self.trial_errors = []
+
+  def add(self, row):
+    if row['status'] == 'error':
+      self.n_failed += 1
+      return
+
+    self.n += 1
+    errors = [float(e) for e in row['avg_pos_errors'].split()]
+    if row['status'] == 'diverged':
+      self.n_diverged += 1
+    else:
+      self.final_errors.append(errors[-1])
+
+    for i, error in enumerate(errors):
+      if i == len(self.trial_errors):
+        self.trial_errors.append([])
+      self.trial_errors[i].append(error)
+
+  @property
+  def divergence_rate(self):
+    return self.n_diverged / max(self.n, 1)
+
+  def report(self, percentiles):
+    """ Lines of a table of the error percentiles per trial and of the final trial """
+    header = "%-8s %6s " % ("Trial", "Runs") + ' '.join("%10s" % ("p%g" % q) for q in percentiles)
+    lines = [header]
+
+    def line(label, errors):
+      return "%-8s %6d " % (label, len(errors)) + ' '.join("%10.3g" % p for p in np.percentile(errors, percentiles))
+
+    for i, errors in enumerate(self.trial_errors):
+      lines.append(line("%d" % (i + 1), errors))
+
+    if self.final_errors:
+      lines.append(line("Final", self.final_errors))
+
+    return lines
+
+def get_montecarlo_parser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, allow_abbrev=False,
+    description="Runs the full ILC experiment for random initial conditions and disturbances on a process pool and reports error statistics. Arguments not listed here are passed to every run (e.g. --system 3d --fb --ff).")
+  parser.add_argument("--sample", default=[], nargs='+', type=str, help="Distributions of ilc.py options, as name=uniform:low:high, normal:mean:std, lognormal:mean:sigma or sphere:radius (per axis options only), e.g. thrust_dist=uniform:0.8:1.2 init_pos_offset=sphere:0.02.")
+  parser.add_argument("--samples", default=100, type=int, help="No. of samples.")
+  parser.add_argument("--seed", default=0, type=int, help="Seed of the sampled values.")
+  parser.add_argument("--percentiles", default=[5, 25, 50, 75, 95], nargs='+', type=float, help="Error percentiles to report.")
+  parser.add_argument("--out", default="montecarlo.csv", type=str, help="Results table with a row per sample. Samples it already holds are not rerun.")
+  parser.add_argument("--workers", default=multiprocessing.cpu_count(), type=int, help="No. of worker processes.")
+  parser.add_argument("--blas-threads", default=1, type=int, help="No. of BLAS threads per worker.")
+  parser.add_argument("--share-operators", default=False, action='store_true', help="Compute the learning operators of constant_ilc_mats systems (3ddedis, 2ddedis) once and share them between the workers through shared memory.")
+  return parser
+
+if __name__ == "__main__":
+  args, base_argv = get_montecarlo_parser().parse_known_args()
+
+  distributions = [parse_distribution(spec) for spec in args.sample]
+  dims = system_map[get_parser().parse_args(base_argv).system][1]
+
+  samples = get_samples(distributions, args.samples, args.seed, dims)
+  param_names = [name for name, _, _ in distributions]
+
+  jobs = get_jobs(base_argv, samples)
+  table = ResultsTable(args.out, param_names)
+  todo = [job for job in jobs if job[0] not in table.completed]
+
+  print("%d samples, %d already in %s" % (len(jobs), len(jobs) - len(todo), args.out))
+
+  stats = ErrorStats()
+  for job in jobs:
+    if job[0] in table.completed:
+      stats.add(table.completed[job[0]])
+
+  def describe(row):
+    if row['status'] == 'error':
+      return "error: %s" % row['error']
+
+    return "%s, avg. pos error %g (%.1f s)" % (row['status'], row['avg_pos_error'], row['time'])
+
+  mc_start = time.perf_counter()
+  for row in run_jobs(todo, table, args.workers, args.blas_threads, describe, args.share_operators):
+    stats.add(row)
+  table.close()
+
+  print("============")
+  print("%d samples (%f s)" % (len(jobs), time.perf_counter() - mc_start))
+  print("============")
+  print("Avg. pos error percentiles:")
+  for line in stats.report(args.percentiles):
+    print(line)
+  print("Divergence rate: %g (%d of %d)" % (stats.divergence_rate, stats.n_diverged, stats.n))
+  if stats.n_failed:
+    print("Failed runs:", stats.n_failed)
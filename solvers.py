@@ -0,0 +1,177 @@
+import time
+
+import numpy as np
+
+from scipy.sparse.linalg import LinearOperator, aslinearoperator
+
+def anytime_lsqr(A, b, deadline=None, atol=1e-8, btol=1e-8, iter_lim=None):
+  """ Solves min || Ax - b || using LSQR (Paige and Saunders 1982).
+
+      The clock is checked after every iteration and the current iterate
+      is returned once time.perf_counter() passes deadline. The LSQR
+      residual norm is non-increasing, so the current iterate is also
+      the best one found so far.
+
+      A can be a dense matrix or a scipy LinearOperator.
+
+      Returns (x, residual norm, converged, no. of iterations)
+  """
+  A = aslinearoperator(A)
+  m, n = A.shape
+
+  if iter_lim is None:
+    iter_lim = 2 * n
+
+  x = np.zeros(n)
+
+  u = np.array(b, dtype=float)
+  beta = bnorm = np.linalg.norm(u)
+  if beta == 0:
+    return x, 0.0, True, 0
+
+  u /= beta
+  v = A.rmatvec(u)
+  alpha = np.linalg.norm(v)
+  if alpha == 0:
+    return x, beta, True, 0
+
+  v /= alpha
+  w = v.copy()
+
+  phibar = beta
+  rhobar = alpha
+  anorm = 0.0
+
+  rnorm = beta
+  converged = False
+
+  itn = 0
+  while itn < iter_lim:
+    itn += 1
+
+    # Golub-Kahan bidiagonalization step.
+    u = A.matvec(v) - alpha * u
+    beta = np.linalg.norm(u)
+    if beta > 0:
+      u /= beta
+
+    anorm = np.sqrt(anorm ** 2 + alpha ** 2 + beta ** 2)
+
+    v = A.rmatvec(u) - beta * v
+    alpha = np.linalg.norm(v)
+    if alpha > 0:
+      v /= alpha
+
+    # Plane rotation to eliminate the subdiagonal.
+    rho = np.hypot(rhobar, beta)
+    c = rhobar / rho
+    s = beta / rho
+    theta = s * alpha
+    rhobar = -c * alpha
+    phi = c * phibar
+    phibar = s * phibar
+
+    x += (phi / rho) * w
+    w = v - (theta / rho) * w
+
+    rnorm = phibar
+    arnorm = alpha * abs(c * phibar)
+
+    # Compatible systems converge on the residual, least squares
+    # systems (e.g. with the control norm rows) on the normal equations.
+    if rnorm <= btol * bnorm + atol * anorm * np.linalg.norm(x) or arnorm <= atol * anorm * rnorm:
+      converged = True
+      break
+
+    if deadline is not None and time.perf_counter() > deadline:
+      break
+
+  return x, rnorm, converged, itn
+
+def dual_lstsq(P, e, weights):
+  """ Solves min || Pu + e ||^2 + || Wu ||^2 with W = diag(weights) in its
+      dual form, u = -W^-2 P^T (P W^-2 P^T + I)^-1 e, which only needs a
+      square solve the size of e (fewer rows than columns, e.g. the
+      constrained outputs of point-to-point ILC). """
+  winv2 = 1.0 / weights ** 2
+  dual_mat = P.dot(winv2[:, np.newaxis] * P.T) + np.eye(len(e))
+  return -winv2 * P.T.dot(np.linalg.solve(dual_mat, e))
+
+def lifted_matvec(As, Bs, Cs, u):
+  """ Computes calCBpD u by a forward recursion through the per step
+      linearization, without forming calCBpD. """
+  N = len(As) - 1
+  n_control = Bs[0].shape[1]
+  us = u.reshape((N, n_control))
+
+  ys = []
+  x = Bs[0].dot(us[0])
+  ys.append(Cs[1].dot(x))
+  for k in range(1, N):
+    x = As[k].dot(x) + Bs[k].dot(us[k])
+    ys.append(Cs[k + 1].dot(x))
+
+  return np.hstack(ys)
+
+def lifted_rmatvec(As, Bs, Cs, e):
+  """ Computes calCBpD^T e by a backward (adjoint) recursion through the
+      per step linearization, without forming calCBpD. """
+  N = len(As) - 1
+  n_out = Cs[0].shape[0]
+  es = e.reshape((N, n_out))
+
+  us = [None] * N
+  lam = Cs[N].T.dot(es[N - 1])
+  us[N - 1] = Bs[N - 1].T.dot(lam)
+  for k in range(N - 2, -1, -1):
+    lam = Cs[k + 1].T.dot(es[k]) + As[k + 1].T.dot(lam)
+    us[k] = Bs[k].T.dot(lam)
+
+  return np.hstack(us)
+
+def lifted_operator(As, Bs, Cs, output_inds=None):
+  """ calCBpD as a LinearOperator with O(N) matvec and rmatvec
+
+      output_inds optionally restricts the operator to the outputs
+      of the given ILC steps (point-to-point ILC).
+  """
+  N = len(As) - 1
+  n_out = Cs[0].shape[0]
+  n_control = Bs[0].shape[1]
+
+  if output_inds is None:
+    output_inds = np.arange(N)
+
+  def matvec(u):
+    ys = lifted_matvec(As, Bs, Cs, np.ravel(u)).reshape((N, n_out))
+    return ys[output_inds].ravel()
+
+  def rmatvec(e):
+    es = np.zeros((N, n_out))
+    es[output_inds] = np.reshape(e, (len(output_inds), n_out))
+    return lifted_rmatvec(As, Bs, Cs, es.ravel())
+
+  return LinearOperator((len(output_inds) * n_out, N * n_control), matvec=matvec, rmatvec=rmatvec, dtype=float)
+
+def operator_norm(A, iters=30, rtol=1e-3, seed=0):
+  """ Estimates the largest singular value of A using power iteration on A^T A """
+  A = aslinearoperator(A)
+
+  v = np.random.RandomState(seed).normal(size=A.shape[1])
+  v /= np.linalg.norm(v)
+
+  sigma = 0.0
+  for _ in range(iters):
+    w = A.rmatvec(A.matvec(v))
+    wnorm = np.linalg.norm(w)
+    if wnorm == 0:
+      return 0.0
+
+    last_sigma = sigma
+    sigma = np.sqrt(wnorm)
+    v = w / wnorm
+
+    if abs(sigma - last_sigma) <= rtol * sigma:
+      break
+
+  return sigma
@@ -0,0 +1,302 @@
+from __future__ import print_function
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from ilc import ILCExperiment, constant_operator_args, get_parser, system_map
+from ilc_models.resources import blas_environment, memory_usage
+from ilc_models.rollout_cache import content_key
+from ilc_models.shared_operators import OperatorCollector, SharedOperators
+
+# Columns of the results table after the swept parameters.
+result_columns = ['status', 'trials_run', 'avg_pos_error', 'max_pos_error', 'avg_pos_errors', 'diverged', 'time', 'error']
+
+# Options runs of a constant_ilc_mats model must agree on to share its learning operators.
+operator_group_args = constant_operator_args + ('sim_dt', 'ilc_dt', 'ilc_dt_start', 'refine_every', 'ilc_grid', 'ilc_grid_floor', 'traj_duration', 'rest_time', 'p2p_times')
+
+# SharedOperators of a worker, kept between its runs.
+worker_operators = SharedOperators()
+
+def option_args(name, value):
+  """ ilc.py arguments setting the option name (dest or flag form) to value.
+      True turns a flag on, False or None leaves the option out. """
+  flag = '--' + name.lstrip('-').replace('_', '-')
+  if value is True:
+    return [flag]
+  if value is False or value is None:
+    return []
+  if isinstance(value, (list, tuple)):
+    return [flag] + [str(v) for v in value]
+
+  return [flag, str(value)]
+
+def option_action(name):
+  """ The argparse action of the ilc.py option name (see option_args) """
+  flag = option_args(name, True)[0]
+  action = get_parser()._option_string_actions.get(flag)
+  assert action is not None, "ilc.py has no option %s" % flag
+  return action
+
+def parse_grid(specs):
+  """ Parameter grid from name=v1,v2,... specs as a list of dicts
+      (the Cartesian product, last name varying fastest). Values of flags
+      (e.g. fb=true,false) are booleans. """
+  names = []
+  values = []
+  for spec in specs:
+    name, _, vals = spec.partition('=')
+    assert vals, "Grid spec %s is not of the form name=v1,v2,..." % spec
+    name = name.lstrip('-').replace('-', '_')
+    vals = vals.split(',')
+
+    if option_action(name).nargs == 0:
+      assert all(v.lower() in ('true', 'false') for v in vals), "Grid spec %s: %s is a flag, its values are true or false" % (spec, name)
+      vals = [v.lower() == 'true' for v in vals]
+
+    names.append(name)
+    values.append(vals)
+
+  return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+def load_manifest(path):
+  """ Configurations from a file of one JSON object (option name : value,
+      see option_args) per line. Blank lines and # comments are skipped. """
+  configs = []
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        config = { name.lstrip('-').replace('-', '_') : value for name, value in json.loads(line).items() }
+        for name in config:
+          option_action(name)
+        configs.append(config)
+
+  return configs
+
+def config_argv(base_argv, config):
+  argv = list(base_argv)
+  for name, value in config.items():
+    argv += option_args(name, value)
+
+  return argv
+
+def config_id(argv):
+  """ Short hash of the options argv resolves to, so that the same
+      configuration has the same id however it is spelled """
+  options = vars(get_parser().parse_args(argv))
+  options.pop('no_stdout')
+  return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+def summarize(experiment):
+  """ Result columns of a finished ILCExperiment """
+  return dict(
+    status='ok' if experiment.diverged is None else 'diverged',
+    trials_run=len(experiment.avg_pos_errors),
+    avg_pos_error=experiment.avg_pos_errors[-1],
+    max_pos_error=experiment.max_pos_errors[-1],
+    avg_pos_errors=' '.join(repr(float(e)) for e in experiment.avg_pos_errors),
+    diverged='' if experiment.diverged is None else "%d %f %s" % experiment.diverged,
+  )
+
+def run_config(argv, run_id, shared_operators=None):
+  """ Runs ILCExperiment for the ilc.py arguments argv in this process and
+      returns its results row. NumPy's global RNG (--noise, --rollouts) is
+      seeded from run_id, so reruns of a configuration reproduce it. """
+  start = time.perf_counter()
+  try:
+    np.random.seed(int(run_id[:8], 16))
+    experiment = ILCExperiment(get_parser().parse_args(argv + ['--no-stdout']), shared_operators)
+    row = summarize(experiment)
+  except Exception:
+    row = dict(status='error', error=traceback.format_exc().strip().splitlines()[-1])
+  finally:
+    plt.close('all')
+
+  row['time'] = time.perf_counter() - start
+  return row
+
+def run_job(job):
+  """ Runs a job of get_jobs. Its operators are None, 'export' to return
+      the learning operators the run computes in the row (_operators) or a
+      SharedOperators registry to read them from. The row also holds the
+      worker's (pid, Pss, private bytes) after the run (_memory). """
+  run_id, config, argv, operators = job
+
+  store = None
+  if operators == 'export':
+    store = OperatorCollector()
+  elif operators is not None:
+    worker_operators.registry.update(operators)
+    store = worker_operators
+
+  row = run_config(argv, run_id, store)
+  row['id'] = run_id
+  row.update(config)
+
+  if operators == 'export':
+    row['_operators'] = store.operators
+  row['_memory'] = (os.getpid(), memory_usage())
+  return row
+
+class ResultsTable(object):
+  """ CSV file with one row per finished run (id, the swept parameters and
+      result_columns), appended and flushed as runs finish. A run counts as
+      completed once it has a row whose status is not error. Other fields
+      of the rows are not written. """
+  def __init__(self, path, param_names):
+    self.path = path
+    # id : row of the completed runs
+    self.completed = {}
+    # ids of all rows, errors included
+    self.ids = set()
+
+    fieldnames = ['id'] + param_names + result_columns
+    if os.path.exists(path) and os.path.getsize(path):
+      with open(path) as f:
+        reader = csv.DictReader(f)
+        assert set(fieldnames) <= set(reader.fieldnames), "%s has the columns %s, not %s" % (path, reader.fieldnames, fieldnames)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+        self.completed = { row['id'] : row for row in rows if row['status'] != 'error' }
+        self.ids = set(row['id'] for row in rows)
+
+      self.f = open(path, 'a')
+      self.writer = csv.DictWriter(self.f, fieldnames, extrasaction='ignore')
+    else:
+      self.f = open(path, 'w')
+      self.writer = csv.DictWriter(self.f, fieldnames, extrasaction='ignore')
+      self.writer.writeheader()
+
+  def write(self, row):
+    self.ids.add(row['id'])
+    self.writer.writerow(row)
+    self.f.flush()
+
+  def close(self):
+    self.f.close()
+
+def operator_groups(jobs):
+  """ Lists of the jobs that can share the learning operators of a constant_ilc_mats model """
+  groups = {}
+  for job in jobs:
+    options = vars(get_parser().parse_args(job[2]))
+    if system_map[options['system']][0].constant_ilc_mats:
+      groups.setdefault(content_key({ name : options[name] for name in operator_group_args }), []).append(job)
+
+  return [group for group in groups.values() if len(group) > 1]
+
+def run_jobs(jobs, table, n_workers, blas_threads, describe, share_operators=False):
+  """ Runs the (id, config, argv, operators) jobs on a pool of n_workers
+      processes with blas_threads BLAS threads each. Yields their rows as
+      they finish, after writing them to table.
+
+      With share_operators, the first run of every group of operator_groups
+      runs before the others and returns its learning operators. They are
+      published in shared memory, where the rest of the group reads them. """
+  # Spawned workers import NumPy afresh and pick these up; plots go nowhere.
+  os.environ.update(blas_environment(blas_threads))
+  os.environ['MPLBACKEND'] = 'Agg'
+
+  first, rest = jobs, []
+  if share_operators:
+    groups = operator_groups(jobs)
+    waiting = set(job[0] for group in groups for job in group[1:])
+    exporting = set(group[0][0] for group in groups)
+
+    first = [job[:3] + ('export' if job[0] in exporting else None,) for job in jobs if job[0] not in waiting]
+    rest = [job for job in jobs if job[0] in waiting]
+
+  shared = SharedOperators()
+  memory = {}
+  n_done = 0
+
+  with multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+    try:
+      for batch in (first, rest):
+        if batch is rest:
+          batch = [job[:3] + (shared.registry,) for job in rest]
+
+        for row in pool.imap_unordered(run_job, batch):
+          for key, arrays in row.pop('_operators', {}).items():
+            shared.publish(key, arrays)
+
+          pid, usage = row.pop('_memory')
+          if usage is not None:
+            memory[pid] = usage
+
+          n_done += 1
+          table.write(row)
+          print("[%d/%d] %s" % (n_done, len(jobs), describe(row)))
+          yield row
+
+    finally:
+      if shared.blocks:
+        print("Shared operators: %d arrays, %.1f MB (one copy)" % (len(shared.blocks), shared.nbytes() / 1e6))
+      if share_operators and memory:
+        print("Worker memory after their last run: %d processes, %.1f MB Pss in total, %.1f MB private at most" % (len(memory), sum(pss for pss, _ in memory.values()) / 1e6, max(private for _, private in memory.values()) / 1e6))
+
+      shared.close(unlink=True)
+
+def get_sweep_parser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, allow_abbrev=False,
+    description="Runs ilc.py experiments over a parameter grid or manifest on a process pool. Arguments not listed here are passed to every run (e.g. --system 3d --fb --ff).")
+  parser.add_argument("--grid", default=[], nargs='+', type=str, help="Parameters to sweep, as name=v1,v2,... (e.g. alpha=0.5,1 w=0.01,0.1). All combinations are run.")
+  parser.add_argument("--manifest", default=None, type=str, help="File of configurations to run, one JSON object of option values per line (e.g. {\"alpha\": 0.5, \"poke\": true}). Combined with every --grid point.")
+  parser.add_argument("--out", default="sweep.csv", type=str, help="Results table. Configurations it already holds results for are skipped.")
+  parser.add_argument("--workers", default=multiprocessing.cpu_count(), type=int, help="No. of worker processes.")
+  parser.add_argument("--blas-threads", default=1, type=int, help="No. of BLAS threads per worker.")
+  parser.add_argument("--share-operators", default=False, action='store_true', help="Compute the learning operators (and pseudoinverse) of constant_ilc_mats systems (3ddedis, 2ddedis) once per ILC grid and share them between the workers through shared memory.")
+  return parser
+
+def get_jobs(base_argv, configs):
+  """ (id, config, argv, operators) of every configuration, without duplicates (see run_job) """
+  jobs = []
+  ids = set()
+  for config in configs:
+    argv = config_argv(base_argv, config)
+    run_id = config_id(argv)
+    if run_id not in ids:
+      ids.add(run_id)
+      jobs.append((run_id, config, argv, None))
+
+  return jobs
+
+if __name__ == "__main__":
+  args, base_argv = get_sweep_parser().parse_known_args()
+
+  configs = parse_grid(args.grid)
+  if args.manifest is not None:
+    configs = [dict(m, **g) for m in load_manifest(args.manifest) for g in configs]
+
+  param_names = []
+  for config in configs:
+    param_names += [name for name in config if name not in param_names]
+
+  jobs = get_jobs(base_argv, configs)
+  table = ResultsTable(args.out, param_names)
+  todo = [job for job in jobs if job[0] not in table.completed]
+
+  print("%d configurations, %d already in %s" % (len(jobs), len(jobs) - len(todo), args.out))
+
+  def describe(row):
+    params = ' '.join("%s=%s" % (name, row[name]) for name in param_names if name in row)
+    if row['status'] == 'error':
+      return "%s: error: %s" % (params, row['error'])
+
+    return "%s: %s, avg. pos error %g (%.1f s)" % (params, row['status'], row['avg_pos_error'], row['time'])
+
+  sweep_start = time.perf_counter()
+  rows = list(run_jobs(todo, table, args.workers, args.blas_threads, describe, args.share_operators))
+  table.close()
+
+  print("Ran %d configurations in %f s (%d errors)" % (len(rows), time.perf_counter() - sweep_start, sum(row['status'] == 'error' for row in rows)))
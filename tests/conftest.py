@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The experiment scripts and ilc_models are imported from the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
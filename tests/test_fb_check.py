@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("python_utils")
+pytest.importorskip("lqr_gain_match")
+
+from ilc import get_parser, system_map
+from ilc_models.fb_check import feedback_jacobians, get_jacobian, get_perturbations
+
+def reference_jacobians(ilc, states, step_kwargs, eps):
+  """ Central differences with one feedback call per perturbation and step """
+  zs = getattr(ilc, 'zs', None)
+
+  responses = []
+  for i, x in enumerate(states):
+    n = len(ilc.get_ilc_state(x, i))
+    outputs = []
+    for offset in get_perturbations(n, eps, 'central'):
+      if zs is not None:
+        ilc.set_controller_state(zs[i] + offset[len(x):] if n > len(x) else zs[i])
+      outputs.append(ilc.fb_resp_output(ilc.feedback(x=x + offset[:len(x)], integrate=False, **step_kwargs(i))))
+
+    responses.append(get_jacobian(np.array(outputs), n, eps, 'central'))
+
+  return np.array(responses)
+
+@pytest.mark.parametrize('system', ['3d', '3dtv', '3ddedi', '3ddediv', '3ddeditd', '3ddedis'])
+def test_batched_jacobians_match_per_call(system):
+  ilc = system_map[system][0](**vars(get_parser().parse_args(['--system', system, '--fb'])))
+  ilc.reset()
+
+  n_steps = 5
+  rng = np.random.RandomState(0)
+  states = 0.3 * rng.normal(size=(n_steps, 12))
+  desired = [0.3 * rng.normal(size=(n_steps, 3)) for _ in range(7)]
+  controls = 0.1 * rng.normal(size=(n_steps, ilc.n_control))
+
+  if getattr(ilc, 'zs', None) is not None:
+    ilc.zs.reserve(n_steps)
+    for z in rng.normal(size=(n_steps, 2)):
+      ilc.zs.append(*(np.array((9.81, 0.0)) + z))
+
+  def step_kwargs(i):
+    names = ('pos_des', 'vel_des', 'acc_des', 'jerk_des', 'snap_des', 'angvel_des', 'angaccel_des')
+    return dict(dict(zip(names, (d[i] for d in desired))), dt=0.02, u_ilc=controls[i])
+
+  batched = feedback_jacobians(ilc, states, step_kwargs, eps=1e-6)
+  reference = reference_jacobians(ilc, states, step_kwargs, eps=1e-6)
+
+  assert batched.shape == reference.shape
+  # Rounding in the central differences grows with the size of the outputs
+  assert np.allclose(batched, reference, rtol=1e-6, atol=1e-6 * np.abs(reference).max())
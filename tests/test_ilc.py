@@ -0,0 +1,82 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+pytest.importorskip("python_utils")
+
+from ilc import ILCExperiment, get_graded_grid, get_ilc_dts, get_output_inds, get_parser
+
+def test_get_output_inds():
+  ts_ilc = np.linspace(0, 1, 51)
+
+  # The output of step i is at ts_ilc[i + 1].
+  assert list(get_output_inds(ts_ilc, ["0.5"])) == [24]
+  assert list(get_output_inds(ts_ilc, ["0.1:0.16", "1"])) == [4, 5, 6, 7, 49]
+  with pytest.raises(AssertionError):
+    get_output_inds(ts_ilc, ["0.505:0.51"])
+
+def test_graded_grid_uniform_density():
+  ts = np.linspace(0, 2, 101)
+  assert np.allclose(get_graded_grid(ts, np.ones(len(ts)), 8), np.linspace(0, 2, 9))
+
+def test_graded_grid_equal_density_per_step():
+  ts = np.linspace(0, 1, 1001)
+  density = 0.2 + np.exp(-((ts - 0.3) / 0.05) ** 2)
+  grid = get_graded_grid(ts, density, 20)
+
+  assert grid[0] == 0 and grid[-1] == 1
+  assert np.all(np.diff(grid) > 0)
+
+  # Steps are short where the density is high.
+  steps = np.diff(grid)
+  assert steps[np.searchsorted(grid, 0.3) - 1] < 0.2 * np.max(steps)
+
+  cum_density = np.hstack((0, np.cumsum(0.5 * (density[1:] + density[:-1]) * np.diff(ts))))
+  per_step = np.diff(np.interp(grid, ts, cum_density))
+  assert np.allclose(per_step, cum_density[-1] / 20, rtol=1e-6)
+
+def test_ilc_dts_of_uniform_grid_span_the_grid():
+  # An ILC dt of 0.03 does not divide 1.1, so the grid has 37 steps of 1.1 / 37.
+  ts_ilc = np.linspace(0, 1.1, int(round(1.1 / 0.03)) + 1)
+
+  assert np.isclose(get_ilc_dts(ts_ilc, True), 1.1 / 37)
+  assert np.allclose(get_ilc_dts(ts_ilc, False), 1.1 / 37)
+
+def run_experiment(*argv):
+  return ILCExperiment(get_parser().parse_args(list(argv) + ['--no-stdout']))
+
+@pytest.mark.parametrize('system', ['linearpos', '3d'])
+@pytest.mark.parametrize('stream', [(), ('--stream',)])
+def test_abort_on_first_record(system, stream):
+  # The initial position is already beyond the abort threshold.
+  experiment = run_experiment('--system', system, '--fb', '--ff', '--trials', '3', '--init-pos-offset', '1', '--abort-pos-error', '0.5', *stream)
+
+  assert experiment.diverged == (0, 0.0, "pos error above 0.500000")
+  assert experiment.avg_pos_errors == [np.inf]
+  assert experiment.max_pos_errors == [np.inf]
+
+def test_check_fb_resp_shape_mismatch_fails():
+  # The analytic response of 3ddedis is in the flat state, not the simulated state.
+  with pytest.raises(AssertionError, match="Numerical FB resp has shape"):
+    run_experiment('--system', '3ddedis', '--fb', '--ff', '--trials', '1', '--check-fb-resp')
+
+@pytest.fixture(params=['fork', 'sequential'])
+def speculative_mode(request, monkeypatch):
+  if request.param == 'sequential':
+    monkeypatch.setattr('multiprocessing.get_all_start_methods', lambda: ['spawn'])
+  elif 'fork' not in multiprocessing.get_all_start_methods():
+    pytest.skip("fork is not available")
+
+def test_alpha_candidates_pick_best_step(speculative_mode):
+  system = ('--system', '3d', '--fb', '--ff', '--trials', '3')
+
+  # A single candidate is the plain update.
+  plain = run_experiment(*system, '--alpha', '1')
+  assert run_experiment(*system, '--alpha-candidates', '1').avg_pos_errors == plain.avg_pos_errors
+
+  # Every trial after the first is the better of the two step sizes.
+  errors = run_experiment(*system[:-1], '2', '--alpha-candidates', '0.5', '1').avg_pos_errors
+  half = run_experiment(*system[:-1], '2', '--alpha', '0.5').avg_pos_errors
+  assert errors[0] == plain.avg_pos_errors[0]
+  assert errors[1] == min(half[1], plain.avg_pos_errors[1])
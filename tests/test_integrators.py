@@ -0,0 +1,37 @@
+import numpy as np
+
+from scipy.signal import cont2discrete
+
+from ilc_models.integrators import DormandPrince, zoh_discretize
+
+def test_zoh_discretize_matches_cont2discrete():
+  dt = 0.02
+  rng = np.random.RandomState(0)
+  Acs = rng.normal(size=(5, 4, 4))
+  Bcs = rng.normal(size=(5, 4, 2))
+
+  # A singular Ac (a double integrator), as for the quadrotor positions
+  Acs[0] = np.diag(np.ones(3), 1)
+
+  As, Bs = zoh_discretize(np.eye(4) + dt * Acs, dt * Bcs)
+  for A, B, Ac, Bc in zip(As, Bs, Acs, Bcs):
+    A_ref, B_ref = cont2discrete((Ac, Bc, np.eye(4), np.zeros((4, 2))), dt, method='zoh')[:2]
+    assert np.allclose(A, A_ref, rtol=1e-12, atol=1e-14)
+    assert np.allclose(B, B_ref, rtol=1e-12, atol=1e-14)
+
+def test_dormand_prince_keeps_step_size_over_short_steps():
+  integrator = DormandPrince(rtol=1e-8, atol=1e-8)
+  f = lambda x: -x
+
+  x = integrator.step(f, np.ones(1), 1.0)
+  assert np.allclose(x, np.exp(-1.0), rtol=1e-7)
+  h = integrator.h
+
+  # Steps shorter than h neither use nor shrink the carried over step size
+  for i in range(10):
+    x = integrator.step(f, x, 1e-3)
+  assert np.allclose(x, np.exp(-1.01), rtol=1e-7)
+  assert integrator.h >= h
+
+  integrator.reset()
+  assert integrator.h is None
@@ -0,0 +1,62 @@
+import csv
+import os
+
+import pytest
+
+from jobqueue import JobQueue, collect
+
+def make_stale(queue, name):
+  old = os.stat(queue.path('running', name)).st_mtime - 2 * queue.timeout
+  os.utime(queue.path('running', name), (old, old))
+
+def test_finish_of_requeued_job_leaves_new_claim(tmp_path):
+  queue = JobQueue(str(tmp_path), timeout=60.0)
+  assert queue.submit([('a', {}, [])], max_attempts=3) == 1
+
+  first = queue.claim('w1')
+  assert first['worker'] == 'w1'
+
+  # w1 misses its heartbeats, and w2 takes the job over.
+  make_stale(queue, 'a')
+  assert queue.requeue_stale() == 1
+  second = queue.claim('w2')
+  assert second['claim'] != first['claim']
+
+  # A late error of w1 neither requeues the job nor touches w2's claim.
+  queue.finish(first, dict(status='error', error='late'))
+  assert queue.names('pending') == []
+  assert queue.read('running', 'a')['claim'] == second['claim']
+
+  queue.finish(second, dict(status='ok'))
+  assert queue.counts()['running'] == 0
+  assert queue.read('done', 'a')['row'] == dict(status='ok')
+  assert 'claim' not in queue.read('done', 'a')
+
+def test_finish_requeues_failed_attempt(tmp_path):
+  queue = JobQueue(str(tmp_path))
+  queue.submit([('a', {}, [])], max_attempts=2)
+
+  queue.finish(queue.claim('w1'), dict(status='error', error='first'))
+  assert queue.names('running') == [] and queue.names('pending') == ['a']
+
+  queue.finish(queue.claim('w1'), dict(status='error', error='second'))
+  assert queue.names('pending') == [] and queue.read('failed', 'a')['attempts'] == 2
+
+def test_collect_writes_failed_jobs_once(tmp_path):
+  # collect writes the table with sweep, which imports ilc.py
+  pytest.importorskip("python_utils")
+
+  queue = JobQueue(str(tmp_path / 'queue'))
+  queue.submit([('a', dict(alpha='0.5'), [])], max_attempts=1)
+  queue.claim('w1')
+  make_stale(queue, 'a')
+  queue.requeue_stale()
+
+  out = str(tmp_path / 'results.csv')
+  assert collect(queue, out) == 1
+  assert collect(queue, out) == 0
+
+  with open(out) as f:
+    rows = list(csv.DictReader(f))
+  assert len(rows) == 1
+  assert (rows[0]['id'], rows[0]['alpha'], rows[0]['status']) == ('a', '0.5', 'error')
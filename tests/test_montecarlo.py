@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip("python_utils")
+
+from montecarlo import get_samples, parse_distribution
+from sweep import config_argv
+
+def test_samples_keep_option_types():
+  distributions = [parse_distribution(spec) for spec in ['trials=uniform:2:6', 'sim-substeps=uniform:1:4', 'thrust_dist=uniform:0.8:1.2', 'init_pos_offset=sphere:0.02']]
+  samples = get_samples(distributions, 5, 0, 3)
+
+  for sample in samples:
+    assert type(sample['trials']) is int and 2 <= sample['trials'] <= 6
+    assert type(sample['sim_substeps']) is int
+    assert type(sample['thrust_dist']) is float
+    assert len(sample['init_pos_offset']) == 3 and all(type(v) is float for v in sample['init_pos_offset'])
+
+    argv = config_argv([], sample)
+    assert argv[argv.index('--trials') + 1] == str(sample['trials'])
+
+def test_unknown_option():
+  with pytest.raises(AssertionError, match="no option --thrust-dsit"):
+    parse_distribution('thrust_dsit=uniform:0.8:1.2')
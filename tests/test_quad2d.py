@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from ilc_models.quad2d import Quad2D
+
+def get_model(**kwargs):
+  options = dict(feedback=False, integrator='euler', sim_substeps=1, integrator_tol=1e-6, event_log_interval=None,
+                 discretization='euler', init_pos_offset=None, init_vel_offset=None, drag_dist=0.0, thrust_dist=1.0)
+  options.update(kwargs)
+  return Quad2D(**options)
+
+@pytest.mark.parametrize('integrator, sim_substeps', [('euler', 1), ('rk4', 1), ('rk45', 1), ('rk4', 3)])
+def test_negative_thrust_recorded_once_per_step(integrator, sim_substeps):
+  ilc = get_model(integrator=integrator, sim_substeps=sim_substeps)
+
+  # Negative thrust on steps 5 to 9 of 20
+  controls = np.array([(-1.0 if 5 <= i < 10 else 9.81, 0.0) for i in range(20)])
+  def fun(x):
+    fun.i += 1
+    return controls[fun.i - 1]
+  fun.i = 0
+
+  ilc.simulate(0.2, fun, 0.01)
+
+  assert ilc.events.snapshot()['negative_thrust'] == (5, 0.05, 0.09)
+
+def test_negative_thrust_batch():
+  ilc = get_model(integrator='rk4')
+  ilc.simulate_batch(0.03, lambda X: np.array(((-1.0, 0.0), (9.81, 0.0))), 0.01, 2)
+
+  assert ilc.events.counts['negative_thrust'] == 3
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("python_utils")
+pytest.importorskip("lqr_gain_match")
+
+from ilc import get_parser, get_poly
+from ilc_models.quad3d import Quad3D
+
+def simulate(*argv, M=None):
+  """ One feedback trial of Quad3D along the default trajectory (no ILC
+      corrections), or with M, one of M vehicles with simulate_batch """
+  args = get_parser().parse_args(['--system', '3d', '--fb'] + list(argv))
+  ilc = Quad3D(**vars(args))
+
+  pos_poly = get_poly(0, end_pos=args.dist, duration=args.traj_duration)
+  vel_poly = np.polyder(pos_poly)
+  acc_poly = np.polyder(vel_poly)
+
+  def control(x):
+    t = control.i * args.sim_dt
+    control.i += 1
+    des = [np.array((0, np.polyval(poly, t), 0)) for poly in (pos_poly, vel_poly, acc_poly)]
+    kwargs = dict(pos_des=des[0], vel_des=des[1], acc_des=des[2], angvel_des=np.zeros(3), angaccel_des=np.zeros(3), u_ilc=np.zeros(4))
+    if M is None:
+      return ilc.feedback(x=x, **kwargs)
+    return ilc.feedback_batch(x, **kwargs)
+
+  control.i = 0
+  if M is None:
+    return ilc.simulate(args.traj_duration, control, args.sim_dt)
+  return ilc.simulate_batch(args.traj_duration, control, args.sim_dt, M)
+
+@pytest.mark.parametrize('argv', [(), ('--sim-substeps', '4'), ('--delay-control', '--thrust-dist', '0.8', '--drag-dist', '0.2')])
+def test_stream_fast_matches_rigid_body(argv):
+  reference = simulate(*argv)
+  fast = simulate('--fast-sim', *argv)
+
+  # Both integrate the same vehicle model; only the attitude representation
+  # (rotation matrices vs. a unit quaternion) and the rounding differ.
+  assert fast.n == reference.n
+  assert np.max(np.abs(reference.pos)) > 1.0
+  assert np.allclose(fast.data, reference.data, rtol=0, atol=1e-9)
+
+def test_feedback_batch_matches_feedback():
+  args = get_parser().parse_args(['--system', '3d', '--fb'])
+  ilc = Quad3D(**vars(args))
+
+  rng = np.random.RandomState(0)
+  X = 0.3 * rng.normal(size=(6, 12))
+  desired = dict(pos_des=rng.normal(size=(6, 3)), vel_des=rng.normal(size=(6, 3)), acc_des=rng.normal(size=(6, 3)),
+                 angvel_des=rng.normal(size=(6, 3)), angaccel_des=rng.normal(size=(6, 3)), u_ilc=rng.normal(size=(6, 4)))
+
+  # Desired values given per row
+  reference = np.array([ilc.feedback(x=x, **{ name : value[k] for name, value in desired.items() }) for k, x in enumerate(X)])
+  assert np.allclose(ilc.feedback_batch(X, **desired), reference, rtol=1e-12, atol=1e-12)
+
+  # Shared desired values
+  shared = { name : value[0] for name, value in desired.items() }
+  reference = np.array([ilc.feedback(x=x, **shared) for x in X])
+  assert np.allclose(ilc.feedback_batch(X, **shared), reference, rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize('integrator', ['euler', 'rk4', 'rk45'])
+def test_simulate_batch_matches_simulate(integrator):
+  argv = ('--integrator', integrator, '--sim-substeps', '2', '--delay-control', '--thrust-dist', '0.8', '--drag-dist', '0.2')
+  reference = simulate(*argv)
+  batch = simulate(*argv, M=2)
+
+  assert np.max(np.abs(reference.pos)) > 1.0
+  for data in batch.data:
+    assert np.allclose(data, reference.data, rtol=0, atol=1e-9)
+
+@pytest.mark.parametrize('system', ['3ddedi', '3ddediv', '3ddeditd', '3ddedis'])
+def test_thrust_map_round_trip(system):
+  from ilc import system_map
+
+  args = get_parser().parse_args(['--system', system, '--fb'])
+  ilc = system_map[system][0](**vars(args))
+  ilc.set_controller_state((10.5, 9.5))
+
+  u, udot = ilc.get_thrust_map().dot(ilc.get_controller_state())
+  if system == '3ddeditd':
+    # The thrust is the delayed int_c.
+    assert (u, udot) == (ilc.int_c, -ilc.T_c * (ilc.int_c - ilc.int_u))
+  else:
+    assert (u, udot) == (ilc.int_u, ilc.int_udot)
+
+  ilc.set_controller_state(np.linalg.solve(ilc.get_thrust_map(), (u, udot)))
+  assert np.allclose(ilc.get_controller_state(), (10.5, 9.5), rtol=1e-14)
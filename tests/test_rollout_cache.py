@@ -0,0 +1,43 @@
+import os
+import time
+
+import numpy as np
+
+from ilc_models.rollout_cache import RolloutCache
+
+def test_shared_directory(tmp_path):
+  a = RolloutCache(str(tmp_path), max_bytes=10 ** 6)
+  b = RolloutCache(str(tmp_path), max_bytes=10 ** 6)
+
+  a.put('x', states=np.arange(3.0))
+  assert np.array_equal(b.get('x')['states'], np.arange(3.0))
+
+  # Removed by the other cache: a miss, not an error
+  os.remove(a.path('x'))
+  assert b.get('x') is None
+  assert (b.hits, b.misses) == (1, 1)
+
+def test_evict_skips_vanished_entries(tmp_path, monkeypatch):
+  cache = RolloutCache(str(tmp_path), max_bytes=0)
+  cache.put('x', states=np.zeros(10))
+
+  # An entry listed here, then evicted by another cache before the stat
+  listdir = os.listdir
+  monkeypatch.setattr(os, 'listdir', lambda path: listdir(path) + ['gone.npz', 'gone.tmp'])
+  cache.put('y', states=np.zeros(10))
+
+  assert not os.path.exists(cache.path('x')) and not os.path.exists(cache.path('y'))
+
+def test_evict_removes_stale_temporary_files(tmp_path):
+  cache = RolloutCache(str(tmp_path), max_bytes=10 ** 6)
+  stale = tmp_path / 'stale.tmp'
+  fresh = tmp_path / 'fresh.tmp'
+  stale.write_bytes(b'partial')
+  fresh.write_bytes(b'partial')
+
+  old = time.time() - 2 * cache.tmp_timeout
+  os.utime(str(stale), (old, old))
+  cache.evict()
+
+  assert not stale.exists()
+  assert fresh.exists()
@@ -0,0 +1,111 @@
+import time
+
+import numpy as np
+
+from solvers import anytime_lsqr, dual_lstsq, lifted_matvec, lifted_operator, lifted_rmatvec, operator_norm
+
+def test_anytime_lsqr_matches_lstsq():
+  rng = np.random.RandomState(0)
+  A = rng.normal(size=(60, 20))
+  b = rng.normal(size=60)
+
+  x, residual, converged, _ = anytime_lsqr(A, b)
+  x_ref = np.linalg.lstsq(A, b, rcond=None)[0]
+
+  assert converged
+  assert np.allclose(x, x_ref, atol=1e-6)
+  assert np.isclose(residual, np.linalg.norm(A.dot(x_ref) - b), rtol=1e-6)
+
+def test_anytime_lsqr_deadline_returns_best_iterate():
+  rng = np.random.RandomState(1)
+  A = rng.normal(size=(200, 100))
+  b = rng.normal(size=200)
+
+  # A deadline in the past stops after the first iteration.
+  x, residual, converged, iters = anytime_lsqr(A, b, deadline=time.perf_counter() - 1)
+
+  assert iters == 1
+  assert not converged
+  assert residual < np.linalg.norm(b)
+  assert np.isclose(residual, np.linalg.norm(A.dot(x) - b))
+
+def test_anytime_lsqr_zero_rhs():
+  x, residual, converged, iters = anytime_lsqr(np.eye(3), np.zeros(3))
+  assert converged and iters == 0 and residual == 0
+  assert np.all(x == 0)
+
+def get_linear_model(**kwargs):
+  from ilc_models.quad2dlin import Quad2DLin
+
+  class Quad2DLinFB(Quad2DLin):
+    """ Quad2DLin with the (open loop) feedback response the dense operator needs """
+    def get_feedback_response(self, state, control, dt):
+      return np.zeros((self.n_control, self.n_state)), np.eye(self.n_control)
+
+  options = dict(feedback=False, integrator='euler', sim_substeps=1, integrator_tol=1e-6, event_log_interval=None,
+                 discretization='euler', init_pos_offset=None, init_vel_offset=None)
+  options.update(kwargs)
+  return Quad2DLinFB(**options)
+
+def get_linearization_args(model, N, seed=0):
+  """ Random states and controls (the model is linearized about them) and desired values """
+  rng = np.random.RandomState(seed)
+  states = rng.normal(size=(N + 1, model.n_state))
+  controls = rng.normal(size=(N + 1, model.n_control))
+  desired = [np.zeros((N + 1, 2)) for _ in range(5)]
+  return [0.02, states, controls] + desired
+
+def test_lifted_operator_matches_dense():
+  model = get_linear_model()
+  args = get_linearization_args(model, 25)
+
+  calCBpD, _ = model.get_learning_operator(*args)
+  As, Bs, Cs, _ = model.get_linearization(*args)
+  op = lifted_operator(As, Bs, Cs)
+
+  rng = np.random.RandomState(1)
+  u = rng.normal(size=calCBpD.shape[1])
+  e = rng.normal(size=calCBpD.shape[0])
+
+  assert op.shape == calCBpD.shape
+  assert np.allclose(lifted_matvec(As, Bs, Cs, u), calCBpD.dot(u), rtol=1e-10, atol=1e-12)
+  assert np.allclose(lifted_rmatvec(As, Bs, Cs, e), calCBpD.T.dot(e), rtol=1e-10, atol=1e-12)
+  assert np.allclose(op.matvec(u), calCBpD.dot(u), rtol=1e-10, atol=1e-12)
+  assert np.allclose(op.rmatvec(e), calCBpD.T.dot(e), rtol=1e-10, atol=1e-12)
+
+def test_operator_norm_estimates_largest_singular_value():
+  model = get_linear_model()
+  args = get_linearization_args(model, 25)
+
+  calCBpD, _ = model.get_learning_operator(*args)
+  As, Bs, Cs, _ = model.get_linearization(*args)
+
+  sigma = np.linalg.norm(calCBpD, 2)
+  assert abs(operator_norm(lifted_operator(As, Bs, Cs), iters=200, rtol=1e-9) - sigma) <= 1e-3 * sigma
+
+def test_p2p_operators_select_rows_of_dense():
+  model = get_linear_model()
+  args = get_linearization_args(model, 25)
+  output_inds = np.array([4, 10, 11, 24])
+
+  calCBpD, _ = model.get_learning_operator(*args)
+  rows = calCBpD.reshape((25, model.n_out, -1))[output_inds].reshape((len(output_inds) * model.n_out, -1))
+
+  calCBpD_p2p, G = model.get_learning_operator(*args, output_inds=output_inds)
+  assert G is None
+  assert np.allclose(calCBpD_p2p, rows, rtol=1e-10, atol=1e-12)
+
+  As, Bs, Cs, _ = model.get_linearization(*args)
+  op = lifted_operator(As, Bs, Cs, output_inds)
+  e = np.random.RandomState(2).normal(size=len(rows))
+  assert op.shape == rows.shape
+  assert np.allclose(op.rmatvec(e), rows.T.dot(e), rtol=1e-10, atol=1e-12)
+
+def test_dual_lstsq_matches_primal():
+  rng = np.random.RandomState(3)
+  P = rng.normal(size=(8, 40))
+  e = rng.normal(size=8)
+  weights = rng.uniform(0.1, 2.0, size=40)
+
+  primal = np.linalg.lstsq(np.vstack((P, np.diag(weights))), -np.hstack((e, np.zeros(40))), rcond=None)[0]
+  assert np.allclose(dual_lstsq(P, e, weights), primal, rtol=1e-8, atol=1e-10)
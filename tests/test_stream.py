@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from scipy.interpolate import interp1d
+
+from ilc_models.stream import Resampler, run_stream, stream_chunks
+
+def get_records(ts, xs):
+  """ simulate_stream like records, without a control for the final state """
+  return ((t, x, np.zeros(2) if i < len(ts) - 1 else None) for i, (t, x) in enumerate(zip(ts, xs)))
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_resampler_matches_interp1d(chunk_size):
+  ts = np.linspace(0, 1, 51)
+  xs = np.random.RandomState(0).normal(size=(len(ts), 5))
+  new_ts = np.hstack((0, np.sort(np.random.RandomState(1).uniform(0, 1, 20)), ts[10], 1))
+
+  resampler = Resampler(ts, new_ts)
+  run_stream(stream_chunks(get_records(ts, xs), chunk_size), [resampler])
+
+  assert np.array_equal(resampler.data, interp1d(ts, xs, axis=0)(new_ts))
@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+pytest.importorskip("python_utils")
+
+from sweep import config_argv, load_manifest, parse_grid
+
+def test_parse_grid_flags():
+  configs = parse_grid(['fb=true,False', 'alpha=0.5,1'])
+
+  assert configs[0] == dict(fb=True, alpha='0.5')
+  assert [config_argv([], config) for config in configs] == [
+    ['--fb', '--alpha', '0.5'],
+    ['--fb', '--alpha', '1'],
+    ['--alpha', '0.5'],
+    ['--alpha', '1'],
+  ]
+
+def test_parse_grid_rejects_unknown_options_and_flag_values():
+  with pytest.raises(AssertionError, match="no option --alhpa"):
+    parse_grid(['alhpa=0.5,1'])
+
+  with pytest.raises(AssertionError, match="is a flag"):
+    parse_grid(['fb=1'])
+
+def test_load_manifest_rejects_unknown_options(tmp_path):
+  path = tmp_path / 'manifest.jsonl'
+  path.write_text(json.dumps(dict(alpha=0.5)) + '\n' + json.dumps(dict(alhpa=0.5)) + '\n')
+
+  with pytest.raises(AssertionError, match="no option --alhpa"):
+    load_manifest(str(path))